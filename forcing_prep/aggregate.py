@@ -11,48 +11,100 @@
 
 import numpy as np
 import xarray as xr
+from scipy import sparse
 
 
-def window_aggregate(dataset, coverage):
+def build_weight_matrix(coverage, shape):
     """
-    For each coverage window defined in coverage, grab the
-    data from dataset for the coverage cells and do a weighted
-    average for all times in the dataset.
+    Build a sparse (divide x grid cell) weight matrix from a coverage table.
+
+    Each row holds the coverage of one divide over the raveled (y, x) cells of
+    a raster with the given shape, normalized so the row sums to one. The
+    weighted mean of every divide is then a single sparse mat-mul over the
+    flattened spatial axes.
+
+    Parameters
+    ----------
+    coverage : pd.DataFrame
+        Coverage table indexed by divide_id with `coverage`, `global_idx_y`
+        and `global_idx_x` columns, as built by `weights.get_all_cov`.
+    shape : tuple
+        The (y, x) shape of the raster the global indices refer to.
+
+    Returns
+    -------
+    tuple
+        (matrix, ids) where matrix is a scipy.sparse.csr_matrix of shape
+        (len(ids), y * x) and ids are the sorted unique divide ids, one per row.
     """
-    all = []
-    windows = coverage.groupby("divide_id")
     ids = coverage.index.unique().sort_values()
+    rows = ids.get_indexer(coverage.index)
+    cols = np.ravel_multi_index(
+        (coverage["global_idx_y"].values, coverage["global_idx_x"].values), shape
+    )
+    # keep the weights in double precision so the aggregation matches
+    # the float64 results of summing coverage * values per divide
+    cov = coverage["coverage"].values.astype(np.float64)
+    matrix = sparse.csr_matrix(
+        (cov, (rows, cols)), shape=(len(ids), int(np.prod(shape)))
+    )
+    # normalize by the total coverage of each divide
+    with np.errstate(divide="ignore", invalid="ignore"):
+        norm = 1.0 / np.asarray(matrix.sum(axis=1)).ravel()
+    matrix = sparse.diags(norm) @ matrix
+    return matrix.tocsr(), ids
+
+
+def divide_blocks(n_divides, cid=-1):
+    """The row slices of blocks of `cid` divides, or a single slice of all divides when cid is -1"""
+    if cid == -1 or cid >= n_divides:
+        return [slice(0, n_divides)]
+    return [slice(start, min(start + cid, n_divides)) for start in range(0, n_divides, cid)]
+
+
+def window_aggregate(dataset, matrix, ids):
+    """
+    Compute the coverage weighted mean of every divide for all variables and
+    times in the dataset in one sparse mat-mul.
+
+    `dataset` is a (variable, time, y, x) block whose spatial extent matches
+    the shape `matrix` was built with (see `build_weight_matrix`).
+    """
+    nvar, ntime = dataset.shape[0], dataset.shape[1]
+    # flatten to (variable * time, cells) so each row is one raster
+    values = np.asarray(dataset.values).reshape(nvar * ntime, -1)
+    out = np.empty((nvar, ntime, len(ids)), dtype=np.result_type(values.dtype, matrix.dtype))
+    # one pass without allocating to find out whether the block has any NaN
+    if np.isnan(values.sum()):
+        # cells without data (e.g. outside the AORC domain) are left out of the mean,
+        # renormalizing the weights of the remaining cells of each divide
+        nan = np.isnan(values)
+        # only the few cells with a NaN at some time step need their valid weight per raster,
+        # the weight of the others is counted once
+        cols = np.flatnonzero(nan.any(axis=0))
+        rest = np.ones(values.shape[1], dtype=matrix.dtype)
+        rest[cols] = 0
+        norm = (matrix[:, cols] @ (~nan[:, cols]).T.astype(matrix.dtype)).T + matrix @ rest
+        # the block may be shared (e.g. by the divide blocks), so it is zeroed in a copy
+        values = np.where(nan, 0, values)
+        del nan
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out.reshape(nvar * ntime, len(ids))[:] = (matrix @ values.T).T / norm
+    else:
+        out.reshape(nvar * ntime, len(ids))[:] = (matrix @ values.T).T
 
-    for id in ids:
-        window = windows.get_group(id)
-        cov = window["coverage"]
-        index = (window["global_idx_y"], window["global_idx_x"])
-        # get the raw numpy data for window cells
-        sub = dataset.values[:, :, index[0], index[1]]
-        # perform the aggregation, axis 2 is time
-        # axis 1 is variable
-        data = np.sum(sub * cov.values, axis=2) / cov.sum()
-        # create the dataarray to hold this aggregated data in
-        # with the window id as a dim/coord
-        da = xr.DataArray(
-            data[:, :, np.newaxis],  # add a new axis for the divide_id
-            dims=[
-                "variable",
-                "time",
-                "divide_id",
-            ],
-            coords={
-                "time": dataset.coords["time"],
-                "variable": dataset["variable"].values,
-                "divide_id": [id],
-            },
-        )
-        # TODO don't append, lists get really large and may be leaking mem??
-        # can allocate and define the final datarray upfront and just dump into it...
-        all.append(da)
-
-    ret = xr.concat(all, dim="divide_id")
-    # Try to get rid of the data we don't need anymore, not sure this is
-    # actually helping the memory pressure through
+    ret = xr.DataArray(
+        out,
+        dims=[
+            "variable",
+            "time",
+            "divide_id",
+        ],
+        coords={
+            "time": dataset.coords["time"],
+            "variable": dataset["variable"].values,
+            "divide_id": ids,
+        },
+    )
     del dataset
     return ret
@@ -0,0 +1,111 @@
+"""basin_registry.py
+    Module for keeping basin geometries and their weights in memory for a run
+
+    generate_hrrr.py processes every basin again for every day (or window),
+    so without a registry each basin's geopackage is read from s3 (or found
+    among the local geopackages) and reprojected to the HRRR grid every day,
+    and its coverage table is read back from the weights store every day. The
+    registry loads each basin once and keeps its divides, and it sits in front
+    of the WeightStore so coverage tables are read or computed once and then
+    served from memory. The time of the first load of every basin and table
+    is recorded, so the summary reports the time that reusing them saved.
+"""
+
+import time
+
+from weights_store import weights_key
+
+
+class _MemoryWeights:
+    """
+    The WeightStore interface used by geo_proc.get_coverage, with entries kept in memory.
+
+    Entries missing from memory are read from `store` if given, and new entries are also
+    written to it, so other runs still share them.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self.entries = {}
+        self.seconds = {}
+        self.reused = 0
+        self.saved = 0.0
+        self._missed = {}
+
+    @property
+    def root(self):
+        return "memory" if self.store is None else f"memory ({self.store.root})"
+
+    def key(self, data, gdf, y_lat_dim, x_lon_dim, id_col="divide_id"):
+        return weights_key(data, gdf, y_lat_dim, x_lon_dim, id_col)
+
+    def get(self, key):
+        if key in self.entries:
+            self.reused += 1
+            self.saved += self.seconds[key]
+            return self.entries[key]
+        tic = time.perf_counter()
+        entry = self.store.get(key) if self.store is not None else None
+        if entry is None:
+            # timed until put, which includes computing the weights
+            self._missed[key] = tic
+            return None
+        self.entries[key] = entry
+        self.seconds[key] = time.perf_counter() - tic
+        return entry
+
+    def put(self, key, coverage, grid):
+        if self.store is not None:
+            self.store.put(key, coverage, grid)
+        self.entries[key] = (coverage, grid)
+        if key in self._missed:
+            self.seconds[key] = time.perf_counter() - self._missed.pop(key)
+        else:
+            self.seconds.setdefault(key, 0.0)
+
+
+class BasinRegistry:
+    """
+    Per run registry of basin divides and coverage weights, loaded once and reused.
+
+    Parameters
+    ----------
+    loader : callable
+        Reads the divides of a basin id, already projected to the grid (e.g.
+        generate_hrrr.read_basin with its other arguments bound).
+    weight_store : WeightStore, optional
+        Store of the weights not in memory yet. Default None keeps them in memory only.
+
+    Attributes
+    ----------
+    weights
+        Pass as the `weight_store` of process_geo_data/process_geo_data_batch.
+    """
+
+    def __init__(self, loader, weight_store=None):
+        self.loader = loader
+        self.weights = _MemoryWeights(weight_store)
+        self.gdfs = {}
+        self.seconds = {}
+        self.reused = 0
+        self.saved = 0.0
+
+    def gdf(self, basin):
+        """The divides of `basin`, loaded on first use"""
+        if basin in self.gdfs:
+            self.reused += 1
+            self.saved += self.seconds[basin]
+            return self.gdfs[basin]
+        tic = time.perf_counter()
+        self.gdfs[basin] = self.loader(basin)
+        self.seconds[basin] = time.perf_counter() - tic
+        return self.gdfs[basin]
+
+    def summary(self):
+        """Print the loads and the time saved by reusing them"""
+        weights = self.weights
+        print(
+            f"Basin registry: {len(self.gdfs)} basins loaded in {sum(self.seconds.values()):.1f} s and reused "
+            f"{self.reused} times, saving {self.saved:.1f} s; {len(weights.entries)} weights read or computed in "
+            f"{sum(weights.seconds.values()):.1f} s and reused {weights.reused} times, saving {weights.saved:.1f} s"
+        )
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Benchmark the coverage table builder in weights.get_all_cov
+
+Compares the vectorized builder against the previous dask/iterrows based
+implementation on a synthetic exact extract weights dataframe shaped like a
+hydrofabric geopackage (many divides, tens of cells each).
+
+    Example
+    -------
+    python bench_coverage.py --divides 20000 --cells 40
+"""
+import argparse
+import time
+
+import dask.array as da
+import dask.dataframe as ddf
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from weights import get_all_cov
+
+
+def _build_index_dask(series, global_shape):
+    """The previous per row implementation of weights._build_index"""
+    all = []
+    for _, series in series.iterrows():
+        cells = series["cell_id"]
+        ids = pd.Series(da.from_array(cells), name="ids")
+        cov = pd.Series(da.from_array(series["coverage"]), name="coverage")
+        global_idx = np.unravel_index(cells, global_shape)
+        idy = pd.Series(da.from_array(global_idx[0]), name="global_idx_y")
+        idx = pd.Series(da.from_array(global_idx[1]), name="global_idx_x")
+        did = pd.Series([series.name] * len(cells), name="divide_id")
+        df = pd.concat([ids, cov, idy, idx, did], axis=1).set_index("divide_id")
+        all.append(df)
+    return pd.concat(all)
+
+
+def get_all_cov_dask(dataset, weights_df, y_lat_dim="latitude", x_lon_dim="longitude"):
+    """The previous implementation of weights.get_all_cov"""
+    dask_weights = ddf.from_pandas(weights_df, npartitions=8)
+    meta = {
+        "ids": np.int64,
+        "coverage": float,
+        "global_idx_y": np.int64,
+        "global_idx_x": np.int64,
+    }
+    all = dask_weights.map_partitions(
+        _build_index_dask, (dataset[y_lat_dim].size, dataset[x_lon_dim].size), meta=meta
+    )
+    return all.compute()
+
+
+def synthetic_weights(n_divides, n_cells, shape, seed=0):
+    """Build an exact extract style weights dataframe with object array columns"""
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, 2 * n_cells, n_divides)
+    starts = rng.integers(0, shape[0] * shape[1] - 2 * n_cells, n_divides)
+    cell_id = [np.arange(s, s + n, dtype=np.int64) for s, n in zip(starts, sizes)]
+    coverage = [rng.random(n) for n in sizes]
+    ids = pd.Index([f"cat-{i}" for i in range(n_divides)], name="divide_id")
+    return pd.DataFrame({"cell_id": cell_id, "coverage": coverage}, index=ids)
+
+
+def _time(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark coverage table construction.")
+    parser.add_argument("--divides", type=int, default=5000, help="Number of divides")
+    parser.add_argument("--cells", type=int, default=40, help="Mean number of cells per divide")
+    parser.add_argument("--ny", type=int, default=1000, help="Raster rows")
+    parser.add_argument("--nx", type=int, default=1000, help="Raster columns")
+    parser.add_argument("--repeat", type=int, default=1, help="Timing repeats, best is reported")
+    args = parser.parse_args()
+
+    dataset = xr.Dataset(coords={"latitude": np.arange(args.ny), "longitude": np.arange(args.nx)})
+    weights_df = synthetic_weights(args.divides, args.cells, (args.ny, args.nx))
+
+    t_old, old = _time(get_all_cov_dask, dataset, weights_df, repeat=args.repeat)
+    t_new, new = _time(get_all_cov, dataset, weights_df, repeat=args.repeat)
+
+    # results must agree up to the float32 coverage, dask sorts on the index
+    old = old.sort_index(kind="stable")
+    new = new.sort_index(kind="stable")
+    assert (old.index == new.index).all()
+    for col in ["ids", "global_idx_y", "global_idx_x"]:
+        assert np.array_equal(old[col].values, new[col].values)
+    assert np.allclose(old["coverage"].values, new["coverage"].values, rtol=1e-6)
+
+    mb_old = old.memory_usage(index=False).sum() / 2**20
+    mb_new = new.memory_usage(index=False).sum() / 2**20
+    print(f"{args.divides} divides, {len(new)} coverage rows")
+    print(f"dask/iterrows : {t_old:8.3f} s  {mb_old:8.1f} MiB")
+    print(f"vectorized    : {t_new:8.3f} s  {mb_new:8.1f} MiB")
+    print(f"speedup       : {t_old / t_new:8.1f}x")
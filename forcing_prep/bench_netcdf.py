@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Benchmark the ngen netcdf written by generate.to_ngen_netcdf
+
+Compares the previous writer (float64, contiguous, Time broadcast to every
+catchment in memory), the default writer (float64, chunked per catchment) and
+the compressed mode (float32, zlib/shuffle, chunked per catchment) on a
+synthetic aggregated forcing dataset. Reports write time, peak memory of the
+write, file size and the time to read every variable of a sample of
+catchments the way ngen does (one catchment row at a time).
+
+The synthetic forcing is a diurnal cycle plus noise, which compresses less
+well than real forcing (e.g. hours of zero precipitation).
+
+    Example
+    -------
+    python bench_netcdf.py --catchments 2000 --hours 8760
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from generate import to_ngen_netcdf
+
+VARIABLES = [
+    "APCP_surface", "DLWRF_surface", "DSWRF_surface", "PRES_surface",
+    "SPFH_2maboveground", "TMP_2maboveground", "UGRD_10maboveground", "VGRD_10maboveground",
+]
+
+
+def synthetic_forcing(n_catchments, n_hours, seed=0):
+    """A (time, divide_id) float64 dataset shaped like a process_geo_data result"""
+    rng = np.random.default_rng(seed)
+    time_index = pd.date_range("2022-01-01", periods=n_hours, freq="h")
+    diurnal = np.sin(2 * np.pi * np.arange(n_hours) / 24)[:, None]
+    ds = xr.Dataset(coords={"time": time_index, "divide_id": [f"cat-{i}" for i in range(n_catchments)]})
+    for i, name in enumerate(VARIABLES):
+        base = rng.uniform(0, 300, n_catchments)[None, :]
+        noise = rng.normal(0, 1, (n_hours, n_catchments))
+        ds[name] = (("time", "divide_id"), base + (i + 1) * diurnal + noise)
+    return ds
+
+
+def to_ngen_netcdf_legacy(ds, out_dir, uniq_name):
+    """The previous implementation of generate.to_ngen_netcdf"""
+    ds = ds.rename_dims({"divide_id": "catchment-id"})
+    ds = ds.rename({"divide_id": "ids", "time": "Time"})
+    ds = ds.rename_dims({"Time": "time"})
+    ds = ds.transpose("catchment-id", "time")
+    ds["Time"] = ds["Time"].expand_dims({"catchment-id": ds["catchment-id"]})
+    ds.to_netcdf(Path(out_dir) / f"{uniq_name}.nc")
+
+
+def read_like_ngen(path, catchments):
+    """Read Time once, then every variable over all time for each catchment"""
+    start = time.perf_counter()
+    with netCDF4.Dataset(path, "r") as nc:
+        nc["Time"][0, :]
+        names = [name for name in nc.variables if name not in ("ids", "Time", "catchment-id")]
+        for idx in catchments:
+            for name in names:
+                nc[name][idx, :]
+    return time.perf_counter() - start
+
+
+def bench(ds, out_dir, mode, catchments):
+    tracemalloc.start()
+    start = time.perf_counter()
+    if mode == "previous":
+        to_ngen_netcdf_legacy(ds, out_dir, mode)
+    else:
+        to_ngen_netcdf(ds, out_dir, mode, compress=mode == "compressed")
+    write = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    path = Path(out_dir) / f"{mode}.nc"
+    return {
+        "write_s": write,
+        "peak_mb": peak / 1e6,
+        "size_mb": path.stat().st_size / 1e6,
+        "read_s": read_like_ngen(path, catchments),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark to_ngen_netcdf with and without compression")
+    parser.add_argument("--catchments", type=int, default=2000, help="Number of catchments")
+    parser.add_argument("--hours", type=int, default=8760, help="Number of hourly time steps")
+    parser.add_argument("--sample", type=int, default=200, help="Number of catchments read back")
+    args = parser.parse_args()
+
+    ds = synthetic_forcing(args.catchments, args.hours)
+    data_mb = sum(ds[name].nbytes for name in ds.data_vars) / 1e6
+    catchments = np.random.default_rng(1).choice(args.catchments, min(args.sample, args.catchments), replace=False)
+    print(f"{args.catchments} catchments x {args.hours} hours x {len(VARIABLES)} variables, {data_mb:.0f} MB in memory")
+    with tempfile.TemporaryDirectory() as out_dir:
+        for mode in ["previous", "default", "compressed"]:
+            r = bench(ds, out_dir, mode, catchments)
+            print(
+                f"{mode:>10}: write {r['write_s']:.2f} s, "
+                f"peak {r['peak_mb']:.0f} MB, file {r['size_mb']:.0f} MB, "
+                f"ngen read of {len(catchments)} catchments {r['read_s']:.2f} s"
+            )
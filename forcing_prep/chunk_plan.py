@@ -0,0 +1,118 @@
+"""chunk_plan.py
+    Module for choosing the variable/time/divide chunking of the aggregation
+
+    The chunk sizes used by geo_proc (cvar, ctime, cid) decide how much of the
+    forcing is held in memory per task. Rather than hand tuning them for each
+    domain, plan_chunks derives them from a memory budget, the number of
+    cells read, the number of divides and the source chunk shape.
+"""
+
+import os
+
+import dask
+import numpy as np
+
+
+def dask_workers():
+    """Number of tasks dask may run at once with the current scheduler config"""
+    try:
+        from distributed import default_client
+
+        # a cluster from cluster.start_cluster runs a task per worker thread
+        return int(sum(default_client().nthreads().values()))
+    except (ImportError, ValueError):
+        pass
+    pool = dask.config.get("pool", None)
+    workers = getattr(pool, "_processes", None) or dask.config.get("num_workers", None)
+    return int(workers or os.cpu_count() or 1)
+
+
+def block_bytes(cvar, ctime, n_cells, n_divides, itemsize=4):
+    """
+    Estimated peak memory of one aggregation task: the input block and its
+    contiguous (or NaN zeroed) copy, the NaN mask of blocks with missing cells,
+    plus the float64 mat-mul result and output array.
+    """
+    return cvar * ctime * (n_cells * (2 * itemsize + 1) + 2 * n_divides * 8)
+
+
+def _fit(budget, step, n_var, n_time, n_cells, n_divides, itemsize):
+    """The variable and time chunks of the largest task within `budget`, for `n_divides` divides per task"""
+    cvar = n_var
+    # Fewer variables per task only if a single source time chunk does not fit
+    while cvar > 1 and block_bytes(cvar, step, n_cells, n_divides, itemsize) > budget:
+        cvar = int(np.ceil(cvar / 2))
+    per_step = block_bytes(cvar, 1, n_cells, n_divides, itemsize)
+    ctime = max(int(budget // per_step) // step * step, step)
+    return int(cvar), int(min(ctime, n_time))
+
+
+def plan_chunks(n_var, n_time, n_cells, n_divides, mem_gb, src_ctime=None, itemsize=4, workers=1, cid=-1):
+    """
+    Pick the variable, time and divide chunk sizes for geo_proc's aggregation.
+
+    All variables are kept in one chunk when possible, since the weights are
+    applied to every variable at once. The time chunk is then the largest
+    multiple of the source time chunk that keeps `workers` concurrent tasks
+    within the memory budget. When the output of the divides dominates the
+    memory of a task and the full period does not fit in one time chunk, the
+    divides are split so their output is about the size of the input block.
+    If a task still does not fit at one variable and one source time chunk,
+    the divides are split further, and a warning is printed if even that is
+    over the budget.
+
+    Parameters
+    ----------
+    n_var : int
+        Number of variables.
+    n_time : int
+        Number of time steps.
+    n_cells : int
+        Number of grid cells read per time step (the pruned or bounding box extent).
+    n_divides : int
+        Number of divides aggregated.
+    mem_gb : float
+        Memory budget in GB for all concurrently running tasks.
+    src_ctime : int, optional
+        Time chunk size of the source data, so reads are not split across tasks. Default None.
+    itemsize : int, optional
+        Bytes per value of the source data. Default 4.
+    workers : int, optional
+        Number of tasks run at once. Default 1.
+    cid : int, optional
+        Largest divide chunk size wanted, -1 for no limit. Default -1.
+
+    Returns
+    -------
+    dict
+        {'cvar': int, 'ctime': int, 'cid': int}, cid -1 meaning all divides per chunk.
+    """
+    budget = mem_gb * 1e9 / max(workers, 1)
+    step = int(src_ctime) if src_ctime else 1
+    step = min(step, n_time)
+    n_div = n_divides if cid == -1 else max(1, min(int(cid), n_divides))
+    cvar, ctime = _fit(budget, step, n_var, n_time, n_cells, n_div, itemsize)
+    if ctime < n_time and n_div * 8 > n_cells * itemsize:
+        # The float64 output of the divides outweighs the input block
+        n_div = max(1, min(n_div, n_cells * itemsize // 8))
+        cvar, ctime = _fit(budget, step, n_var, n_time, n_cells, n_div, itemsize)
+    if block_bytes(cvar, ctime, n_cells, n_div, itemsize) > budget:
+        # One variable and one source time chunk is over the budget, only fewer divides are left
+        room = budget / (cvar * ctime) - n_cells * (2 * itemsize + 1)
+        if room >= 16:
+            # otherwise the input block alone is over the budget, and splitting the divides does not help
+            n_div = min(n_div, int(room // 16))
+    task = block_bytes(cvar, ctime, n_cells, n_div, itemsize)
+    plan = {"cvar": cvar, "ctime": ctime, "cid": -1 if n_div >= n_divides else int(n_div)}
+    print(
+        f"Chunk plan: cvar={plan['cvar']} of {n_var}, ctime={ctime} of {n_time}"
+        + (f" (source time chunk {step})" if src_ctime else "")
+        + f", cid={plan['cid']} of {n_divides} divides over {n_cells} cells, "
+        f"~{task / 1e9:.3f} GB per task x {workers} workers"
+    )
+    if task > budget:
+        print(
+            f"Warning: the smallest chunks, ~{task * max(workers, 1) / 1e9:.3g} GB for {workers} workers, exceed chunk_mem_gb={mem_gb}. "
+            "Lower the number of workers or raise the budget"
+        )
+    return plan
@@ -0,0 +1,103 @@
+"""cluster.py
+    Module for running the aggregation on a local dask.distributed cluster
+
+    By default the dask graphs of geo_proc run on a shared thread pool, so the
+    numpy/pandas work that holds the GIL does not scale with threads, and a
+    VPU scale run that exceeds the memory of the node fails rather than
+    spilling to disk. With a `cluster` section in the config, generate.py and
+    generate_hrrr.py start a LocalCluster of worker processes instead, each
+    with a memory limit past which it spills to a local directory. Sizes not
+    given in the config are taken from the SLURM allocation (see run.slurm),
+    or from the machine outside of SLURM.
+
+    Requires the optional dask.distributed package (plus bokeh for the dashboard).
+"""
+
+import os
+
+import dask
+
+
+def slurm_resources():
+    """
+    The CPUs and memory of the SLURM allocation on this node.
+
+    Returns
+    -------
+    tuple
+        (cpus, memory_bytes), either None when not running under SLURM or not given by the allocation.
+    """
+    env = os.environ
+    cpus = None
+    if "SLURM_CPUS_ON_NODE" in env:
+        cpus = int(env["SLURM_CPUS_ON_NODE"])
+    elif "SLURM_NTASKS" in env:
+        cpus = int(env["SLURM_NTASKS"]) * int(env.get("SLURM_CPUS_PER_TASK", 1))
+    memory = None
+    if env.get("SLURM_MEM_PER_NODE", "0") != "0":
+        memory = int(env["SLURM_MEM_PER_NODE"]) * 2**20
+    elif "SLURM_MEM_PER_CPU" in env and cpus is not None:
+        memory = int(env["SLURM_MEM_PER_CPU"]) * 2**20 * cpus
+    return cpus, memory
+
+
+def start_cluster(n_workers=None, threads_per_worker=2, memory_limit=None, spill_dir=None, dashboard=False, spill=0.7):
+    """
+    Start a LocalCluster of worker processes and make it the default dask scheduler.
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        Number of worker processes. Default None uses the CPUs of the SLURM allocation (or the
+        machine) divided by `threads_per_worker`.
+    threads_per_worker : int, optional
+        Threads per worker process. Default 2, as the aggregation is mostly GIL-bound.
+    memory_limit : str or int, optional
+        Memory limit of each worker, e.g. '16GB'. Default None splits 90% of the memory of the
+        SLURM allocation between the workers, or lets dask split the memory of the machine.
+    spill_dir : str or Path, optional
+        Local directory workers spill to beyond `spill` of their memory limit. Default None uses
+        dask's temporary directory.
+    dashboard : bool, optional
+        Serve the dask dashboard (requires bokeh). Default False.
+    spill : float, optional
+        Fraction of the memory limit at which a worker spills data to disk. Workers pause at
+        spill + 0.1 and are restarted at 0.95. Default 0.7.
+
+    Returns
+    -------
+    distributed.Client connected to the cluster. Close it when done.
+    """
+    try:
+        from distributed import Client, LocalCluster
+    except ImportError as e:
+        raise ImportError("The cluster option requires dask.distributed, e.g. pip install distributed") from e
+
+    cpus, memory = slurm_resources()
+    cpus = cpus or os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = max(cpus // threads_per_worker, 1)
+    if memory_limit is None:
+        memory_limit = int(0.9 * memory / n_workers) if memory is not None else "auto"
+    dask.config.set({
+        # the client replaces the shared thread pool, which cannot be passed on to the workers with the config
+        "pool": None,
+        "distributed.worker.memory.target": spill - 0.1,
+        "distributed.worker.memory.spill": spill,
+        "distributed.worker.memory.pause": min(spill + 0.1, 0.9),
+        "distributed.worker.memory.terminate": 0.95,
+    })
+    cluster = LocalCluster(
+        n_workers=n_workers,
+        threads_per_worker=threads_per_worker,
+        processes=True,
+        memory_limit=memory_limit,
+        local_directory=None if spill_dir is None else str(spill_dir),
+        dashboard_address=":8787" if dashboard else None,
+    )
+    client = Client(cluster)
+    limit = f"{memory_limit / 1e9:.1f} GB" if isinstance(memory_limit, (int, float)) else memory_limit
+    print(f"Started a dask cluster of {n_workers} workers x {threads_per_worker} threads, memory limit {limit} per worker")
+    if dashboard:
+        print(f"Dask dashboard: {client.dashboard_link}")
+    return client
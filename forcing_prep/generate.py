@@ -6,7 +6,8 @@ Entrypoint for resampling zarr based AORC to hy_features catchments.
     - Individual subcatchment forcing timeseries saved as f'{out_dir}/{year_str}/camels_{basin_id}_{year_str}/cat-{subcatchment_id}}.csv'
         where year_str = {year_begin}_to_{year_end}, e.g. '1979_to_2023'
     - Aggregated basin forcing timeseries saved as f'{out_dir}/{year_str}/camels_{basin_id}_{year_str}/{basin_id}_{year_str}_agg.csv'
-    - Basin AORC coverage weightings saved as f'{out_dir}/{year_str}/{basin_id}_{year_str}_coverage.parquet'
+    - Basin AORC coverage weightings saved in the shared weights store f'{out_dir}/weights/{key}.parquet', keyed on the grid and basin geometry
+    - Basin processing states (pending/running/done/failed, timing, retries) saved as f'{out_dir}/{year_str}/processing_queue.sqlite'
 
     Authors
     -------
@@ -30,18 +31,34 @@ import dask
 import dask.delayed
 import geopandas as gpd
 import numpy as np
-import s3fs
 import xarray as xr
 
-from geo_proc import process_geo_data
+from cluster import start_cluster
+from geo_proc import batch_basins, process_geo_data, process_geo_data_batch
+from global_weights import GlobalWeights
+from stores import ChunkCache, open_store, source_fs
+from subset import check_within, open_subset
+from locality import locality_order
+from sharding import basin_costs, parse_shard, shard_basins, shard_queue_path
+from task_queue import BasinQueue, run_queue
+from weights_store import WeightStore
+from writers import AggCsvWriter, DivideCsvWriter, NgenNetcdfWriter, ZarrWriter, last_written, stream_forcing
 
 dask.config.set(pool=ThreadPool(12))
 
 import dask.dataframe as ddf
 
-def to_ngen_netcdf(ds: xr.Dataset, out_dir: Path, uniq_name: str) -> None:
+def to_ngen_netcdf(ds: xr.Dataset, out_dir: Path, uniq_name: str, compress: bool = False) -> None:
         path = Path(f"{out_dir}/")
         Path.mkdir(path, exist_ok=True)
+        if compress:
+            # float32, compressed and chunked per catchment, without materializing Time per catchment in memory
+            writer = NgenNetcdfWriter(path / f"{uniq_name}.nc", compress=True)
+            try:
+                writer.write(ds)
+            finally:
+                writer.close()
+            return
         ds = ds.rename_dims( {'divide_id': 'catchment-id'} )
         ds = ds.rename({'divide_id':'ids', 'time':'Time'})
         ds = ds.rename_dims( {'Time': 'time'} )
@@ -53,7 +70,11 @@ def to_ngen_netcdf(ds: xr.Dataset, out_dir: Path, uniq_name: str) -> None:
         # TODO put in feature request for ngen to handle proper cf time units
         # ds['Time'].attrs['epoch_start'] = "01/01/1970 00:00:00"
         # ds['Time'].attrs['units'] = "seconds"
-        ds.to_netcdf(path / f"{uniq_name}.nc")
+        # An unlimited time dimension lets later years be appended in place, see writers.NgenNetcdfWriter.
+        # Chunk per catchment as ngen reads, netcdf's default for an unlimited dimension is one time step per chunk
+        chunks = (1, max(min(ds['time'].size, 8760), 1))
+        encoding = {name: {'chunksizes': chunks} for name in list(ds.data_vars) + ['Time']}
+        ds.to_netcdf(path / f"{uniq_name}.nc", unlimited_dims=['time'], encoding=encoding)
         # Not sure this is going to work quite as well
         # since ngen expects an id dimension in netcdf
         # it is much easier to "fake" forcing to ngen using csv...
@@ -61,39 +82,215 @@ def to_ngen_netcdf(ds: xr.Dataset, out_dir: Path, uniq_name: str) -> None:
         # ds.to_netcdf(path / f"{uniq_name}_agg.csv")
         return
 
-def generate_forcing(gdf: gpd.GeoDataFrame, kwargs: dict) -> None:
-    
-    year_str = kwargs.pop('year_str')
-    name = kwargs.pop('name')
-    out_dir = kwargs.get('out_dir', './')
-    nc_out = kwargs.pop('netcdf', True)
-    uniq_name = f'{name}_{year_str}'
-
-    df = process_geo_data(gdf, forcing, name, **kwargs)
+def write_forcing(df: xr.Dataset, out_dir: Path, uniq_name: str, nc_out: bool = True, compress: bool = False) -> None:
+    frame = df.to_dataframe()
     # save to netcdf is requested
     if nc_out:
-        to_ngen_netcdf(df, out_dir, uniq_name)
+        to_ngen_netcdf(df, out_dir, uniq_name, compress)
         path = out_dir
     else:
-        df = df.to_dataframe()
-            
-        cats = df.groupby("divide_id")
         path = Path(f"{out_dir}/camels_{uniq_name}")
-        Path.mkdir(path, exist_ok=True)
         # Write timeseries for each sub-catchment within CAMELS basin
-        for name, data in cats:
-            data = data.droplevel('divide_id')
-            data.to_csv(path / f"{name}_{uniq_name}.csv")
+        DivideCsvWriter(path, uniq_name).write(df)
     # Write aggregated basin timeseries (all subcatchments averaged together)
     # See comment at end of to_ngen_netcdf for why this is still done in csv for now
-    df = df.to_dataframe()
-    agg = df.groupby("time").mean()
+    agg = frame.groupby("time").mean()
     agg.to_csv(path / f"{uniq_name}_agg.csv")
 
+def forcing_writers(out_dir: Path, uniq_name: str, nc_out: bool = True, stream_format: str = 'netcdf', mode: str = 'w', compress: bool = False) -> list:
+    """The streaming equivalents of the outputs of write_forcing, see writers.py"""
+    if nc_out:
+        path = Path(out_dir)
+        if stream_format == 'zarr':
+            store = ZarrWriter(path / f"{uniq_name}.zarr", mode=mode)
+        else:
+            store = NgenNetcdfWriter(path / f"{uniq_name}.nc", mode=mode, compress=compress)
+    else:
+        path = Path(f"{out_dir}/camels_{uniq_name}")
+        store = DivideCsvWriter(path, uniq_name, mode=mode)
+    Path.mkdir(path, exist_ok=True, parents=True)
+    return [store, AggCsvWriter(path / f"{uniq_name}_agg.csv", mode=mode)]
+
+def prior_runs(out_root: Path, years: tuple) -> list:
+    """The (directory, year_str) of earlier runs with the same first year that end before years[1], latest first"""
+    runs = []
+    for path in Path(out_root).glob(f"{years[0]}_to_*"):
+        end = path.name.split('_to_')[-1]
+        if path.is_dir() and end.isdigit() and int(end) < years[1]:
+            runs.append((path, path.name))
+    return sorted(runs, key=lambda run: int(run[1].split('_to_')[-1]), reverse=True)
+
+def adopt_outputs(prior: list, out_dir: Path, name: str, year_str: str) -> None:
+    """Move the outputs of basin `name` from the latest prior run that has them into out_dir, renamed for year_str"""
+    uniq_name = f'{name}_{year_str}'
+    for prior_dir, prior_str in prior:
+        old_name = f'{name}_{prior_str}'
+        moved = False
+        for suffix in ['.nc', '.zarr', '_agg.csv']:
+            src, dst = prior_dir / f'{old_name}{suffix}', out_dir / f'{uniq_name}{suffix}'
+            if src.exists() and not dst.exists():
+                src.rename(dst)
+                moved = True
+        src, dst = prior_dir / f'camels_{old_name}', out_dir / f'camels_{uniq_name}'
+        if src.exists() and not dst.exists():
+            src.rename(dst)
+            moved = True
+        if dst.exists():
+            # also finishes renames interrupted by a crash
+            for file in dst.glob(f'*_{prior_str}*.csv'):
+                file.rename(dst / file.name.replace(f'_{prior_str}', f'_{year_str}'))
+        if moved:
+            print(f"Extending the outputs of basin {name} from {prior_dir}")
+            return
+
+def missing_forcing(end) -> xr.Dataset:
+    """The forcing after `end`, the last time step already written, or the full period if end is None"""
+    data = forcing
+    times = forcing['time'].values
+    if end is None or np.datetime64(end) + (times[1] - times[0]) < times[0]:
+        # Earlier years are missing too
+        data = full_forcing()
+    if end is not None:
+        data = data.isel(time=data['time'].values > np.datetime64(end))
+    return data
+
+def generate_forcing(gdf: gpd.GeoDataFrame, kwargs: dict) -> None:
+    
+    kwargs = dict(kwargs)
+    year_str = kwargs.pop('year_str')
+    name = kwargs.pop('name')
+    out_dir = kwargs.get('out_dir', './')
+    nc_out = kwargs.pop('netcdf', True)
+    compress = kwargs.pop('netcdf_compress', False)
+    stream = kwargs.pop('stream', False)
+    stream_format = kwargs.pop('stream_format', 'netcdf')
+    extend = kwargs.pop('extend', False)
+    prior = kwargs.pop('prior_runs', [])
+    store = kwargs.pop('forcing_store', None)
+    uniq_name = f'{name}_{year_str}'
+    if store is not None:
+        # A subset store only covers its bounding box, the coverage of a basin sticking out would be cut silently
+        check_within(gdf, forcing, kwargs['y_lat_dim'], kwargs['x_lon_dim'], store)
+
+    if extend:
+        # Only aggregate the hours missing from this basin's outputs, and append them in place
+        adopt_outputs(prior, out_dir, name, year_str)
+        writers = forcing_writers(out_dir, uniq_name, nc_out, stream_format, mode='a', compress=compress)
+        data = missing_forcing(last_written(writers))
+        if data['time'].size == 0:
+            print(f"Basin {name} is up to date")
+            return
+        df = process_geo_data(gdf, data, name, compute=False, **kwargs)
+        stream_forcing({name: df}, {name: writers})
+        return
+    if stream:
+        # Write each time block as soon as it is computed rather than holding the full period in memory
+        df = process_geo_data(gdf, forcing, name, compute=False, **kwargs)
+        writers = {name: forcing_writers(out_dir, uniq_name, nc_out, stream_format, compress=compress)}
+        stream_forcing({name: df}, writers)
+        return
+    df = process_geo_data(gdf, forcing, name, **kwargs)
+    write_forcing(df, out_dir, uniq_name, nc_out, compress)
+
+def generate_forcing_batch(gdfs: dict, kwargs: dict) -> None:
+    """Process a batch of basins in one pass over the forcing, see geo_proc.process_geo_data_batch"""
+    kwargs = dict(kwargs)
+    year_str = kwargs.pop('year_str')
+    kwargs.pop('name', None)
+    out_dir = kwargs.get('out_dir', './')
+    nc_out = kwargs.pop('netcdf', True)
+    compress = kwargs.pop('netcdf_compress', False)
+    kwargs.pop('stream', False)
+    stream_format = kwargs.pop('stream_format', 'netcdf')
+    extend = kwargs.pop('extend', False)
+    prior = kwargs.pop('prior_runs', [])
+    store = kwargs.pop('forcing_store', None)
+    if store is not None:
+        for gdf in gdfs.values():
+            check_within(gdf, forcing, kwargs['y_lat_dim'], kwargs['x_lon_dim'], store)
+
+    if extend:
+        for name in gdfs:
+            adopt_outputs(prior, out_dir, name, year_str)
+        writers = {name: forcing_writers(out_dir, f'{name}_{year_str}', nc_out, stream_format, mode='a', compress=compress) for name in gdfs}
+        # Writers skip the hours each output already has
+        ends = [last_written(w) for w in writers.values()]
+        data = missing_forcing(None if any(end is None for end in ends) else min(ends))
+        if data['time'].size == 0:
+            print(f"Basins {', '.join(gdfs)} are up to date")
+            return
+        results = process_geo_data_batch(gdfs, data, compute=False, **kwargs)
+        stream_forcing(results, writers)
+        return
+    # Always streamed, whatever `stream` is: batch_basins bounds the memory of one time block, while
+    # computing the full period of every basin of the batch before writing would not be bounded
+    results = process_geo_data_batch(gdfs, forcing, compute=False, **kwargs)
+    writers = {name: forcing_writers(out_dir, f'{name}_{year_str}', nc_out, stream_format, compress=compress) for name in results}
+    stream_forcing(results, writers)
+
+def open_forcing(aorc_source: str, aorc_year_url: str, years: tuple, cache: ChunkCache = None, store: str = None) -> xr.Dataset:
+    """
+    Lazily open the AORC zarr stores (s3 or a local directory) of the years in range(*years) as one dataset,
+    or those years of a local subset store from subset.py
+    """
+    if store is not None:
+        return open_subset(store).sel(time=slice(str(years[0]), str(years[1] - 1)))
+    fs = source_fs(aorc_source)
+    files = [
+        open_store(aorc_year_url.format(source=aorc_source, year=year), fs=fs, cache=cache)
+        for year in range(*years)
+    ]
+    return xr.open_mfdataset(files, engine="zarr", parallel=True, consolidated=True)
+
+# How to open the forcing of the full year range, and the dataset once opened.
+# When extending a prior run `forcing` only covers the missing years.
+_full_forcing = {}
+
+def full_forcing() -> xr.Dataset:
+    """The forcing over the full year range, opened on first use"""
+    if 'data' not in _full_forcing:
+        _full_forcing['data'] = open_forcing(*_full_forcing['args'])
+    return _full_forcing['data']
+
+def _init_worker(aorc_source: str, aorc_year_url: str, years: tuple, open_years: tuple, cache: ChunkCache = None, store: str = None) -> None:
+    """Open the forcing once in each basin worker process"""
+    global forcing, chunk_cache
+    chunk_cache = cache
+    forcing = open_forcing(aorc_source, aorc_year_url, open_years, cache, store)
+    _full_forcing['args'] = (aorc_source, aorc_year_url, years, cache, store)
+    if open_years == years:
+        _full_forcing['data'] = forcing
+
+def list_basins(basins: list, basin_url: str) -> list:
+    """The basin ids of the config, listing the hydrofabric s3 bucket path when they include 'all'"""
+    if 'all' not in basins:
+        return basins
+    # Expected format: 's3://lynker-spatial/hydrofabric/v20.1/camels/Gage_{basin_id}.gpkg'
+    # base_path = 's3://lynker-spatial/hydrofabric/v20.1/camels/'
+    base_path = str(Path(basin_url).parent)
+    if 's3://' not in base_path:
+        base_path = str(base_path).replace('s3:/','s3://')
+    return np.unique([Path(x).stem.split('_')[1] for x in source_fs(base_path).ls(base_path) if '/Gage_' in x])
+
+def run_basin(b: str, basin_url: str, config: dict) -> tuple:
+    """
+    Read the geopackage of basin `b` from s3 and generate its forcing. Returns the chunk cache
+    counts taken in this process (see ChunkCache.take_counts), or None without a cache
+    """
+    url = basin_url.format(basin_id=b)
+    gdf = gpd.read_file(
+        source_fs(url).open(url), driver="gpkg", layer="divides"
+    )
+    gdf = gdf.to_crs(forcing[next(iter(forcing.keys()))].crs)
+    config = dict(config, name=b)
+    generate_forcing(gdf, config)
+    return chunk_cache.take_counts() if chunk_cache is not None else None
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Process the YAML config file.')
     parser.add_argument('config_path', type=str, help='Path to the YAML configuration file')
+    parser.add_argument('--shard', type=str, default=None, help='Only process shard i of N of the basins, given as i/N (e.g. ${SLURM_ARRAY_TASK_ID}/10), see sharding.py')
     args = parser.parse_args()
     
     # Load the YAML configuration file
@@ -115,80 +312,138 @@ if __name__ == "__main__":
     x_lon_dim = config['x_lon_dim']
     y_lat_dim = config['y_lat_dim']
     out_dir = Path(config['out_dir'].format(home_dir=str(Path.home())))
+    # Grid weights are shared by every year range and run, so keep them outside of year_str
+    _weights_dir = config.pop('weights_dir', None)
+    weights_dir = Path(_weights_dir.format(home_dir=str(Path.home()))) if _weights_dir is not None else out_dir / 'weights'
+    config['weight_store'] = WeightStore(weights_dir, max_gb=config.pop('weights_cache_gb', None))
+    # Look the weights up in the prebuilt weights of every divide on the AORC grid, see global_weights.py
+    _global_weights = config.pop('global_weights', None)
+    config['global_weights'] = GlobalWeights(_global_weights.format(home_dir=str(Path.home()))) if _global_weights is not None else None
+    # Process several basins per pass over the forcing, bounded by a memory budget per time block
+    batch_mem_gb = config.pop('batch_mem_gb', None)
+    # Number of basins processed concurrently, each in its own process, and retries of a failed basin
+    workers = config.pop('workers', 1)
+    max_retries = config.pop('max_retries', 2)
+    # Append only the missing hours to the outputs of an earlier run rather than reprocessing every year
+    extend = config.get('extend', False)
+    # Keep the AORC chunks read on local disk, so reruns do not download them again
+    _chunk_cache_dir = config.pop('chunk_cache_dir', None)
+    chunk_cache_gb = config.pop('chunk_cache_gb', None)
+    # Read the forcing from a local time-major subset store made with subset.py rather than from aorc_source
+    _forcing_store = config.pop('forcing_store', None)
+    forcing_store = _forcing_store.format(home_dir=str(Path.home())) if _forcing_store is not None else None
+    config['forcing_store'] = forcing_store
+    # Order the basins by the source chunks they read rather than by id
+    basin_order = config.pop('basin_order', 'id')
+    # Aggregate on a local dask.distributed cluster of worker processes that spill to disk
+    cluster = config.pop('cluster', None)
+    chunk_cache = None
+    if _chunk_cache_dir is not None:
+        chunk_cache = ChunkCache(_chunk_cache_dir.format(home_dir=str(Path.home())), max_gb=chunk_cache_gb)
 
-    # Setup the s3fs filesystem that is going to be used by xarray to open the zarr files
-    _s3 = s3fs.S3FileSystem(anon=True)
     if gpkg is None:
-        # List all the basins inside the hydrofabric s3 bucket path
-        if 'all' in basins:
-            # Expected format: 's3://lynker-spatial/hydrofabric/v20.1/camels/Gage_{basin_id}.gpkg'
-            # base_path = 's3://lynker-spatial/hydrofabric/v20.1/camels/'
-            base_path = str(Path(_basin_url).parent)
-            if 's3://' not in base_path:
-                base_path = str(base_path).replace('s3:/','s3://')
-            basins = np.unique([Path(x).stem.split('_')[1] for x in  _s3.ls(base_path) if '/Gage_' in x])
+        basins = list_basins(basins, _basin_url)
+        if args.shard is not None:
+            # Only this shard's basins, balanced between shards by their divides and extent
+            shard = parse_shard(args.shard)
+            basins = shard_basins(basins, _basin_url, out_dir / 'basin_costs.csv', *shard)
+    elif args.shard is not None:
+        raise ValueError("--shard splits the basins of basin_url_template and is not used with gpkg")
 
     # Create a year-range output directory: 
     year_str = '_to_'.join([str(x) for x in years])
+    out_root = out_dir
     out_dir = Path(out_dir/f'{year_str}')
     config['out_dir'] = out_dir
     config['year_str'] = year_str
-    # TODO add search for existing years and only fill in those which are missing
+
+    open_years = years
+    if extend:
+        # Outputs of e.g. 1980_to_2024 are moved to 1980_to_2025 and appended to, so only 2024 is read
+        config['prior_runs'] = prior_runs(out_root, years)
+        if config['prior_runs']:
+            prior_dir, prior_str = config['prior_runs'][0]
+            open_years = (int(prior_str.split('_to_')[-1]), years[1])
+            print(f"Extending {prior_dir}, reading AORC years {open_years[0]} to {open_years[1] - 1}")
 
     # Create output directory in case it does not exist
     if not Path.exists(out_dir):
         print("Creating the following path for writing output: " + str(out_dir))
         Path.mkdir(out_dir, exist_ok = True, parents = True)
 
-    files = [
-        s3fs.S3Map(
-            root=_aorc_year_url.format(source=_aorc_source, year=year),
-            s3=_s3,
-            check=False,
-        )
-        for year in range(*years) 
-    ] 
+    client = None
+    if cluster is not None and workers > 1:
+        print("The cluster option is not used with workers > 1, each basin process uses its own thread pool")
+    elif cluster is not None:
+        if cluster.get('spill_dir') is not None:
+            cluster['spill_dir'] = cluster['spill_dir'].format(home_dir=str(Path.home()))
+        client = start_cluster(**cluster)
 
-    forcing = xr.open_mfdataset(files, engine="zarr", parallel=True, consolidated=True)
+    forcing = open_forcing(_aorc_source, _aorc_year_url, open_years, chunk_cache, forcing_store)
+    _full_forcing['args'] = (_aorc_source, _aorc_year_url, years, chunk_cache, forcing_store)
+    if open_years == years:
+        _full_forcing['data'] = forcing
 
     proj = forcing[next(iter(forcing.keys()))].crs
     print(proj)
-    
-    # Ensure the processing log file exists
-    log_file = Path(out_dir) / "processing_log.txt"
-    if not log_file.exists():
-        log_file.touch()
 
     if gpkg is not None:
         gdf = gpd.read_file(gpkg, driver="gpkg", layer="divides").to_crs(proj)
         config['name'] = gpkg.stem
         generate_forcing(gdf, config)
     else:
-        for b in basins:
-            
-            # Read the processing log file
-            with open(log_file, 'r') as file:
-                processed_basins = file.read().splitlines()
-            
-            if b in [line.split(':')[0] for line in processed_basins]:
-                print(f"Basin {b} already processed. Skipping.")
-                continue
-
-            # Add basin to the log file with status 'processing'
-            with open(log_file, 'a') as file:
-                file.write(f"{b}: processing\n")
-
-            # This is a bug, this line should be unneccessary, but this is the simple fix I could fine.
-            config['year_str'] = year_str
-
-            # read the geopackage from s3
-            gdf = gpd.read_file(
-                _s3.open(_basin_url.format(basin_id=b)), driver="gpkg", layer="divides"
-            ).to_crs(proj)
-            config['name'] = b
-            generate_forcing(gdf, config)
-            
-            # Update the log file with status 'finished'
-            with open(log_file, 'a') as file:
-                file.write(f"{b}: finished\n")
+        # Basin states (pending/running/done/failed) persist here, so a restart resumes
+        # interrupted and failed basins and skips finished ones
+        queue_path = out_dir / "processing_queue.sqlite" if args.shard is None else shard_queue_path(out_dir, *shard)
+        queue = BasinQueue(queue_path, max_retries=max_retries)
+        # A shard only takes its own basins from the log, the others are finished in their shards
+        queue.import_log(out_dir / "processing_log.txt", basins if args.shard is not None else None)
+        if basin_order != 'id':
+            # Consecutive basins read the same source chunks, so cached chunks are reused.
+            # Only sets the order of basins new to the queue.
+            bounds = basin_costs(basins, _basin_url, out_root / 'basin_costs.csv')
+            basins = locality_order(basins, bounds, forcing, y_lat_dim, x_lon_dim, basin_order)
+        queue.add(basins)
+        queue.recover()
+
+        if batch_mem_gb is not None:
+            def read_basins():
+                while (b := queue.claim()) is not None:
+                    # read the geopackage from s3
+                    try:
+                        url = _basin_url.format(basin_id=b)
+                        gdf = gpd.read_file(
+                            source_fs(url).open(url), driver="gpkg", layer="divides"
+                        ).to_crs(proj)
+                    except Exception as e:
+                        queue.fail(b, repr(e))
+                        continue
+                    yield b, gdf
 
+            # Each batch streams its union of AORC chunks from s3 once for all of its basins
+            for batch in batch_basins(read_basins(), forcing, y_lat_dim, x_lon_dim, batch_mem_gb, ctime_max):
+                try:
+                    generate_forcing_batch(batch, config)
+                except Exception as e:
+                    for b in batch:
+                        queue.fail(b, repr(e))
+                else:
+                    for b in batch:
+                        queue.done(b)
+        else:
+            # A single worker runs in this process with the forcing opened above
+            run_queue(
+                queue, run_basin, args=(_basin_url, config), workers=workers,
+                initializer=_init_worker if workers > 1 else None,
+                initargs=(_aorc_source, _aorc_year_url, years, open_years, chunk_cache, forcing_store),
+                collect=chunk_cache.add_counts if chunk_cache is not None else None,
+            )
+        queue.summary()
+        queue.close()
+    if chunk_cache is not None:
+        # The chunks are read by the cluster workers or the basin processes, which counted them in their own process
+        if client is not None:
+            chunk_cache.take_worker_counts(client)
+        chunk_cache.summary()
+    if client is not None:
+        client.shutdown()
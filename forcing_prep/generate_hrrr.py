@@ -7,7 +7,10 @@ Process HRRR forcings into timeseries for CAMELS basins & subcatchments.
     - Individual subcatchment forcing timeseries saved as f'{out_dir}/{year_str}/camels_{basin_id}_{year_str}/cat-{subcatchment_id}}.csv'
         where year_str = {year_begin}_to_{year_end}, e.g. '1979_to_2023'
     - Aggregated basin forcing timeseries saved as f'{out_dir}/{year_str}/camels_{basin_id}_{year_str}/{basin_id}_{year_str}_agg.csv'
-    - Basin AORC coverage weightings saved as f'{out_dir}/{year_str}/{basin_id}_{year_str}_coverage.parquet'
+    - Basin HRRR coverage weightings saved in the shared weights store f'{out_dir}/weights/{key}.parquet', keyed on the grid and basin geometry
+    - With window_days set, days are processed in windows and each basin's timeseries are appended over all windows instead:
+        f'{out_dir}/camels_{basin_id}/{subcatchment_id}.csv' and the basin aggregate f'{out_dir}/camels_{basin_id}_agg.csv'
+    - Variable hours that could not be opened, kept as NaN in the timeseries, with the reason in f'{out_dir}/hrrr_gaps.csv'
 
     Record of missing forecast data through 2020 here: 
     https://mesowest.utah.edu/html/hrrr/zarr_documentation/html/fcst_downtime.html
@@ -53,12 +56,19 @@ from dask.diagnostics import ProgressBar
 import warnings
 
 # The custom functions
-from hrrr_proc import prep_date_time_range, _map_open_files_hrrrzarr, _gen_hrrr_zarr_urls
-from geo_proc import process_geo_data
+from hrrr_manifest import HrrrManifest
+from hrrr_metadata import HrrrMetadataIndex
+from hrrr_proc import prep_date_time_range, _map_open_files_hrrrzarr, _gen_hrrr_zarr_urls, hrrr_projection, fill_dropped, gap_mask
+from geo_proc import batch_basins, process_geo_data, process_geo_data_batch
+from global_weights import GlobalWeights
+from weights_store import WeightStore
+from writers import AggCsvWriter, DivideCsvWriter, last_written, stream_forcing
+from stores import ChunkCache, source_fs
+from basin_registry import BasinRegistry
+from cluster import start_cluster
 
 dask.config.set(pool=ThreadPool(12))
 from functools import partial
-from cartopy import crs as ccrs
 
 def _preprocess_sel_time(xda, apcp_fcst):
     # This helps select the forecast hour of interest, rather than grab all forecasted hours
@@ -66,6 +76,129 @@ def _preprocess_sel_time(xda, apcp_fcst):
     xda = xda.isel(time=apcp_fcst)
     return xda
 
+def open_day(date, level_vars_anl, level_vars_fcst, fcst_hr, bucket_subf, drop_vars, manifest = None, cache = None, hour_workers = 8, hour_retries = 3, hour_backoff = 2.0, index = None):
+    '''
+    Lazily open the analysis and forecast HRRR data of a day as one dataset, or None if the day has no data
+
+    Hours that could not be opened are NaN, and listed with the reason in the dataset's
+    attrs['hrrr_gaps'] (see hrrr_proc.gap_mask). With an index (hrrr_metadata.HrrrMetadataIndex)
+    the stores are opened from their indexed metadata
+    '''
+    actual_fcst_dt_hr = fcst_hr + 1 # for accumulated precip, the actual forecast timestamp is accumulated precip at the end of an hour, so add 1 hour. E.g. if nowcast is desired, apcp_fcst_hr = 0, but we need to add 1 hour to represent the accumulated precip that actually happened.
+    # Define the partial function used for processing time in forecast data:
+    partial_func = partial(_preprocess_sel_time, apcp_fcst = fcst_hr)
+    try:
+        urls_fcst, urls_anl =  _gen_hrrr_zarr_urls(date=date, level_vars_anl=level_vars_anl, level_vars_fcst=level_vars_fcst,fcst_hr=fcst_hr, bucket_subf = bucket_subf, manifest = manifest)
+    except:
+        raise ValueError(f'Could not list bucket for {date} inside {bucket_subf}.\nConsider sf.ls() in lieu of explicit build.')
+
+    skip_fcst = skip_anl = False
+    if len(urls_fcst) == 0 == len(urls_anl) == 0:
+        print(f'No data exist for {date}') 
+        return None
+    elif len(urls_fcst) == 0:
+        print(f'No forecasted precip data available on {date}')
+        skip_fcst = True
+    elif len(urls_anl) == 0:
+        print(f'No analysis data available on {date}')
+        skip_anl = True
+    elif len(urls_fcst[0]) == 0:
+        raise Warning(f'No forecast urls exist for {date}') # e.g. '20180711'
+
+    # Now run a data pull. Hours failing within a day are opened one by one, concurrently and with retries (e.g. 20190506)
+    open_kwargs = dict(fs = source_fs(bucket_subf), cache = cache, workers = hour_workers, retries = hour_retries, backoff = hour_backoff, index = index)
+    try:
+        if not skip_anl:
+            dat_anl = _map_open_files_hrrrzarr(urls_ls = urls_anl, concat_dim = ['time',None], **open_kwargs)
+        else: 
+            dat_anl = xr.Dataset()
+        if not skip_fcst:
+            dat_fcst = _map_open_files_hrrrzarr(urls_ls = urls_fcst, concat_dim = ['time',None], preprocess = partial_func,fcst_hr=actual_fcst_dt_hr, **open_kwargs)
+        else:
+            dat_fcst = xr.Dataset()
+    except Exception as e:
+        raise ValueError(f'Could not open the hrrrzarr stores of {date}') from e
+
+    gaps = {**dat_anl.attrs.get('hrrr_gaps', {}), **dat_fcst.attrs.get('hrrr_gaps', {})}
+    dat = dat_anl.merge(dat_fcst)
+    if len(dat.data_vars) == 0:
+        print(f'No hour could be opened on {date}')
+        return None
+    dat.attrs['hrrr_gaps'] = gaps
+    # e.g. the forecast when none of its hours opened, on the grid of the analysis
+    dat = fill_dropped(dat)
+    return dat.drop_vars([x for x in dat.data_vars.keys() if x in drop_vars])
+
+def concat_days(days):
+    '''
+    Concatenate the datasets of several days along time.
+
+    Variables missing on some days (e.g. no forecasts) are filled with NaN there, so the
+    appended basin outputs keep the same columns throughout.
+    '''
+    names = list(dict.fromkeys(name for day in days for name in day.data_vars))
+    filled = []
+    for day in days:
+        for name in names:
+            if name not in day.data_vars:
+                ref = next(d[name] for d in days if name in d.data_vars)
+                gap = xr.full_like(ref.isel(time=0, drop=True), np.nan).expand_dims(time=day['time'].values)
+                day = day.assign({name: gap.transpose(*ref.dims)})
+        filled.append(day)
+    forcing = xr.concat(filled, dim='time', coords='minimal', compat='override')
+    # Keep a time step opened on two days once
+    _, first = np.unique(forcing['time'].values, return_index=True)
+    forcing = forcing.isel(time=first)
+    gaps = {}
+    for day in days:
+        for name, dropped in day.attrs.get('hrrr_gaps', {}).items():
+            gaps.setdefault(name, {}).update(dropped)
+    forcing.attrs['hrrr_gaps'] = gaps
+    return forcing
+
+def log_gaps(dat, path):
+    '''
+    Append the hours dropped from dat (see open_day) to the csv at path, with the reason
+    '''
+    rows = [(name, t, reason) for name, dropped in dat.attrs.get('hrrr_gaps', {}).items() for t, reason in dropped.items()]
+    if len(rows) == 0:
+        return
+    nan_hours = gap_mask(dat).sum('time')
+    counts = ', '.join(f'{name}: {int(n)}' for name, n in zip(nan_hours['variable'].values, nan_hours.values) if n > 0)
+    print(f'{len(rows)} variable hours could not be opened and are NaN ({counts}), see {path}')
+    gaps = pd.DataFrame(rows, columns=['variable', 'time', 'reason'])
+    gaps.to_csv(path, mode='a', header=not Path(path).exists(), index=False)
+
+def read_basin(b, basin_url, proj, dir_custom_gpkg = None, epsg = None):
+    '''
+    Read the divides of basin b, from basin_url or the geopackages in dir_custom_gpkg, in the projection proj
+    '''
+    if not dir_custom_gpkg: # read the geopackage from s3
+        url = basin_url.format(b)
+        print(f"Reading geopackage data from s3: {url}")
+        return gpd.read_file(
+            source_fs(url).open(url), driver="gpkg", layer="divides").to_crs(proj)
+    # read the geopackage locally
+    all_files = list(dir_custom_gpkg.glob('*.gpkg'))
+    
+    gpkg_file = [f for f in all_files if str(b) in f.stem]
+    print(f"Reading geopackage data locally from: {gpkg_file}")
+    gdf_raw =gpd.read_file(gpkg_file[0],engine='pyogrio')
+    if epsg:
+        gdf_raw = gdf_raw.set_crs(epsg=epsg,allow_override=True)
+    else:
+        warnings.warn("EPSG NOT SPECIFIED FOR INPUT DATA!!!")
+    # Convert to the grid's native projection of LambertConformal:
+    # https://mesowest.utah.edu/html/hrrr/zarr_documentation/html/ex_python_plot_zarr.html#:~:text=Plotting%20HRRR%20Zarr%20data%20for%20a%20single%20gridpoint.%20This%20python
+    return gdf_raw.to_crs(proj)
+
+def basin_writers(out_dir, b):
+    '''
+    Writers appending to the time series of basin b over every window: f'{out_dir}/camels_{b}/{divide_id}.csv'
+    and f'{out_dir}/camels_{b}_agg.csv'. Time steps already written are skipped.
+    '''
+    return [DivideCsvWriter(Path(out_dir) / f'camels_{b}', None, mode='a'), AggCsvWriter(Path(out_dir) / f'camels_{b}_agg.csv', mode='a')]
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Process the YAML config file.')
@@ -88,6 +221,20 @@ if __name__ == "__main__":
     dir_custom_gpkg = Path(config.get('dir_custom_gpkg', '').format(home_dir=home_dir)) if config.get('dir_custom_gpkg', None) is not None else None
     epsg = config.get('epsg',None)
     id_col = config.get('id_col', 'divide_id') # Default to 'divide_id' in the case of hydrofabric
+    # The HRRR grid is the same every day, so weights are computed once per basin and reused from the shared store
+    weights_dir = Path(config['weights_dir'].format(home_dir=home_dir)) if config.get('weights_dir', None) is not None else out_dir / 'weights'
+    weight_store = WeightStore(weights_dir, max_gb=config.get('weights_cache_gb', None))
+    # Optionally look the weights up in the prebuilt weights of every divide on the HRRR grid, see global_weights.py
+    global_weights = GlobalWeights(config['global_weights'].format(home_dir=home_dir)) if config.get('global_weights', None) is not None else None
+    # Optionally keep the hrrrzarr chunks read on local disk, so reruns do not download them again
+    chunk_cache = ChunkCache(config['chunk_cache_dir'].format(home_dir=home_dir), max_gb=config.get('chunk_cache_gb', None)) if config.get('chunk_cache_dir', None) is not None else None
+    # Optionally open the hrrrzarr stores from their metadata crawled into a local index, see hrrr_metadata.py
+    metadata_index = HrrrMetadataIndex(config['hrrr_metadata_index'].format(home_dir=home_dir)) if config.get('hrrr_metadata_index', None) is not None else None
+    # Optionally aggregate on a local dask.distributed cluster of worker processes that spill to disk
+    cluster = dict(config['cluster']) if config.get('cluster', None) is not None else None
+    if cluster is not None and cluster.get('spill_dir', None) is not None:
+        cluster['spill_dir'] = cluster['spill_dir'].format(home_dir=home_dir)
+    client = start_cluster(**cluster) if cluster is not None else None
 
 
     time_bgn = config['time_bgn']# '2018-07-13'
@@ -100,9 +247,6 @@ if __name__ == "__main__":
     apcp_fcst_hr = config['fcst_hr'] # when the 'nowcast' is desired, this should be 0
     _drop_vars = config['drop_vars']
     
-    
-
-    actual_fcst_dt_hr = apcp_fcst_hr + 1 # for accumulated precip, the actual forecast timestamp is accumulated precip at the end of an hour, so add 1 hour. E.g. if nowcast is desired, apcp_fcst_hr = 0, but we need to add 1 hour to represent the accumulated precip that actually happened.
     ####
     fs = s3fs.S3FileSystem(anon=True)
     # List all the basins inside the hydrofabric s3 bucket path
@@ -117,96 +261,74 @@ if __name__ == "__main__":
 
     Path.mkdir(Path(out_dir), exist_ok = True)
 
-    # Define the partial function used for processing time in forecast data:
-    partial_func = partial(_preprocess_sel_time, apcp_fcst = apcp_fcst_hr)
-
     all_dates, all_hours = prep_date_time_range(time_bgn, time_end)
+    # List the hourly stores of every day once, concurrently, and keep them for reruns. The forecasts also need the day before
+    manifest_path = Path(config['hrrr_manifest'].format(home_dir=home_dir)) if config.get('hrrr_manifest', None) is not None else out_dir / 'hrrr_manifest.json'
+    manifest = HrrrManifest(manifest_path, _bucket_subf)
+    day_before = (pd.to_datetime(all_dates[0], format='%Y%m%d') - pd.Timedelta(1, unit='D')).strftime('%Y%m%d')
+    manifest.prefetch([day_before] + all_dates)
     
     # HRRR grid uses the Lambert Conformal projection:
-    proj = ccrs.LambertConformal(central_longitude=262.5, 
-                                    central_latitude=38.5, 
-                                    standard_parallels=(38.5, 38.5),
-                                        globe=ccrs.Globe(semimajor_axis=6371229,
-                                                        semiminor_axis=6371229))
-    for date in all_dates:
-        print(f'Processing {date}')
-        try:
-            urls_fcst, urls_anl =  _gen_hrrr_zarr_urls(date=date, level_vars_anl=_level_vars_anl, level_vars_fcst=_level_vars_fcst,fcst_hr=apcp_fcst_hr, bucket_subf = _bucket_subf)
-        except:
-            raise ValueError(f'Could not list bucket for {date} inside {_bucket_subf}.\nConsider sf.ls() in lieu of explicit build.')
-
-        skip_fcst = skip_anl = False
-        if len(urls_fcst) == 0 == len(urls_anl) == 0:
-            print(f'No data exist for {date}') 
-            continue
-        elif len(urls_fcst) == 0:
-            print(f'No forecasted precip data available on {date}')
-            skip_fcst = True
-        elif len(urls_anl) == 0:
-            print(f'No analysis data available on {date}')
-            skip_anl = True
-        elif len(urls_fcst[0]) == 0:
-            raise Warning(f'No forecast urls exist for {date}') # e.g. '20180711'
-
-        # Now run a data pull
-        try:
-            if not skip_anl:
-                dat_anl = _map_open_files_hrrrzarr(urls_ls = urls_anl, concat_dim = ['time',None])
-            else: 
-                dat_anl = xr.Dataset()
-            if not skip_fcst:
-                dat_fcst = _map_open_files_hrrrzarr(urls_ls = urls_fcst, concat_dim = ['time',None], preprocess = partial_func,fcst_hr=actual_fcst_dt_hr)
-            else:
-                dat_fcst = xr.Dataset()
-        except: # Example: 20190506
-            print(f'Initial hrrrzarr file opening unsuccessful on {date}. Waiting 30s and reattempting:') 
-            import time
-            time.sleep(30) # wait 30 seconds and try again
-            try:
-                if not skip_anl:
-                    dat_anl = _map_open_files_hrrrzarr(urls_ls = urls_anl, concat_dim = ['time',None])
-                else: 
-                    dat_anl = xr.Dataset()
-                if not skip_fcst:
-                    dat_fcst = _map_open_files_hrrrzarr(urls_ls = urls_fcst, concat_dim = ['time',None], preprocess = partial_func,fcst_hr=actual_fcst_dt_hr)
-                else:
-                    dat_fcst = xr.Dataset()
-            except:
-                raise ValueError(f'TODO figure out what to do for {date}') 
-
-        dat_anl = dat_anl.drop_vars([x for x in dat_anl.data_vars.keys() if x in _drop_vars])
-        dat_fcst = dat_fcst.drop_vars([x for x in dat_fcst.data_vars.keys() if x in _drop_vars])
-        forcing = dat_anl.merge(dat_fcst)   
-        
-        for b in basins:
-            print(f'Processing basin {b}')
-            if not dir_custom_gpkg: # read the geopackage from s3
-                print(f"Reading geopackage data from s3: {_basin_url}")
-                gdf = gpd.read_file(
-                    fs.open(_basin_url.format(b)), driver="gpkg", layer="divides").to_crs(proj)
-            else: # read the geopackage locally
-                all_files = list(dir_custom_gpkg.glob('*.gpkg'))
-                
-                gpkg_file = [f for f in all_files if str(b) in f.stem]
-                print(f"Reading geopackage data locally from: {gpkg_file}")
-                gdf_raw =gpd.read_file(gpkg_file[0],engine='pyogrio')
-                if epsg:
-                    gdf_raw = gdf_raw.set_crs(epsg=epsg,allow_override=True)
-                else:
-                    warnings.warn("EPSG NOT SPECIFIED FOR INPUT DATA!!!")
-                # Convert to the grid's native projection of LambertConformal:
-                # https://mesowest.utah.edu/html/hrrr/zarr_documentation/html/ex_python_plot_zarr.html#:~:text=Plotting%20HRRR%20Zarr%20data%20for%20a%20single%20gridpoint.%20This%20python
-                gdf = gdf_raw.to_crs(proj)
-
-            df = process_geo_data(gdf, data=forcing, name = b, y_lat_dim = y_lat_dim, x_lon_dim = x_lon_dim, id_col=id_col, out_dir = out_dir, redo = redo)
-            df = df.to_dataframe()
-            # Save results by basin average and subcatchment
-            save_path_base = f'{out_dir}/camels_{date}' # Main directory based on date
-            cats = df.groupby('divide_id') # Note that 'divide_id' has become a standardized colname at this point
-            path = Path(save_path_base)
-            Path.mkdir(path, exist_ok=True)
-            for name, data in cats:
-                data = data.droplevel('divide_id')
-                data.to_csv(path / f"{name}.csv")
-            agg = df.groupby("time").mean()
-            agg.to_csv(path / f"camels_{b}_agg.csv")
\ No newline at end of file
+    proj = hrrr_projection()
+    # Read and reproject every basin once, and keep its weights in memory, for all days
+    registry = BasinRegistry(partial(read_basin, basin_url = _basin_url, proj = proj, dir_custom_gpkg = dir_custom_gpkg, epsg = epsg), weight_store)
+    geo_kwargs = dict(y_lat_dim = y_lat_dim, x_lon_dim = x_lon_dim, id_col=id_col, out_dir = out_dir, redo = redo, cvar = cvar, ctime_max = ctime_max, cid = cid, weight_store = registry.weights, global_weights = global_weights, weights_workers = config.get('weights_workers', None), chunk_mem_gb = config.get('chunk_mem_gb', None), io_workers = config.get('io_workers', None), prefetch = config.get('prefetch', 2))
+    day_kwargs = dict(level_vars_anl = _level_vars_anl, level_vars_fcst = _level_vars_fcst, fcst_hr = apcp_fcst_hr, bucket_subf = _bucket_subf, drop_vars = _drop_vars, manifest = manifest, cache = chunk_cache, hour_workers = config.get('hour_workers', 8), hour_retries = config.get('hour_retries', 3), hour_backoff = config.get('hour_backoff_s', 2.0), index = metadata_index)
+    # Hours that could not be opened, and why
+    gaps_path = out_dir / 'hrrr_gaps.csv'
+    # Optionally aggregate windows of several days at once, appending to one time series per basin
+    window_days = config.get('window_days', None)
+    if window_days is None:
+        for date in all_dates:
+            print(f'Processing {date}')
+            forcing = open_day(date, **day_kwargs)
+            if forcing is None:
+                continue
+            log_gaps(forcing, gaps_path)
+            for b in basins:
+                print(f'Processing basin {b}')
+                gdf = registry.gdf(b)
+                df = process_geo_data(gdf, data=forcing, name = b, **geo_kwargs)
+                # Save results by basin average and subcatchment
+                save_path_base = f'{out_dir}/camels_{date}' # Main directory based on date
+                path = Path(save_path_base)
+                # Note that 'divide_id' has become a standardized colname at this point
+                DivideCsvWriter(path, None).write(df)
+                df = df.to_dataframe()
+                agg = df.groupby("time").mean()
+                agg.to_csv(path / f"camels_{b}_agg.csv")
+    else:
+        batch_mem_gb = config.get('batch_mem_gb', None)
+        # A rerun resumes after the last hour written for every basin, days before it are not opened again
+        ends = [last_written(basin_writers(out_dir, b)) for b in basins]
+        written = None if any(end is None for end in ends) else min(ends)
+        for first in range(0, len(all_dates), window_days):
+            dates = all_dates[first:first + window_days]
+            if written is not None:
+                dates = [date for date in dates if pd.to_datetime(date, format='%Y%m%d') + pd.Timedelta(23, unit='h') > written]
+                if not dates:
+                    print(f'Skipping {all_dates[first]} to {all_dates[min(first + window_days, len(all_dates)) - 1]}, already written')
+                    continue
+            print(f'Processing {dates[0]} to {dates[-1]}')
+            days = [day for day in (open_day(date, **day_kwargs) for date in dates) if day is not None]
+            if not days:
+                continue
+            forcing = concat_days(days)
+            log_gaps(forcing, gaps_path)
+            gdfs = ((b, registry.gdf(b)) for b in basins)
+            # All basins in one pass over the window, or in batches bounded by a memory budget per time block
+            batches = batch_basins(gdfs, forcing, y_lat_dim, x_lon_dim, batch_mem_gb, ctime_max) if batch_mem_gb is not None else [dict(gdfs)]
+            for batch in batches:
+                results = process_geo_data_batch(batch, forcing, compute = False, **geo_kwargs)
+                stream_forcing(results, {b: basin_writers(out_dir, b) for b in batch})
+    registry.summary()
+    if chunk_cache is not None:
+        if client is not None:
+            # the chunks are read and counted in the processes of the cluster workers
+            chunk_cache.take_worker_counts(client)
+        chunk_cache.summary()
+    if metadata_index is not None:
+        metadata_index.summary()
+    print(f"Listed {manifest.lists} days of {_bucket_subf}, {len(all_dates) + 1 - manifest.lists} from the manifest {manifest_path}")
+    if client is not None:
+        client.shutdown()
@@ -13,113 +13,160 @@
 '''
 
 
+import json
 import zarr
 from pathlib import Path
 from multiprocessing.pool import ThreadPool
 
 import dask
+import dask.array
 import dask.delayed
 import geopandas as gpd
 import numpy as np
+import pandas as pd
 import s3fs
 import xarray as xr
 from dask.diagnostics import ProgressBar
 import dask.dataframe as ddf
+from scipy import sparse
 
-from aggregate import window_aggregate
-from weights import get_all_cov, get_weights_df
+from aggregate import build_weight_matrix, divide_blocks, window_aggregate
+from chunk_plan import dask_workers, plan_chunks
+from pipeline import BlockPipeline, PipelineView
+from subset import check_within, open_subset
+from weights import cell_window, get_all_cov, get_weights_df, grid_template
+from weights_store import grid_extent
 
-def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id', out_dir = '', redo = False, cvar = 8, ctime_max = 120, cid = -1):
+def _flip(data, y_lat_dim):
+    '''In case the data is upside down, flip the y axis'''
+    flipped = bool(len(data[y_lat_dim]) > 1 and data[y_lat_dim][1] > data[y_lat_dim][0])
+    if flipped:
+        data = data.sel({y_lat_dim : slice(None, None, -1)})
+    return data, flipped
+
+def get_coverage(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id', out_dir = '', redo = False, weight_store = None, global_weights = None, weights_workers = None):
     '''
-   Given a geodataframe representing catchment(s) boundaries and a raster dataset,
-    compute the mean data values spanning the catchment(s) boundaries.
+    Load or compute the grid coverage weights of the catchment(s) in a geodataframe.
 
-    Parameters
-    ----------
-    gdf : GeoDataFrame
-        Geodataframe of catchments.
-    data : xarray.Dataset
-        Xarray dataset of raster data.
-    name : str
-        A unique file name used for saving catchment-specific grid weights. The basin id is ideal.
-    y_lat_dim : str
-        The latitude identifier in the xarray dataset `data`.
-    x_lon_dim : str
-        The longitude identifier in the xarray dataset `data`.
-    out_dir : str
-        The desired save directory for catchment-specific grid weights.
-    redo : bool, optional
-        Should previously saved catchment grid weights be read in if they have already been created? If False, weights are regenerated. Default is False.
-    cvar : int, optional
-        Chunk size for variables. Default is 8.
-    ctime_max : int, optional
-        The max chunk time frame. Units of hours. Default is 120.
-    cid : int, optional
-        The `id_col` chunk size. Default is -1, which means all divide_ids in a basin. A small value may be needed for very large basins with many catchments.
+    See process_geo_data for a description of the parameters.
 
     Returns
     -------
-    xr.dataset of retrieved variables
+    tuple
+        (coverage, data) where coverage is the coverage table from weights.get_all_cov and data is
+        `data` sliced to the grid the coverage indices refer to (with the y axis high to low).
     '''
     print("Slicing data to domain")
-    # Only need to load the raster for the geo data extent
+    # Only need the grid over the geo data extent, padded to every cell the catchments may touch
     extent = gdf.total_bounds
-    lats = slice(extent[1], extent[3])
-    lons = slice(extent[0], extent[2])
-    # In  case the data is upside down, flip the y axis
-    flipped = bool(len(data[y_lat_dim]) > 1 and data[y_lat_dim][1] > data[y_lat_dim][0])
-    if flipped:
-        data = data.sel({y_lat_dim : slice(None, None, -1)})
-        # in order for xarray to use slice indexing, need to ensure
-        # the lats slice is high to low when the latitude index is reversed
-        lats = slice(extent[3], extent[1])
-    data_sub = data.sel(indexers = {x_lon_dim:lons, y_lat_dim:lats})
+    data, flipped = _flip(data, y_lat_dim)
+    if global_weights is not None and redo != True:
+        found = global_weights.coverage(gdf, data, y_lat_dim, x_lon_dim, id_col = id_col)
+        if found is not None:
+            print(f"Reading {name} coverage from {global_weights.path}")
+            coverage, window = found
+            return coverage, data.isel(indexers = window)
+    data_sub = data.isel(indexers = cell_window(data, extent, y_lat_dim, x_lon_dim))
     # Load or compute coverage masks
     save = Path(f"{out_dir}/{name}_coverage.parquet")
-    if save.exists() and redo != True:
+    cached = None
+    if weight_store is not None:
+        key = weight_store.key(data_sub, gdf, y_lat_dim, x_lon_dim, id_col)
+        if redo != True:
+            cached = weight_store.get(key)
+    elif save.exists() and redo != True:
         print(f"Reading {name} coverage from file")
         coverage = ddf.read_parquet(save).compute()
-        data = data_sub
-        #NJF FIXME this isn't quite right if coverage is created based on biggerdata below?????
-    else:
-        # If we don't have weights cached, compute and save them
-        weight_raster = (
-            data_sub[next(iter(data_sub.keys()))]
-            .isel(time=0)
-            .sel(indexers = {x_lon_dim:lons, y_lat_dim:lats})
-            .compute()
-        )
+        sidecar = save.with_suffix(".json")
+        if sidecar.exists():
+            with open(sidecar, "r") as file:
+                cached = coverage, json.load(file)
+        else:
+            # Written before the grid was recorded, on the cells whose centres are within the extent
+            lats = slice(extent[3], extent[1]) if flipped else slice(extent[1], extent[3])
+            cached = coverage, grid_extent(data.sel(indexers = {x_lon_dim:slice(extent[0], extent[2]), y_lat_dim:lats}), y_lat_dim, x_lon_dim)
+    if cached is not None:
+        # Select the exact grid the coverage indices were built against
+        coverage, grid = cached
+        data_grid = data.sel(indexers = {dim: slice(grid[dim][0], grid[dim][1]) for dim in (y_lat_dim, x_lon_dim)})
+        sizes = {y_lat_dim: coverage["global_idx_y"].max(), x_lon_dim: coverage["global_idx_x"].max()}
+        if any(data_grid[dim].size != grid[dim][2] or sizes[dim] >= grid[dim][2] for dim in (y_lat_dim, x_lon_dim)):
+            print(f"Cached {name} coverage does not match the grid, recomputing")
+            cached = None
+        else:
+            if weight_store is not None:
+                print(f"Reading {name} coverage from {weight_store.root}")
+            data = data_grid
+    if cached is None:
+        # If we don't have weights cached, compute and save them. The weights only depend on
+        # the grid, so they are computed on a template of it and no forcing data is read
         print("Computing Weights")
-        try:
-            weights_df = get_weights_df(gdf, weight_raster, id_col=id_col)
-            data = data_sub
-        except:
-            print('weight_raster may not have enough coverage. Try expanding size of sliced raster')
-            x_lon_diff = data[x_lon_dim][1].values - data[x_lon_dim][0].values
-            y_lat_diff = data[y_lat_dim][1].values - data[y_lat_dim][0].values
-            if flipped:
-                lats_big = slice(extent[3]-y_lat_diff, extent[1]+y_lat_diff)
-            else:
-                lats_big = slice(extent[1]-y_lat_diff, extent[3]+y_lat_diff)
-            lons_big = slice(extent[0]-x_lon_diff, extent[2]+x_lon_diff)
-            biggerdata = data.sel(indexers = {x_lon_dim:lons_big, y_lat_dim:lats_big})
-            weight_raster = (
-                biggerdata[next(iter(biggerdata.keys()))]
-                .isel(time=0)
-                .sel(indexers = {x_lon_dim:lons_big, y_lat_dim:lats_big})
-                .compute()
-            )
-            weights_df = get_weights_df(gdf, weight_raster,id_col=id_col)
-            data = biggerdata
+        weights_df = get_weights_df(gdf, grid_template(data_sub, y_lat_dim, x_lon_dim), id_col=id_col, workers=weights_workers)
+        data = data_sub
         print("Creating Coverage")
         coverage = get_all_cov(data, weights_df, y_lat_dim = y_lat_dim, x_lon_dim = x_lon_dim)
-        coverage.to_parquet(save)
-    print("Processing the following raster data set")
-    #print(data)
+        if weight_store is not None:
+            weight_store.put(key, coverage, grid_extent(data, y_lat_dim, x_lon_dim))
+        else:
+            coverage.to_parquet(save)
+            with open(save.with_suffix(".json"), "w") as file:
+                json.dump(grid_extent(data, y_lat_dim, x_lon_dim), file)
+    return coverage, data
+
+def _prune_chunks(data, matrix, y_lat_dim, x_lon_dim):
+    '''
+    Keep only the source (zarr) chunks of a (variable, time, y, x) array that contain weighted cells.
+
+    Returns
+    -------
+    tuple
+        (data, matrix) where data is a lazy (variable, time, cell) array of the cells of every
+        spatial chunk with a non-zero weight (row-major within each chunk) and matrix has its
+        columns reordered to match, so the chunks without weights are never read.
+    '''
+    ny, nx = data[y_lat_dim].size, data[x_lon_dim].size
+    # The dask chunks follow the source chunks of the store (clipped at the edges of the slice)
+    chunks = dict(zip(data.dims, data.chunks))
+    ybounds = np.cumsum((0,) + chunks[y_lat_dim])
+    xbounds = np.cumsum((0,) + chunks[x_lon_dim])
+    iy, ix = np.unravel_index(np.unique(matrix.indices), (ny, nx))
+    tiles = np.unique(
+        np.stack([np.searchsorted(ybounds, iy, side="right") - 1, np.searchsorted(xbounds, ix, side="right") - 1], axis=1),
+        axis=0,
+    )
+    nvar, ntime = data.shape[0], data.shape[1]
+    blocks, columns = [], []
+    for ty, tx in tiles:
+        y0, y1, x0, x1 = ybounds[ty], ybounds[ty + 1], xbounds[tx], xbounds[tx + 1]
+        blocks.append(data.data[:, :, y0:y1, x0:x1].reshape(nvar, ntime, -1))
+        columns.append((np.arange(y0, y1)[:, np.newaxis] * nx + np.arange(x0, x1)).ravel())
+    columns = np.concatenate(columns)
+    pruned = xr.DataArray(
+        dask.array.concatenate(blocks, axis=2),
+        dims=["variable", "time", "cell"],
+        coords={"variable": data["variable"].values, "time": data["time"]},
+    )
+    nbytes = nvar * ntime * data.dtype.itemsize
+    skipped = (ny * nx - columns.size) * nbytes
+    print(f"Reading {len(tiles)} of {(len(ybounds) - 1) * (len(xbounds) - 1)} spatial chunks, "
+          f"skipping {skipped / 1e9:.3f} GB ({100 * skipped / (ny * nx * nbytes):.1f}%) of the bounding box read")
+    return pruned, matrix[:, columns]
+
+def _aggregate(data, matrix, ids, y_lat_dim, x_lon_dim, cvar, ctime_max, cid, prune_chunks = True, chunk_mem_gb = None, io_workers = None, prefetch = 2):
+    '''
+    Lazily compute the weighted mean of every row of `matrix` for all variables and times in `data`.
+
+    Returns a lazy DataArray, or a pipeline.BlockPipeline when `io_workers` is set.
+    '''
     # Stack all the raster variables into a single multi-dimension array
     # This makes the windowing algorithm much more efficient as it can broadcast
     # operations arcoss all the variable data at once
-    data = data.to_dataarray()
+    data = data.to_dataarray().transpose("variable", "time", y_lat_dim, x_lon_dim)
+    spatial = {y_lat_dim: -1, x_lon_dim: -1}
+    if prune_chunks and data.chunks is not None:
+        # Only read the source chunks that contain weighted cells
+        data, matrix = _prune_chunks(data, matrix, y_lat_dim, x_lon_dim)
+        spatial = {"cell": -1}
 
 
     # Chunk params were chosen based on processing HUC 01 (19k geometries) within reasonable
@@ -127,31 +174,53 @@ def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id'
     # geo data sets!!!
     ctime = np.min([ctime_max, len(data['time'])])
     
-    # On huc01 when this is not 1, you get
+    # On huc01 chunking divide_id within a single map_blocks gives
     # KeyError: ('<this-array>-agg_xr5-1d8d7d6b0dd083c3658d89ffacb65555', 0, 0, 1)
     # when the results try to join :confused:
     # but seemed to work on on smaller domains (e.g. a camels basin)
+    if chunk_mem_gb is not None:
+        # Plan the chunks from a memory budget instead of the hand tuned values
+        src_ctime = dict(zip(data.dims, data.chunks))["time"][0] if data.chunks is not None else None
+        plan = plan_chunks(
+            len(data["variable"]), len(data["time"]), int(np.prod(data.shape[2:])), len(ids), chunk_mem_gb,
+            src_ctime=src_ctime, itemsize=data.dtype.itemsize, workers=dask_workers() if io_workers is None else prefetch + 2, cid=cid,
+        )
+        cvar, ctime, cid = plan["cvar"], plan["ctime"], plan["cid"]
 
     # Rechunk data through time, but ensure the entire spatial extent is in mem
     data = data.chunk(
-        {"variable": cvar, y_lat_dim: -1, x_lon_dim: -1, "time": ctime}
-    )
-    # Build the template data array for the outputs
-    coords = {
-        "time": data.time,
-        "divide_id": gdf[id_col].sort_values(),
-        "variable": data.coords["variable"].values,
-    }
-    dims = ["variable", "time", "divide_id"]
-    shp = (
-        len(data.coords["variable"]),
-        data.time.size,
-        len(gdf[id_col]),
+        {"variable": cvar, "time": ctime, **spatial}
     )
-    var = xr.DataArray(np.zeros(shp), coords=coords, dims=dims)
-    # It is important to make sure these chunks align with the data chunks!
-    var = var.chunk({"variable": cvar, "time": ctime, "divide_id": cid})
-    result = data.map_blocks(window_aggregate, args=(coverage,), template=var)
+    if io_workers is not None:
+        # Read ahead on a dedicated I/O pool while the current time block is aggregated
+        return BlockPipeline(data, matrix, ids, ctime, io_workers, prefetch, cid)
+    # The source blocks have no divide_id to split along (the KeyError above), so every
+    # block of cid divides is its own map_blocks over the same source blocks, with its rows
+    # of the weights
+    parts = []
+    for rows in divide_blocks(len(ids), cid):
+        # Build the template data array for the outputs
+        coords = {
+            "time": data.time,
+            "divide_id": ids[rows],
+            "variable": data.coords["variable"].values,
+        }
+        dims = ["variable", "time", "divide_id"]
+        shp = (
+            len(data.coords["variable"]),
+            data.time.size,
+            rows.stop - rows.start,
+        )
+        # A lazy template, so the full (variable, time, divide_id) result is never allocated up front
+        var = xr.DataArray(dask.array.zeros(shp, chunks=(cvar, ctime, -1)), coords=coords, dims=dims)
+        # It is important to make sure these chunks align with the data chunks!
+        var = var.chunk({"variable": cvar, "time": ctime, "divide_id": -1})
+        parts.append(data.map_blocks(window_aggregate, args=(matrix[rows], ids[rows]), template=var))
+    return parts[0] if len(parts) == 1 else xr.concat(parts, dim="divide_id")
+
+def _compute(result):
+    if isinstance(result, BlockPipeline):
+        return result.compute()
     # Perform the computations
     with ProgressBar():
         try:
@@ -160,6 +229,185 @@ def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id'
             print("TODO: is there a dimensional out of bounds problem? Try and figure this out")
             # print("Attempting without chunking/window aggregation")
             # result = data.compute()
+    return result
+
+def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id', out_dir = '', redo = False, cvar = 8, ctime_max = 120, cid = -1, weight_store = None, global_weights = None, weights_workers = None, compute = True, prune_chunks = True, chunk_mem_gb = None, io_workers = None, prefetch = 2):
+    '''
+   Given a geodataframe representing catchment(s) boundaries and a raster dataset,
+    compute the mean data values spanning the catchment(s) boundaries.
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        Geodataframe of catchments.
+    data : xarray.Dataset or str or Path
+        Xarray dataset of raster data, or the path of a local subset store from subset.py.
+    name : str
+        A unique file name used for saving catchment-specific grid weights. The basin id is ideal.
+    y_lat_dim : str
+        The latitude identifier in the xarray dataset `data`.
+    x_lon_dim : str
+        The longitude identifier in the xarray dataset `data`.
+    out_dir : str
+        The desired save directory for catchment-specific grid weights. Only used when `weight_store` is None.
+    redo : bool, optional
+        Should previously saved catchment grid weights be read in if they have already been created? If False, weights are regenerated. Default is False.
+    cvar : int, optional
+        Chunk size for variables. Default is 8.
+    ctime_max : int, optional
+        The max chunk time frame. Units of hours. Default is 120.
+    cid : int, optional
+        The `id_col` chunk size, the number of divides aggregated per task. Default is -1, which means all divide_ids in a basin.
+    weight_store : WeightStore, optional
+        Shared store of grid weights keyed on the grid definition and catchment geometries. Default None saves weights as `{out_dir}/{name}_coverage.parquet`.
+    global_weights : global_weights.GlobalWeights, optional
+        Prebuilt weights of every divide on the full grid, looked up before `weight_store` or the saved weights. Divides or grids it does not cover fall back to computing the weights. Default None.
+    weights_workers : int, optional
+        Compute weights with exact_extract over tiles of the grid in this many processes, for large geodataframes such as a VPU. Default None computes them in a single exact_extract.
+    compute : bool, optional
+        Compute the result before returning. If False, a lazy dask backed dataset chunked by time is returned, e.g. for writers.stream_forcing. Default True.
+    prune_chunks : bool, optional
+        Only read the source chunks of `data` that contain weighted cells, rather than the full bounding box of `gdf`. Default True.
+    chunk_mem_gb : float, optional
+        Memory budget in GB for the aggregation. When set, cvar, ctime_max and cid are replaced by a plan from chunk_plan.plan_chunks. Default None.
+    io_workers : int, optional
+        Aggregate with a pipeline.BlockPipeline that reads time blocks on a dedicated pool of this many threads, overlapping reads with the aggregation. With compute=False a pipeline.PipelineView for writers.stream_forcing is returned. Default None computes a single dask graph.
+    prefetch : int, optional
+        Number of time blocks read ahead of the aggregation when `io_workers` is set. Default 2.
+
+    Returns
+    -------
+    xr.dataset of retrieved variables
+    '''
+    if isinstance(data, (str, Path)):
+        path, data = data, open_subset(data)
+        check_within(gdf, data, y_lat_dim, x_lon_dim, path)
+    coverage, data = get_coverage(gdf, data, name, y_lat_dim, x_lon_dim, id_col = id_col, out_dir = out_dir, redo = redo, weight_store = weight_store, global_weights = global_weights, weights_workers = weights_workers)
+    print("Processing the following raster data set")
+    #print(data)
+    # Build the normalized (divide x cell) weights once, every block is then a
+    # single sparse mat-mul over the flattened spatial axes
+    matrix, ids = build_weight_matrix(
+        coverage, (data[y_lat_dim].size, data[x_lon_dim].size)
+    )
+    result = _aggregate(data, matrix, ids, y_lat_dim, x_lon_dim, cvar, ctime_max, cid, prune_chunks, chunk_mem_gb, io_workers, prefetch)
+    if isinstance(result, BlockPipeline) and not compute:
+        return PipelineView(result)
+    if compute:
+        result = _compute(result)
     # Unstack the variables back into a dataset
     result = result.to_dataset(dim="variable")
     return result
+
+def _domain_cells(extent, data, y_lat_dim, x_lon_dim):
+    '''
+    Number of grid cells in the (one cell padded) bounding box `extent` of `data`, from the coordinates alone.
+    '''
+    cells = 1
+    for dim, lo, hi in [(x_lon_dim, extent[0], extent[2]), (y_lat_dim, extent[1], extent[3])]:
+        coords = data[dim].values
+        pad = np.abs(coords[1] - coords[0]) if coords.size > 1 else 0
+        cells *= int(np.count_nonzero((coords >= lo - pad) & (coords <= hi + pad)))
+    return cells
+
+def batch_basins(basins, data, y_lat_dim, x_lon_dim, mem_gb, ctime_max = 120):
+    '''
+    Group basins into batches whose union bounding box fits a memory budget per time block.
+
+    Parameters
+    ----------
+    basins : iterable
+        (name, GeoDataFrame) pairs, already projected to the crs of `data`. Consumed lazily, so
+        geopackages may be read as batches are formed.
+    data : xarray.Dataset
+        Xarray dataset of raster data.
+    y_lat_dim : str
+        The latitude identifier in the xarray dataset `data`.
+    x_lon_dim : str
+        The longitude identifier in the xarray dataset `data`.
+    mem_gb : float
+        Memory budget in GB for one time block of all variables over the union of a batch.
+    ctime_max : int, optional
+        The max chunk time frame. Units of hours. Default is 120.
+
+    Yields
+    ------
+    dict
+        Basin name to GeoDataFrame, in the order given. A basin larger than the budget on its own
+        is yielded as a batch of one.
+    '''
+    ctime = np.min([ctime_max, len(data['time'])])
+    itemsize = max(data[v].dtype.itemsize for v in data.data_vars)
+    per_cell = len(data.data_vars) * ctime * itemsize
+    batch, extent = {}, None
+    for name, gdf in basins:
+        bounds = gdf.total_bounds
+        union = bounds if extent is None else np.concatenate([np.minimum(extent[:2], bounds[:2]), np.maximum(extent[2:], bounds[2:])])
+        if batch and _domain_cells(union, data, y_lat_dim, x_lon_dim) * per_cell > mem_gb * 1e9:
+            yield batch
+            batch, union = {}, bounds
+        batch[name] = gdf
+        extent = union
+    if batch:
+        yield batch
+
+def process_geo_data_batch(gdfs, data, y_lat_dim, x_lon_dim, id_col = 'divide_id', out_dir = '', redo = False, cvar = 8, ctime_max = 120, cid = -1, weight_store = None, global_weights = None, weights_workers = None, compute = True, prune_chunks = True, chunk_mem_gb = None, io_workers = None, prefetch = 2):
+    '''
+    Compute the mean data values of the catchments of many basins in a single pass over `data`.
+
+    Each time block of the union of the basins' grids is read once and every basin's weights are
+    applied to that in-memory block. Use batch_basins to bound the size of the union.
+
+    Parameters
+    ----------
+    gdfs : dict
+        Basin name to Geodataframe of catchments. The name is used as in process_geo_data.
+    data : xarray.Dataset or str or Path
+        Xarray dataset of raster data, or the path of a local subset store from subset.py.
+
+    See process_geo_data for a description of the remaining parameters.
+
+    Returns
+    -------
+    dict of basin name to xr.dataset of retrieved variables
+    '''
+    if isinstance(data, (str, Path)):
+        path, data = data, open_subset(data)
+        for gdf in gdfs.values():
+            check_within(gdf, data, y_lat_dim, x_lon_dim, path)
+    dims = (y_lat_dim, x_lon_dim)
+    full, _ = _flip(data, y_lat_dim)
+    grids = {}
+    for name, gdf in gdfs.items():
+        coverage, sub = get_coverage(gdf, data, name, y_lat_dim, x_lon_dim, id_col = id_col, out_dir = out_dir, redo = redo, weight_store = weight_store, global_weights = global_weights, weights_workers = weights_workers)
+        # Locate the basin's grid within the full grid, which get_coverage returns with the y axis high to low
+        start = {dim: full.get_index(dim).get_loc(sub[dim].values[0]) for dim in dims}
+        grids[name] = (coverage, start, {dim: sub[dim].size for dim in dims})
+    # The union of all basin grids, read once per time block
+    lo = {dim: min(g[1][dim] for g in grids.values()) for dim in dims}
+    hi = {dim: max(g[1][dim] + g[2][dim] for g in grids.values()) for dim in dims}
+    union = full.isel(indexers = {dim: slice(lo[dim], hi[dim]) for dim in dims})
+    shape = (hi[y_lat_dim] - lo[y_lat_dim], hi[x_lon_dim] - lo[x_lon_dim])
+    print(f"Processing {len(gdfs)} basins over a {shape[0]} x {shape[1]} grid")
+    # Stack every basin's weights, re-indexed onto the union grid, into one matrix
+    matrices, rows = [], {}
+    for name, (coverage, start, _) in grids.items():
+        coverage = coverage.copy()
+        coverage["global_idx_y"] += start[y_lat_dim] - lo[y_lat_dim]
+        coverage["global_idx_x"] += start[x_lon_dim] - lo[x_lon_dim]
+        matrix, ids = build_weight_matrix(coverage, shape)
+        offset = sum(m.shape[0] for m in matrices)
+        rows[name] = (offset, offset + len(ids), ids)
+        matrices.append(matrix)
+    # Basins may share catchments (e.g. nested gages), so rows are positional here
+    matrix = sparse.vstack(matrices, format="csr")
+    result = _aggregate(union, matrix, pd.RangeIndex(matrix.shape[0]), y_lat_dim, x_lon_dim, cvar, ctime_max, cid, prune_chunks, chunk_mem_gb, io_workers, prefetch)
+    if isinstance(result, BlockPipeline) and not compute:
+        return {name: PipelineView(result, (start, end), ids) for name, (start, end, ids) in rows.items()}
+    if compute:
+        result = _compute(result)
+    results = {}
+    for name, (start, end, ids) in rows.items():
+        sub = result.isel(divide_id = slice(start, end)).assign_coords(divide_id = ids)
+        results[name] = sub.to_dataset(dim="variable")
+    return results
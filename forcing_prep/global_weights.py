@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""global_weights.py
+    Build once, then look up, the coverage weights of a whole hydrofabric on a full forcing grid
+
+    The coverage of every divide is computed with exact_extract against the
+    full AORC (or HRRR) grid and kept as one sparse matrix in CSR form: for
+    each divide id, the raveled cell indices of the full grid (y high to low,
+    as in geo_proc) and their coverage fractions. The arrays, the grid
+    coordinates and the CRS are saved in a single npz. Any basin, gage subset
+    or VPU then gets its coverage table by row selection instead of running
+    exact_extract, see get_coverage in geo_proc (the `global_weights` option
+    of process_geo_data) and GlobalWeights.coverage. Lookups on a subgrid of
+    the full grid (e.g. a subset.py store) are supported, other grids fall
+    back to exact_extract.
+
+    Example
+    -------
+    python global_weights.py config_aorc.yaml --gpkg /path/to/conus.gpkg --out aorc_weights.npz
+    python global_weights.py config_aorc.yaml --out camels_aorc_weights.npz  # the basins of the config
+    python global_weights.py config_hrrr.yaml --hrrr --gpkg /path/to/conus.gpkg --out hrrr_weights.npz
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from locality import hilbert_key
+from weights import _build_index, cell_window, get_weights_df, grid_template
+from weights_store import _grid_crs
+
+
+def _full_grid(data, y_lat_dim):
+    from geo_proc import _flip
+
+    return _flip(data, y_lat_dim)[0]
+
+
+def build_global_weights(gdfs, data, y_lat_dim, x_lon_dim, out, id_col="divide_id", group_size=5000, workers=None):
+    """
+    Compute the coverage of every divide over the full grid of `data` and save it as a CSR npz.
+
+    Parameters
+    ----------
+    gdfs : iterable
+        GeoDataFrames of divides (e.g. one per VPU or basin), already projected to the crs of
+        `data`. Divides seen before (e.g. in nested basins) are skipped.
+    data : xarray.Dataset
+        Dataset on the full grid. Only its coordinates and CRS are used, nothing is read.
+    y_lat_dim : str
+        The latitude identifier in the xarray dataset `data`.
+    x_lon_dim : str
+        The longitude identifier in the xarray dataset `data`.
+    out : str or Path
+        The npz to write.
+    id_col : str, optional
+        The divide id column. Default 'divide_id'.
+    group_size : int, optional
+        Divides computed at once. Large geodataframes are split into groups of nearby divides
+        (along a Hilbert curve of their centroids), so each group covers a small window. Default 5000.
+    workers : int, optional
+        Processes computing the tiles of each group, see weights.get_weights_df. Default None.
+
+    Returns
+    -------
+    GlobalWeights of the npz written.
+    """
+    full = _full_grid(data, y_lat_dim)
+    ny, nx = full[y_lat_dim].size, full[x_lon_dim].size
+    dtype = np.int32 if ny * nx < 2**31 else np.int64
+    rows, seen, done = [], set(), 0
+    for gdf in gdfs:
+        gdf = gdf[~gdf[id_col].astype(str).isin(seen)].drop_duplicates(id_col)
+        if gdf.empty:
+            continue
+        seen.update(gdf[id_col].astype(str))
+        # order the divides along a Hilbert curve, so each group is compact
+        centroids = gdf.geometry.representative_point()
+        res = np.abs(np.diff(full[x_lon_dim].values[:2]))[0] if nx > 1 else 1
+        keys = [hilbert_key(int((y - centroids.y.min()) / res), int((x - centroids.x.min()) / res), order=20) for x, y in zip(centroids.x, centroids.y)]
+        gdf = gdf.iloc[np.argsort(keys, kind="stable")]
+        for start in range(0, len(gdf), group_size):
+            group = gdf.iloc[start:start + group_size]
+            window = cell_window(full, group.total_bounds, y_lat_dim, x_lon_dim)
+            sub = full.isel(indexers=window)
+            weights_df = get_weights_df(group, grid_template(sub, y_lat_dim, x_lon_dim), id_col=id_col, workers=workers)
+            cov = _build_index(weights_df, (sub[y_lat_dim].size, sub[x_lon_dim].size))
+            gy = cov["global_idx_y"].values.astype(np.int64) + window[y_lat_dim].start
+            gx = cov["global_idx_x"].values.astype(np.int64) + window[x_lon_dim].start
+            rows.append(pd.DataFrame(
+                {"cell": (gy * nx + gx).astype(dtype), "coverage": cov["coverage"].values},
+                index=cov.index.astype(str),
+            ))
+            done += len(group)
+            print(f"Computed the weights of {done} divides")
+    table = pd.concat(rows)
+    # CSR: the entries are grouped by divide, in sorted divide order
+    ids, counts = np.unique(table.index.values, return_counts=True)
+    order = np.argsort(table.index.values, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    np.savez(
+        out,
+        ids=ids.astype(str),
+        indptr=indptr,
+        indices=table["cell"].values[order],
+        coverage=table["coverage"].values[order].astype(np.float32),
+        y=full[y_lat_dim].values,
+        x=full[x_lon_dim].values,
+        crs=np.array(_grid_crs(full)),
+    )
+    print(f"Saved the weights of {len(ids)} divides ({len(table)} cells) to {out}")
+    return GlobalWeights(out)
+
+
+def _offset(coords, sub):
+    """Position of the coordinates `sub` within `coords`, or None if they are not a contiguous part of it"""
+    if sub.size == 0 or sub.size > coords.size:
+        return None
+    tol = np.abs(np.diff(coords[:2])).min() * 1e-3 if coords.size > 1 else 1e-9
+    match = np.flatnonzero(np.abs(coords - sub[0]) <= tol)
+    if match.size == 0 or match[0] + sub.size > coords.size:
+        return None
+    start = int(match[0])
+    if not np.allclose(coords[start:start + sub.size], sub, rtol=0, atol=tol):
+        return None
+    return start
+
+
+class GlobalWeights:
+    """
+    Row lookup of the coverage of divides in a npz written by build_global_weights.
+
+    The arrays are read on first use; pickling keeps only the path, so the object can be
+    passed to worker processes cheaply.
+
+    Parameters
+    ----------
+    path : str or Path
+        The npz written by build_global_weights.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._arrays = None
+
+    def __getstate__(self):
+        return {"path": self.path, "_arrays": None}
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            with np.load(self.path, allow_pickle=False) as npz:
+                self._arrays = {name: npz[name] for name in npz.files}
+            self._arrays["row"] = pd.Index(self._arrays["ids"])
+        return self._arrays
+
+    def coverage(self, gdf, data, y_lat_dim, x_lon_dim, id_col="divide_id"):
+        """
+        The coverage table of the divides of `gdf` and the window of `data` it refers to.
+
+        `data` must have its y axis high to low (see geo_proc._flip) and a grid that is the
+        full grid of the npz or a contiguous part of it, with the same CRS.
+
+        Returns
+        -------
+        tuple or None
+            (coverage, window) with coverage as from weights.get_all_cov and window the index
+            slices of `data` its global_idx_y/global_idx_x refer to. None if a divide is missing
+            from the npz, or the grid does not match, so the caller computes the weights itself.
+        """
+        a = self.arrays
+        ids = gdf[id_col].astype(str).values
+        rows = a["row"].get_indexer(ids)
+        if (rows < 0).any():
+            print(f"{int((rows < 0).sum())} divides are not in {self.path}, computing their weights")
+            return None
+        if _grid_crs(data) != str(a["crs"]):
+            print(f"The grid of {self.path} has another CRS, computing the weights")
+            return None
+        y0 = _offset(a["y"], data[y_lat_dim].values)
+        x0 = _offset(a["x"], data[x_lon_dim].values)
+        if y0 is None or x0 is None:
+            print(f"The grid is not part of the grid of {self.path}, computing the weights")
+            return None
+        starts, ends = a["indptr"][rows], a["indptr"][rows + 1]
+        lengths = ends - starts
+        take = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)]) if len(rows) else np.empty(0, np.int64)
+        gy, gx = np.divmod(a["indices"][take].astype(np.int64), a["x"].size)
+        gy, gx = gy - y0, gx - x0
+        ny, nx = data[y_lat_dim].size, data[x_lon_dim].size
+        if gy.size == 0 or gy.min() < 0 or gx.min() < 0 or gy.max() >= ny or gx.max() >= nx:
+            print("The divides are not within the grid, computing the weights")
+            return None
+        window = {
+            y_lat_dim: slice(int(gy.min()), int(gy.max()) + 1),
+            x_lon_dim: slice(int(gx.min()), int(gx.max()) + 1),
+        }
+        ly, lx = gy - window[y_lat_dim].start, gx - window[x_lon_dim].start
+        width = window[x_lon_dim].stop - window[x_lon_dim].start
+        coverage = pd.DataFrame(
+            {
+                "ids": (ly * width + lx).astype(np.int32),
+                "coverage": a["coverage"][take],
+                "global_idx_y": ly.astype(np.int32),
+                "global_idx_x": lx.astype(np.int32),
+            },
+            index=pd.Index(np.repeat(ids, lengths), name="divide_id"),
+        )
+        return coverage, window
+
+
+if __name__ == "__main__":
+    import geopandas as gpd
+    import yaml
+
+    from stores import source_fs
+
+    parser = argparse.ArgumentParser(description="Build the coverage weights of many divides over a full forcing grid.")
+    parser.add_argument("config_path", type=str, help="Path to the YAML configuration file of generate.py (or generate_hrrr.py with --hrrr)")
+    parser.add_argument("--gpkg", type=str, nargs="*", help="Geopackages of divides, e.g. the hydrofabric VPUs. Default is the basins of the config")
+    parser.add_argument("--hrrr", action="store_true", help="Build for the HRRR grid of the first day of the config rather than the AORC grid")
+    parser.add_argument("--out", type=str, required=True, help="The npz to write")
+    parser.add_argument("--group_size", type=int, default=5000, help="Divides computed at once")
+    parser.add_argument("--workers", type=int, default=None, help="Processes computing the weights of a group in tiles")
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as file:
+        config = yaml.safe_load(file)
+    id_col = config.get("id_col", "divide_id")
+    if args.hrrr:
+        from hrrr_proc import _gen_hrrr_zarr_urls, _map_open_files_hrrrzarr, hrrr_projection, prep_date_time_range
+
+        date = prep_date_time_range(config["time_bgn"], config["time_bgn"])[0][0]
+        _, urls_anl = _gen_hrrr_zarr_urls(date=date, level_vars_anl=config["level_vars_anl"][:1], level_vars_fcst=[], bucket_subf=config["hrrr_source"])
+        data = _map_open_files_hrrrzarr(urls_ls=urls_anl, concat_dim=["time", None], fs=source_fs(config["hrrr_source"]))
+        proj = hrrr_projection()
+        basin_url = config["basin_url_template"].replace("{}", "{basin_id}")
+    else:
+        from generate import open_forcing
+
+        data = open_forcing(config["aorc_source"], config["aorc_year_url_template"], tuple(config["years"]))
+        proj = data[next(iter(data.keys()))].crs
+        basin_url = config["basin_url_template"]
+
+    def read_divides():
+        if args.gpkg:
+            for path in args.gpkg:
+                yield gpd.read_file(path, layer="divides").to_crs(proj)
+            return
+        from generate import list_basins
+
+        for b in list_basins(config["basins"], basin_url):
+            url = basin_url.format(basin_id=b)
+            yield gpd.read_file(source_fs(url).open(url), driver="gpkg", layer="divides").to_crs(proj)
+
+    build_global_weights(read_divides(), data, config["y_lat_dim"], config["x_lon_dim"], args.out, id_col=id_col, group_size=args.group_size, workers=args.workers)
@@ -0,0 +1,106 @@
+"""hrrr_manifest.py
+    Module for a local record of the hourly hrrrzarr stores available per day
+
+    Building the urls of a day lists its bucket folder, plus the previous day
+    for the forecast hours, so a multi-year run repeats thousands of list calls
+    and every rerun repeats them all again. The manifest keeps the `_anl.zarr`
+    and `_fcst.zarr` stores of every day listed in a json file. All days of a
+    run (and the day before the first, for the forecasts) are listed once,
+    concurrently, before processing starts; days already in the file are never
+    listed again, so rerunning a date range makes no list calls. Days within
+    `settle_days` of today may still receive hours and are only kept for the
+    run.
+"""
+
+import datetime as dt
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from stores import source_fs
+
+_KINDS = ("_anl.zarr", "_fcst.zarr")
+
+
+class HrrrManifest:
+    """
+    The hourly hrrrzarr stores of every day of a bucket, listed once and kept in a json file.
+
+    Parameters
+    ----------
+    path : str or Path
+        The json file of the manifest, e.g. `{out_dir}/hrrr_manifest.json`.
+    bucket_subf : str
+        The hrrrzarr bucket folder (e.g. 's3://hrrrzarr/sfc') or a local directory with the same layout.
+    threads : int, optional
+        Days listed concurrently by `prefetch`. Default 16.
+    settle_days : int, optional
+        Days this recent are not saved, as their hours may still be uploaded. Default 2.
+    """
+
+    def __init__(self, path, bucket_subf, threads=16, settle_days=2):
+        self.path = Path(path)
+        self.bucket_subf = bucket_subf
+        self.threads = threads
+        self.settle_days = settle_days
+        self.fs = source_fs(bucket_subf)
+        self.days = {}
+        self.lists = 0
+        if self.path.exists():
+            with open(self.path, "r") as file:
+                saved = json.load(file)
+            if saved.get("bucket") == bucket_subf:
+                self.days = saved["days"]
+            else:
+                print(f"{self.path} lists {saved.get('bucket')} rather than {bucket_subf}, listing again")
+        self._saved = set(self.days)
+
+    def _list(self, date):
+        self.lists += 1
+        try:
+            listed = self.fs.ls(f"{self.bucket_subf}/{date}/")
+        except FileNotFoundError:
+            listed = []
+        return sorted(str(x) for x in listed if any(kind in str(x) for kind in _KINDS))
+
+    def _settled(self, date):
+        return pd.to_datetime(date, format="%Y%m%d").date() <= dt.datetime.utcnow().date() - dt.timedelta(days=self.settle_days)
+
+    def ls(self, date):
+        """The `_anl.zarr` and `_fcst.zarr` stores of `date` (YYYYMMDD), as listed by the filesystem"""
+        if date not in self.days:
+            self.days[date] = self._list(date)
+            self.save()
+        return self.days[date]
+
+    def prefetch(self, dates):
+        """List every day of `dates` not in the manifest yet, concurrently, and save them"""
+        missing = sorted(set(dates) - set(self.days))
+        if not missing:
+            print(f"All {len(set(dates))} days are in the HRRR manifest {self.path}")
+            return
+        print(f"Listing {len(missing)} days of {self.bucket_subf}")
+        with ThreadPoolExecutor(self.threads) as pool:
+            futures = {date: pool.submit(self._list, date) for date in missing}
+        for date, future in futures.items():
+            try:
+                self.days[date] = future.result()
+            except Exception as e:
+                # left for ls to list again when the day is processed
+                print(f"Could not list {date}: {e!r}")
+        self.save()
+
+    def save(self):
+        """Write the settled days, atomically replacing the file"""
+        settled = {date: self.days[date] for date in sorted(self.days) if self._settled(date)}
+        if set(settled) == self._saved:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, "w") as file:
+            json.dump({"bucket": self.bucket_subf, "days": settled}, file)
+        os.replace(tmp, self.path)
+        self._saved = set(settled)
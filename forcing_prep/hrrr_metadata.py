@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""hrrr_metadata.py
+    Crawl once, then look up, the zarr metadata of the hourly hrrrzarr stores
+
+    The hrrrzarr stores are not opened with consolidated metadata, as some
+    variables lack it (see _map_open_files_hrrrzarr), so opening a store reads
+    its .zgroup, .zattrs and the .zarray/.zattrs of every array one GET at a
+    time, for each of the 24 hours of every variable of a day. The crawler
+    reads these keys once for a date range (one listing and one batched read
+    per store) and keeps them as consolidated metadata in a local index, one
+    gzipped json per day. open_store then answers the metadata keys of an
+    indexed store locally, so xarray opens it without metadata round trips;
+    stores missing from the index are opened as before.
+
+    Example
+    -------
+    python hrrr_metadata.py config_hrrr.yaml --out /path/to/hrrr_metadata
+"""
+import argparse
+import gzip
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from stores import source_fs
+
+_META = (".zgroup", ".zattrs")
+_ARRAY_META = (".zarray", ".zattrs")
+
+
+def _store_id(url):
+    return str(url).removeprefix("s3://").rstrip("/")
+
+
+def _day(url):
+    """The date folder (YYYYMMDD) of a hrrrzarr store url, from its store name (e.g. 20240430_22z_anl.zarr)"""
+    store = next(part for part in str(url).split("/") if part.endswith("_anl.zarr") or part.endswith("_fcst.zarr"))
+    return store[0:8]
+
+
+def crawl_store(url, fs):
+    """
+    The consolidated metadata of the zarr store at `url`: its group keys and those of its arrays.
+
+    Returns
+    -------
+    dict or None
+        The content of a `.zmetadata` for the store, or None if the store does not exist.
+    """
+    try:
+        children = fs.ls(url, detail=False)
+    except FileNotFoundError:
+        return None
+    names = [str(c).rstrip("/").split("/")[-1] for c in children]
+    keys = list(_META) + [f"{name}/{meta}" for name in names if not name.startswith(".") for meta in _ARRAY_META]
+    paths = {fs._strip_protocol(f"{url}/{key}"): key for key in keys}
+    found = fs.cat(list(paths), on_error="omit")
+    metadata = {paths[fs._strip_protocol(path)]: json.loads(data) for path, data in found.items()}
+    if ".zgroup" not in metadata:
+        return None
+    # Only the arrays of the group are opened, leave out subgroups (e.g. the level group of a metadata store)
+    arrays = {key.split("/")[0] for key in metadata if key.endswith("/.zarray")}
+    metadata = {key: value for key, value in metadata.items() if "/" not in key or key.split("/")[0] in arrays}
+    return {"metadata": metadata, "zarr_consolidated_format": 1}
+
+
+class HrrrMetadataIndex:
+    """
+    Local index of the consolidated metadata of hrrrzarr stores, one gzipped json per day.
+
+    Days are read on first use. Hits and misses of `get` are counted for the summary.
+
+    Parameters
+    ----------
+    root : str or Path
+        Directory of the index.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.days = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, date):
+        return self.root / f"{date}.json.gz"
+
+    def _load(self, date):
+        if date not in self.days:
+            path = self._path(date)
+            if path.exists():
+                with gzip.open(path, "rt") as file:
+                    self.days[date] = json.load(file)
+            else:
+                self.days[date] = {}
+        return self.days[date]
+
+    def get(self, url):
+        """The consolidated metadata of the store at `url`, or None if it is not indexed"""
+        metadata = self._load(_day(url)).get(_store_id(url))
+        if metadata is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return metadata
+
+    def crawl(self, urls, fs, threads=16):
+        """Index the stores of `urls` not in the index yet, concurrently, and save the days they belong to"""
+        missing = sorted({_store_id(url): url for url in urls if _store_id(url) not in self._load(_day(url))}.items())
+        if not missing:
+            print(f"All {len(set(map(_store_id, urls)))} stores are in the HRRR metadata index {self.root}")
+            return
+        print(f"Crawling the metadata of {len(missing)} stores")
+        with ThreadPoolExecutor(threads) as pool:
+            futures = {store_id: pool.submit(crawl_store, url, fs) for store_id, url in missing}
+        changed = set()
+        for store_id, future in futures.items():
+            try:
+                metadata = future.result()
+            except Exception as e:
+                # left for a later crawl, the store is opened from the source meanwhile
+                print(f"Could not crawl {store_id}: {e!r}")
+                continue
+            # stores that do not exist are kept as None, so they are not crawled again
+            self.days[_day(store_id)][store_id] = metadata
+            changed.add(_day(store_id))
+        for date in sorted(changed):
+            self.save(date)
+
+    def save(self, date):
+        """Write the index of `date`, atomically replacing its file"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self._path(date)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with gzip.open(tmp, "wt") as file:
+            json.dump(self.days[date], file)
+        os.replace(tmp, path)
+
+    def summary(self):
+        """Print the hit/miss counters"""
+        print(f"HRRR metadata index {self.root}: {self.hits} stores opened from the index, {self.misses} not indexed")
+
+
+def hrrr_store_urls(dates, level_vars_anl, level_vars_fcst, fcst_hr, bucket_subf, manifest=None):
+    """Every store url opened by generate_hrrr.open_day for `dates`"""
+    from hrrr_proc import _gen_hrrr_zarr_urls
+
+    urls = []
+    for date in dates:
+        urls_fcst, urls_anl = _gen_hrrr_zarr_urls(date=date, level_vars_anl=level_vars_anl, level_vars_fcst=level_vars_fcst, fcst_hr=fcst_hr, bucket_subf=bucket_subf, manifest=manifest)
+        urls.extend(url for var in urls_anl + urls_fcst for hr in var for url in hr)
+    return urls
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    import yaml
+
+    from hrrr_manifest import HrrrManifest
+    from hrrr_proc import prep_date_time_range
+
+    parser = argparse.ArgumentParser(description="Crawl the zarr metadata of the hrrrzarr stores of a date range into a local index.")
+    parser.add_argument("config_path", type=str, help="Path to the YAML configuration file of generate_hrrr.py")
+    parser.add_argument("--out", type=str, default=None, help="Directory of the index. Default is hrrr_metadata_index of the config")
+    parser.add_argument("--time_bgn", type=str, default=None, help="First day, default time_bgn of the config")
+    parser.add_argument("--time_end", type=str, default=None, help="Last day, default time_end of the config")
+    parser.add_argument("--threads", type=int, default=16, help="Stores crawled concurrently")
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as file:
+        config = yaml.safe_load(file)
+    home_dir = str(Path.home())
+    out = args.out if args.out is not None else config["hrrr_metadata_index"].format(home_dir=home_dir)
+    bucket_subf = config["hrrr_source"]
+    dates = prep_date_time_range(args.time_bgn or config["time_bgn"], args.time_end or config["time_end"])[0]
+    # The same manifest as generate_hrrr.py, the forecasts also need the day before
+    manifest_path = config["hrrr_manifest"] if config.get("hrrr_manifest", None) is not None else f"{config['out_dir']}/hrrr_manifest.json"
+    manifest = HrrrManifest(manifest_path.format(home_dir=home_dir), bucket_subf)
+    day_before = (pd.to_datetime(dates[0], format="%Y%m%d") - pd.Timedelta(1, unit="D")).strftime("%Y%m%d")
+    manifest.prefetch([day_before] + dates)
+    urls = hrrr_store_urls(dates, config["level_vars_anl"], config["level_vars_fcst"], config["fcst_hr"], bucket_subf, manifest)
+    HrrrMetadataIndex(out).crawl(urls, source_fs(bucket_subf), threads=args.threads)
@@ -12,6 +12,22 @@ import dask
 import dask.delayed
 import xarray as xr
 import warnings
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stores import open_store, source_fs
+
+def hrrr_projection():
+    '''
+    The Lambert Conformal projection of the HRRR grid
+    https://mesowest.utah.edu/html/hrrr/zarr_documentation/html/ex_python_plot_zarr.html
+    '''
+    return ccrs.LambertConformal(central_longitude=262.5, 
+                                 central_latitude=38.5, 
+                                 standard_parallels=(38.5, 38.5),
+                                 globe=ccrs.Globe(semimajor_axis=6371229,
+                                                  semiminor_axis=6371229))
 
 def prep_date_time_range(time_bgn, time_end):
     '''
@@ -35,13 +51,21 @@ def _build_zarr_urls(zarr_paths, level_vars):
         ls_urls.append(zip_urls)
     return ls_urls
 
-def _fcst_url_find(times_avail, fcst_hr, bucket_subf, date):
+def _ls_day(bucket_subf, date, manifest = None):
+    '''
+    The hourly stores of a day in hour order, from the manifest (see hrrr_manifest.py) if given, otherwise listed
+    '''
+    if manifest is not None:
+        return manifest.ls(date)
+    # sorted, as the hour selection of _fcst_url_find relies on the order (local listings are unordered)
+    return sorted(str(x) for x in source_fs(bucket_subf).ls(f'{bucket_subf}/{date}/'))
+
+def _fcst_url_find(times_avail, fcst_hr, bucket_subf, date, manifest = None):
     '''
     The forecast data represent time into the future and this changes the date/hour to align with nowcast data.
     For example if forecast hour = 03, HRRR data extract the forecasted data from hours spanning 03 to 04,
         e.g. accumulated precipitation after one hour has passed by 04:00. 
     '''
-    fs = s3fs.S3FileSystem(anon=True)
     # Find the url date - hour pairings corresponding to the desired forecasting hour
     if int(fcst_hr) > 23:
         raise ValueError('Forecast data subsetting has only been designed for forecasts up to 24 hours in advance. Please set fcst_hr to values from 0 to 23.')
@@ -62,8 +86,7 @@ def _fcst_url_find(times_avail, fcst_hr, bucket_subf, date):
     back_time = pd.to_datetime(date, format = '%Y%m%d') - pd.Timedelta(fcst_hr+1, unit='hour')
     back_date = str(back_time)[0:10].replace('-','')
     back_hour = f'_{24-(fcst_hr+1):02d}z_'
-    bucket_subfolder_backdate = f'{bucket_subf}/{back_date}/'
-    times_avail_back = [x for x in fs.ls(bucket_subfolder_backdate) if '_fcst.zarr' in x ]
+    times_avail_back = [x for x in _ls_day(bucket_subf, back_date, manifest) if '_fcst.zarr' in x ]
     times_sel_back = list()
     
     for x in np.arange((24-(fcst_hr+1)),24):
@@ -72,24 +95,33 @@ def _fcst_url_find(times_avail, fcst_hr, bucket_subf, date):
     urls_fcst = times_sel_back + sub_times_fcst_og
     return urls_fcst
 
-def _gen_hrrr_zarr_urls(date, level_vars_anl = None, level_vars_fcst=None, fcst_hr=0, bucket_subf = 's3://hrrrzarr/sfc'):
+def _gen_hrrr_zarr_urls(date, level_vars_anl = None, level_vars_fcst=None, fcst_hr=0, bucket_subf = 's3://hrrrzarr/sfc', manifest = None):
     # Zarr data file structure follows e.g. 'hrrrzarr/sfc/20240430/20240430_22z_anl.zarr/2m_above_ground/TMP/2m_above_ground'
-    fs = s3fs.S3FileSystem(anon=True)
+    # bucket_subf may also be a local directory with the same layout
+    # With a manifest (see hrrr_manifest.py) the day is not listed again
     bucket_subfolder_date = f'{bucket_subf}/{date}/'
     try:
-        times_anl = [x for x in fs.ls(bucket_subfolder_date) if '_anl.zarr' in x]
+        times_avail = _ls_day(bucket_subf, date, manifest)
+        times_anl = [x for x in times_avail if '_anl.zarr' in x]
         if not times_anl:
             raise(Warning(f'Could not list bucket for {date} inside {bucket_subfolder_date}. Skipping.'))
         urls_anl = _build_zarr_urls(times_anl, level_vars_anl)
         # Build forecast urls based on forecast hour
-        times_avail_fcst = [x for x in fs.ls(bucket_subfolder_date) if '_fcst.zarr' in x]
-        times_fcst = _fcst_url_find(times_avail_fcst, fcst_hr, bucket_subf, date)
+        times_avail_fcst = [x for x in times_avail if '_fcst.zarr' in x]
+        times_fcst = _fcst_url_find(times_avail_fcst, fcst_hr, bucket_subf, date, manifest)
         urls_fcst = _build_zarr_urls(times_fcst, level_vars_fcst)
     except:
         urls_fcst = list()
         urls_anl = list()
     return urls_fcst, urls_anl
 
+def _url_time(url):
+    '''
+    The date and hour of a hrrrzarr url, from its store name (e.g. 20240430_22z_anl.zarr) at any depth, as in local sources
+    '''
+    store = next(part for part in url.split('/') if part.endswith('_anl.zarr') or part.endswith('_fcst.zarr'))
+    return pd.to_datetime(store[0:11], format='%Y%m%d_%H')
+
 def _check_hrrrzarr_url_time_vs_data_time(urls_ls, ls_vars,drop_vars=None,fcst_hr = 0):
     '''
     Checks to see if any timestamps specified in a zarr url do not agree
@@ -134,7 +166,7 @@ def _check_hrrrzarr_url_time_vs_data_time(urls_ls, ls_vars,drop_vars=None,fcst_h
 
         for day_url in  urls_ls[ctr_ls]:
             # Convert a url into a timestamp, acknowledging that for forecast hours, the forecast needs to be added back in to jive with the retrieved data's timestamp set using the 'preprocess' function arg passed inside _map_open_files_hrrrzarr()
-            dt_url = pd.to_datetime(day_url[0].split('/')[3][0:11],format='%Y%m%d_%H') + pd.Timedelta(hours = fcst_hr)
+            dt_url = _url_time(day_url[0]) + pd.Timedelta(hours = fcst_hr)
             idx_chck.append(np.where(subdat.time.data == dt_url))
             # Simplify the time indexes for keeps into a list of ints
             idx_keep = [y[0] for y in [x[0] for x in idx_chck if x[0].size > 0]]
@@ -153,13 +185,143 @@ def fxn():
     # "No index created for dimension time because variable time is not a coordinate. To create an index for time, please first call `.set_coords('time')` on this object."
     warnings.warn("UserWarning", UserWarning)
 
-def _map_open_files_hrrrzarr(urls_ls, concat_dim = ['time',None], preprocess = None,drop_vars = None,fcst_hr = 0):
+def _indexed(index, url):
+    # The consolidated metadata of url in the index, if any
+    return None if index is None else index.get(url)
+
+def _open_hour(hr, fs, cache, preprocess, must_have_vars, retries = 3, backoff = 2.0, index = None):
+    '''
+    Open the stores of one hour of a variable, retrying transient errors.
+
+    Parameters
+    ----------
+    hr : tuple
+        The zarr url and metadata url of the hour.
+    must_have_vars : list
+        Variables the opened hour must contain, otherwise it is dropped.
+    retries : int, optional
+        Attempts after the first one for errors other than missing stores. Default 3.
+    backoff : float, optional
+        Seconds before the first retry, doubled for every later one, with +/-50% jitter so
+        hours failing together do not retry together. Default 2.0.
+    index : hrrr_metadata.HrrrMetadataIndex, optional
+        Local consolidated metadata of the stores, see open_store. Default None.
+
+    Returns
+    -------
+    tuple
+        (dataset, None) once the hour is opened, or (None, reason) if it is dropped.
+    '''
+    for attempt in range(retries + 1):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                hr_map = [open_store(h, fs=fs, cache=cache, metadata=_indexed(index, h)) for h in hr]
+                # Hours are already opened concurrently, so not parallel. Note no concat_dim when working with lowest 'resolution'
+                check = xr.open_mfdataset(hr_map, engine = 'zarr', parallel = False, combine = 'nested',
+                                          preprocess = preprocess) # TODO may need to handle a different pre-processing function in case failure occurs
+        except (FileNotFoundError, KeyError) as e: # A missing store or group is not transient
+            return None, f'missing store: {e}'
+        except Exception as e:
+            if attempt == retries:
+                return None, f'failed after {retries + 1} attempts: {e!r}'
+            time.sleep(backoff * 2**attempt * random.uniform(0.5, 1.5))
+            continue
+        missing = [x for x in must_have_vars if x not in check.data_vars] # Example 20200318_22z DSWRF
+        if missing:
+            return None, f"missing variables {' & '.join(missing)}"
+        return check, None
+
+def _open_hours(var, fs, cache, preprocess, must_have_vars, fcst_hr = 0, workers = 8, retries = 3, backoff = 2.0, index = None):
+    '''
+    Open the hourly stores of a variable concurrently and concatenate them along time.
+
+    Hours that cannot be opened stay on the time axis, filled with NaN, rather than shortening it.
+    If no hour can be opened, the dataset only has the expected time axis, see fill_dropped.
+
+    Parameters
+    ----------
+    var : list
+        The hours of the variable, as [zarr url, metadata url] pairs.
+    fcst_hr : int, optional
+        Hours added to the url time to get the data time (see _check_hrrrzarr_url_time_vs_data_time). Default 0.
+    workers : int, optional
+        Hours opened at once. Default 8.
+
+    Returns
+    -------
+    tuple
+        (dataset, dropped) where dropped maps the data time (ISO string) of every dropped hour to the reason.
+
+    See Also
+    --------
+    _open_hour
+    '''
+    with ThreadPoolExecutor(max(1, min(workers, len(var)))) as pool:
+        opened = list(pool.map(lambda hr: _open_hour(hr, fs, cache, preprocess, must_have_vars, retries, backoff, index), var))
+    ls_hrs, dropped = list(), dict()
+    for hr, (check, reason) in zip(var, opened):
+        if check is None:
+            print(f'Dropped {hr[0]}: {reason}')
+            dropped[(_url_time(hr[0]) + pd.Timedelta(hours = fcst_hr)).isoformat()] = reason
+        else:
+            ls_hrs.append(check)
+    if len(ls_hrs) == 0:
+        return xr.Dataset(coords = {'time': pd.DatetimeIndex(sorted(dropped))}), dropped
+    # Concatenate each hour's dataset into a full days' dataset:
+    sub_concat = xr.concat(ls_hrs, dim = 'time')
+    if dropped and 'time' in sub_concat.indexes:
+        sub_concat = sub_concat.drop_duplicates(dim = 'time', keep = 'last')
+        sub_concat = sub_concat.reindex(time = sub_concat.get_index('time').union(pd.DatetimeIndex(list(dropped))))
+    return sub_concat, dropped
+
+def gap_mask(dat):
+    '''
+    The hours dropped from each variable of a dataset from _map_open_files_hrrrzarr (or generate_hrrr.open_day).
+
+    Returns
+    -------
+    xarray.DataArray
+        Boolean (variable, time), True where an hour of the variable was dropped and is NaN.
+    '''
+    gaps = dat.attrs.get('hrrr_gaps', {})
+    names = list(dat.data_vars)
+    mask = np.zeros((len(names), dat.sizes.get('time', 0)), dtype = bool)
+    if 'time' in dat.indexes:
+        times = dat.get_index('time')
+        for i, name in enumerate(names):
+            for t in gaps.get(name, {}):
+                mask[i] |= times == pd.Timestamp(t)
+    return xr.DataArray(mask, coords = {'variable': names, 'time': dat['time'].values if 'time' in dat.coords else np.arange(mask.shape[1])}, dims = ['variable', 'time'])
+
+def fill_dropped(dat):
+    '''
+    Add the variables of dat.attrs['hrrr_gaps'] that no hour could be opened for, all NaN over the time axis.
+
+    The grid is that of another variable of dat, so a variable stays missing while dat has none.
+    '''
+    ref = next((da for da in dat.data_vars.values() if 'time' in da.dims), None)
+    if ref is None:
+        return dat
+    dtype = ref.dtype if np.issubdtype(ref.dtype, np.floating) else np.float32
+    for name in dat.attrs.get('hrrr_gaps', {}):
+        if name not in dat.data_vars:
+            print(f'No hour of {name} could be opened, kept as NaN')
+            dat[name] = xr.full_like(ref, np.nan, dtype = dtype).assign_attrs({})
+    return dat
+
+def _map_open_files_hrrrzarr(urls_ls, concat_dim = ['time',None], preprocess = None,drop_vars = None,fcst_hr = 0, fs = None, cache = None, workers = 8, retries = 3, backoff = 2.0, index = None):
     # Expect urls_ls to be a nested list as follows: [var[date-hour[paired urls]]]
-    fs = s3fs.S3FileSystem(anon=True)
+    # fs is the filesystem of the urls (default anonymous s3), see stores.source_fs. cache is an optional stores.ChunkCache
+    # workers, retries and backoff apply to the per-hour fallback, see _open_hours. The hours it dropped are in dat.attrs['hrrr_gaps'], see gap_mask
+    # index is an optional hrrr_metadata.HrrrMetadataIndex, the stores it has are opened from their indexed metadata
+    if fs is None:
+        fs = s3fs.S3FileSystem(anon=True)
     # Map the urls
-    files_map = [[[s3fs.S3Map(z , s3=fs) for z in y] for y in x] for x in urls_ls]
+    files_map = [[[open_store(z, fs=fs, cache=cache, metadata=_indexed(index, z)) for z in y] for y in x] for x in urls_ls]
     # Problem: some variables needs to be read in using consolidated = False (e.g. DSWRF 20240430), which is much slower
     ls_vars = list()
+    gaps = dict()
     var_ctr = -1
     for fvar in files_map:
         var_ctr +=1
@@ -174,39 +336,18 @@ def _map_open_files_hrrrzarr(urls_ls, concat_dim = ['time',None], preprocess = N
                                             preprocess = preprocess,
                                             concat_dim = concat_dim)) 
             except:
-                print('Could not successfully process urls. Attempting to process by the hour instead of day (this takes longer)')
+                print('Could not successfully process urls. Opening the hours concurrently instead')
                 var = urls_ls[var_ctr]
                 var_name = var[0][1].split('/')[-1]
                 print(f'Problematic variable includes: {var_name}')
-                
-                ls_hrs = list()
-                for hr in var: 
-                    try:
-                        hr_map = [s3fs.S3Map(h, s3=fs) for h in hr]
-                        check = (xr.open_mfdataset(hr_map, engine = 'zarr', parallel = True,
-                                        combine = 'nested',
-                                        preprocess = preprocess # TODO may need to handle a different pre-processing function in case failure occurs
-                                        ))  # Note no concat_dim when working with lowest 'resolution'
-                        # Add in expected data variable check:
-                        if not 'fcst' in var_name: # A forecast variable name likely does not have a 'time' variable, but rather a 'forecast_reference_time'
-                            must_have_vars = [x for x in concat_dim if x is not None] + [var_name]
-                        else: # Do not want 'time' to be expected in variables for the case of APCP_1hr_acc_fcst
-                            must_have_vars = [var_name]
-
-                        if not all([x in check.data_vars for x in must_have_vars]): # Example 20200318_22z DSWRF
-                            # Expected variables include 'time' and the var_name
-                            print(f"Skipping {var_name} because {' & '.join(must_have_vars)} are not present as variables in the dataset from {hr}. ")
-                            continue
-                    except: # Skip this one and head to the next
-                        print(f'Could not process {hr}. Skipping. Consider the preprocess function or faulty zarr data.')
-                        continue
-                    else:
-                        ls_hrs.append(check)
-                # Concatenate each hour's dataset into a full days' dataset:
-                if len(ls_hrs) > 0:
-                    sub_concat = xr.concat(ls_hrs,dim='time')
-                else:
-                    sub_concat = xr.Dataset()
+                # Add in expected data variable check:
+                if not 'fcst' in var_name: # A forecast variable name likely does not have a 'time' variable, but rather a 'forecast_reference_time'
+                    must_have_vars = [x for x in concat_dim if x is not None] + [var_name]
+                else: # Do not want 'time' to be expected in variables for the case of APCP_1hr_acc_fcst
+                    must_have_vars = [var_name]
+                sub_concat, dropped = _open_hours(var, fs, cache, preprocess, must_have_vars, fcst_hr = fcst_hr, workers = workers, retries = retries, backoff = backoff, index = index)
+                if dropped:
+                    gaps[var_name] = dropped
                 ls_vars.append(sub_concat) # Add the variable's full day to list of variables
     try: # Upon building list of variable-days, combine into a single dataset
         # TODO On 20200727 why does everything go to 20200728T01 except for the variable PRES?
@@ -237,6 +378,9 @@ def _map_open_files_hrrrzarr(urls_ls, concat_dim = ['time',None], preprocess = N
             except:
                 print("DO SOMETHING 2")
         dat = dat1
+    if len(dat.data_vars) == 0: # Every hour was dropped
+        dat.attrs['hrrr_gaps'] = gaps
+        return dat
     if any(dat.get_index('time').duplicated()): # Double check no timestamps were duplicated
         print(f'Duplicated timestamps generated - removed.')
         dat = dat.drop_duplicates(dim = ['time'], keep = 'last')
@@ -247,6 +391,8 @@ def _map_open_files_hrrrzarr(urls_ls, concat_dim = ['time',None], preprocess = N
     if any(ls_wrong_ts):
         # There are more timestamps than expected.
         dat = xr.merge(subdat_ls)
-    return dat
+    dat.attrs['hrrr_gaps'] = gaps
+    # Variables without any hour are NaN rather than missing
+    return fill_dropped(dat)
 
 
@@ -0,0 +1,155 @@
+"""locality.py
+    Module for ordering basins so consecutive basins read the same source chunks
+
+    The basin ids of 'all' follow no geography, so consecutive basins rarely
+    share AORC chunks and the chunk cache (stores.ChunkCache) or the OS page
+    cache seldom serve a read. Here every basin is reduced to the set of
+    source chunks (tiles of the y/x chunk grid) its bounding box touches, and
+    basins are ordered along a Hilbert curve through the tile grid, or
+    greedily by the overlap of their tiles with the tiles of the basins just
+    processed. The expected reuse ratio, the share of chunk reads that the
+    previous basins already read, is reported for the order chosen and for
+    the id order.
+"""
+
+import numpy as np
+from pyproj import Transformer
+
+ORDERS = ("id", "hilbert", "greedy")
+
+
+def _chunk_bounds(data, dim):
+    """Start of every chunk along a dimension, plus the end of the last one"""
+    var = data[next(iter(data.data_vars))]
+    chunks = var.chunksizes.get(dim, (data[dim].size,))
+    return np.cumsum((0,) + tuple(chunks))
+
+
+def chunk_footprints(bounds, data, y_lat_dim, x_lon_dim):
+    """
+    The source chunk tiles touched by the bounding box of every basin.
+
+    Parameters
+    ----------
+    bounds : pd.DataFrame
+        Indexed by basin with `minx`, `miny`, `maxx`, `maxy` columns in EPSG:4326, e.g. from
+        sharding.basin_costs.
+    data : xarray.Dataset
+        Lazy source dataset, chunked as stored, with a `crs` attribute on its variables.
+    y_lat_dim : str
+        The latitude identifier in the xarray dataset `data`.
+    x_lon_dim : str
+        The longitude identifier in the xarray dataset `data`.
+
+    Returns
+    -------
+    dict of basin to a set of (chunk row, chunk column) tiles.
+    """
+    crs = data[next(iter(data.data_vars))].crs
+    to_grid = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    ys, xs = data[y_lat_dim].values, data[x_lon_dim].values
+    ybounds, xbounds = _chunk_bounds(data, y_lat_dim), _chunk_bounds(data, x_lon_dim)
+    footprints = {}
+    for basin, row in bounds.iterrows():
+        minx, miny, maxx, maxy = to_grid.transform_bounds(row["minx"], row["miny"], row["maxx"], row["maxy"])
+        tiles = []
+        for coords, lo, hi, cb in [(ys, miny, maxy, ybounds), (xs, minx, maxx, xbounds)]:
+            inside = np.flatnonzero((coords >= lo) & (coords <= hi))
+            if inside.size == 0:
+                # bounds narrower than a cell, use the nearest cell
+                inside = np.array([np.abs(coords - (lo + hi) / 2).argmin()])
+            first, last = np.searchsorted(cb, [inside.min(), inside.max()], side="right") - 1
+            tiles.append(range(first, last + 1))
+        footprints[basin] = {(ty, tx) for ty in tiles[0] for tx in tiles[1]}
+    return footprints
+
+
+def hilbert_key(ty, tx, order=16):
+    """Distance along a Hilbert curve of the (row, column) tile on a 2**order grid"""
+    n = 1 << order
+    x, y, d = int(tx), int(ty), 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        if ry == 0:
+            if rx == 1:
+                x, y = n - 1 - x, n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def _centre_key(tiles):
+    ty, tx = np.mean(list(tiles), axis=0)
+    return hilbert_key(round(ty), round(tx))
+
+
+def order_basins(footprints, method="hilbert", window=4):
+    """
+    Order basins so consecutive basins share source chunks.
+
+    Parameters
+    ----------
+    footprints : dict
+        Basin to set of chunk tiles, see chunk_footprints.
+    method : str, optional
+        'hilbert' sorts by the Hilbert curve position of each footprint's centre. 'greedy'
+        starts from the first basin on the curve and then always takes the basin with the most
+        tiles among those of the last `window` basins (ties along the curve). 'id' keeps the
+        given order. Default 'hilbert'.
+    window : int, optional
+        Number of recent basins whose tiles are considered hot by 'greedy'. Default 4.
+
+    Returns
+    -------
+    list of basins.
+    """
+    if method not in ORDERS:
+        raise ValueError(f"Unknown basin order {method}, use one of {ORDERS}")
+    basins = list(footprints)
+    if method == "id":
+        return basins
+    keys = {b: _centre_key(footprints[b]) for b in basins}
+    curve = sorted(basins, key=lambda b: (keys[b], b))
+    if method == "hilbert":
+        return curve
+    position = {b: i for i, b in enumerate(curve)}
+    order, left = [curve[0]], set(curve[1:])
+    while left:
+        hot = set().union(*(footprints[b] for b in order[-window:]))
+        last = position[order[-1]]
+        # the most overlap with the hot tiles, then the nearest further along the curve
+        best = max(left, key=lambda b: (len(footprints[b] & hot), -((position[b] - last) % len(curve))))
+        order.append(best)
+        left.remove(best)
+    return order
+
+
+def reuse_ratio(order, footprints, window=1):
+    """Share of the chunk reads of `order` that one of the previous `window` basins already read"""
+    reads = reused = 0
+    for i, b in enumerate(order):
+        hot = set().union(*(footprints[p] for p in order[max(i - window, 0):i]))
+        reads += len(footprints[b])
+        reused += len(footprints[b] & hot)
+    return reused / reads if reads else 0.0
+
+
+def locality_order(basins, bounds, data, y_lat_dim, x_lon_dim, method="hilbert"):
+    """
+    Reorder basins by their source chunk footprint and print the expected chunk reuse.
+
+    See chunk_footprints and order_basins for the parameters.
+    """
+    basins = [str(b) for b in basins]
+    footprints = chunk_footprints(bounds.loc[basins], data, y_lat_dim, x_lon_dim)
+    order = order_basins(footprints, method)
+    distinct = len(set().union(*footprints.values())) if footprints else 0
+    print(
+        f"Basin order '{method}': {distinct} distinct source chunks, expected reuse between consecutive "
+        f"basins {reuse_ratio(order, footprints):.0%} ({reuse_ratio(basins, footprints):.0%} in the given order)"
+    )
+    return order
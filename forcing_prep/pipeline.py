@@ -0,0 +1,184 @@
+"""pipeline.py
+    Module for aggregating the forcing with reads and aggregation overlapped
+
+    Computing the aggregation as one dask graph under a shared thread pool
+    leaves reads and the sparse mat-mul competing for the same threads, so in
+    practice the pool alternates between waiting on s3 and aggregating. The
+    BlockPipeline splits the work into stages instead: a reader thread loads
+    one time block at a time with its chunk reads spread over a dedicated I/O
+    pool, keeping up to `prefetch` loaded blocks in a bounded queue, while the
+    caller's thread aggregates the current block and hands it downstream
+    (e.g. to the writers of writers.stream_forcing). At most prefetch + 2
+    blocks of the source are held in memory at once. The busy and idle time
+    of every stage is printed when the pipeline finishes, to show which stage
+    bounds the run.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dask
+import numpy as np
+import xarray as xr
+
+from aggregate import divide_blocks, window_aggregate
+
+_DONE = object()
+
+
+class StageClock:
+    """Busy and idle wall time of the stages of a pipeline"""
+
+    def __init__(self, stages):
+        self.busy = dict.fromkeys(stages, 0.0)
+        self.idle = dict.fromkeys(stages, 0.0)
+
+    def add(self, stage, busy=0.0, idle=0.0):
+        self.busy[stage] += busy
+        self.idle[stage] += idle
+
+    def summary(self, nblocks):
+        """Print the busy/idle time of every stage"""
+        print(f"Pipeline of {nblocks} time blocks:")
+        for stage in self.busy:
+            total = self.busy[stage] + self.idle[stage]
+            share = self.busy[stage] / total if total else 0
+            print(f"  {stage:>9}: busy {self.busy[stage]:8.2f} s, idle {self.idle[stage]:8.2f} s ({share:.0%} busy)")
+
+
+class BlockPipeline:
+    """
+    Aggregate a (variable, time, ...) source one time block at a time, reading ahead on a dedicated I/O pool.
+
+    Parameters
+    ----------
+    data : xr.DataArray
+        Lazy (dask backed) source stacked along "variable", with the spatial axes last and
+        flattened in the order of the columns of `matrix`, as prepared by geo_proc._aggregate.
+    matrix : scipy.sparse.csr_matrix
+        Normalized (divide x cell) weights, see aggregate.build_weight_matrix.
+    ids : array-like
+        The divide id of every row of `matrix`.
+    ctime : int
+        Number of time steps per block.
+    io_workers : int, optional
+        Number of threads reading the chunks of a block. Default 8.
+    prefetch : int, optional
+        Number of loaded blocks queued ahead of the aggregation. Default 2.
+    cid : int, optional
+        Number of divides aggregated at once within a block, -1 for all. Default -1.
+    """
+
+    def __init__(self, data, matrix, ids, ctime, io_workers=8, prefetch=2, cid=-1):
+        self.data = data
+        self.matrix = matrix
+        self.ids = ids
+        self.ctime = int(ctime)
+        self.io_workers = int(io_workers)
+        self.prefetch = max(int(prefetch), 1)
+        self.cid = int(cid)
+
+    @property
+    def time(self):
+        return self.data["time"]
+
+    @staticmethod
+    def _put(loaded, item, stop):
+        """Put `item` in the bounded queue, waiting while it is full unless the pipeline stopped"""
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self, bounds, loaded, stop, clock):
+        """Reader thread: load every block in turn into the bounded `loaded` queue"""
+        try:
+            with ThreadPoolExecutor(self.io_workers, thread_name_prefix="io") as pool:
+                for start, end in zip(bounds[:-1], bounds[1:]):
+                    tic = time.perf_counter()
+                    block = self.data.isel(time=slice(start, end))
+                    values, = dask.compute(block.data, scheduler="threads", pool=pool)
+                    block = block.copy(data=values)
+                    toc = time.perf_counter()
+                    # waits while the queue is full, which bounds the memory read ahead
+                    put = self._put(loaded, block, stop)
+                    clock.add("read", busy=toc - tic, idle=time.perf_counter() - toc)
+                    if not put:
+                        return
+        except BaseException as e:
+            self._put(loaded, e, stop)
+            return
+        self._put(loaded, _DONE, stop)
+
+    def blocks(self):
+        """
+        Yield the aggregated (variable, time, divide_id) DataArray of every time block in order.
+
+        Time the caller spends between blocks (e.g. writing them) is reported as the
+        "write" stage.
+        """
+        ntime = self.time.size
+        bounds = np.append(np.arange(0, ntime, self.ctime), ntime)
+        clock = StageClock(["read", "aggregate", "write"])
+        loaded = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read, args=(bounds, loaded, stop, clock), daemon=True)
+        reader.start()
+        try:
+            while True:
+                tic = time.perf_counter()
+                block = loaded.get()
+                toc = time.perf_counter()
+                if block is _DONE:
+                    clock.add("aggregate", idle=toc - tic)
+                    break
+                if isinstance(block, BaseException):
+                    raise block
+                rows = divide_blocks(len(self.ids), self.cid)
+                parts = [window_aggregate(block, self.matrix[r], self.ids[r]) for r in rows]
+                result = parts[0] if len(parts) == 1 else xr.concat(parts, dim="divide_id")
+                clock.add("aggregate", busy=time.perf_counter() - toc, idle=toc - tic)
+                # the caller waited for this block while it was read and aggregated
+                clock.add("write", idle=time.perf_counter() - tic)
+                tic = time.perf_counter()
+                yield result
+                clock.add("write", busy=time.perf_counter() - tic)
+        finally:
+            stop.set()
+            reader.join()
+        clock.summary(len(bounds) - 1)
+
+    def compute(self):
+        """The aggregated (variable, time, divide_id) DataArray over the full period"""
+        return xr.concat(list(self.blocks()), dim="time")
+
+
+class PipelineView:
+    """
+    The rows of one basin in the results of a BlockPipeline, for writers.stream_forcing.
+
+    Parameters
+    ----------
+    pipeline : BlockPipeline
+        The pipeline, possibly shared by the views of all basins of a batch.
+    rows : tuple, optional
+        (start, end) rows of the basin in the matrix of the pipeline. Default None is all rows.
+    ids : array-like, optional
+        The divide ids of the rows. Only used with `rows`.
+    """
+
+    def __init__(self, pipeline, rows=None, ids=None):
+        self.pipeline = pipeline
+        self.rows = rows
+        self.ids = ids
+
+    def select(self, block):
+        """The basin's dataset of an aggregated block yielded by BlockPipeline.blocks"""
+        if self.rows is not None:
+            block = block.isel(divide_id=slice(*self.rows)).assign_coords(divide_id=self.ids)
+        return block.to_dataset(dim="variable")
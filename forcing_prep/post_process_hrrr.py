@@ -35,12 +35,13 @@ if __name__ == "__main__":
     
     subdirs = [p for p in out_dir.rglob('*') if p.is_dir()]
 
-    subfiles = [f for f in out_dir.rglob('*.parquet')] # Should contain all basin identifiers
+    subfiles = [f for f in out_dir.rglob('camels_*_agg.csv')] # Should contain all basin identifiers
 
-    basin_ids = [f.name.replace('_coverage.parquet','') for f in subfiles]
+    basin_ids = sorted(set([f.name.replace('camels_','').replace('_agg.csv','') for f in subfiles]))
 
     for b in basin_ids:
-        paths_agg = [f for sd1 in subdirs for f in sd1.iterdir()  if f.is_file and b in f.name and 'agg.csv' in f.name]
+        # Per day runs write f'{out_dir}/camels_{date}/camels_{b}_agg.csv', runs with window_days f'{out_dir}/camels_{b}_agg.csv'
+        paths_agg = [f for f in subfiles if f.name == f'camels_{b}_agg.csv']
         paths_non_agg = [f for sd1 in subdirs for f in sd1.iterdir()  if f.is_file and b in f.name and 'agg.csv' not in f.name]
 
         compiled_df = pd.concat([pd.read_csv(x) for x in paths_agg]).sort_values(by = 'time', ascending=True).reset_index()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""sharding.py
+    Split the basins of generate.py between independent jobs, e.g. a SLURM array
+
+    `generate.py config.yaml --shard i/N` only processes shard i of N. Basins are
+    assigned to shards by longest processing time first on a cost of their
+    number of divides and bounding box area (the area sets how much forcing is
+    read, the divides how much is aggregated and written), so shards take
+    similar time rather than holding the same number of basins. The assignment
+    only depends on the basin list and their costs, which are measured once
+    and kept in `{out_dir}/basin_costs.csv`, so every job derives the same
+    shards. Each shard keeps its basin states in its own queue database in the
+    year range directory; outputs are named per basin so shards never write
+    the same file. Once all jobs ended, the verify step checks every basin
+    finished in exactly one shard and can merge the shard queues into the
+    queue of an unsharded run.
+
+    Example
+    -------
+    python sharding.py config_aorc.yaml costs
+    sbatch --array=0-9 run.slurm  # runs generate.py config_aorc.yaml --shard ${SLURM_ARRAY_TASK_ID}/10
+    python sharding.py config_aorc.yaml verify --shards 10 --merge
+"""
+import argparse
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from stores import source_fs
+from task_queue import BasinQueue
+
+# equal area projection of the hydrofabric, so bounding box areas are comparable between basins
+_AREA_CRS = "EPSG:5070"
+
+
+def parse_shard(spec):
+    """(index, count) of a 'i/N' shard spec, with 0 <= i < N"""
+    try:
+        index, count = (int(part) for part in str(spec).split("/"))
+    except ValueError:
+        raise ValueError(f"Shard {spec} is not of the form i/N, e.g. 0/10") from None
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard {spec} is out of range, i must be in [0, N)")
+    return index, count
+
+
+def shard_queue_path(out_dir, index, count):
+    """The queue database of one shard within the year range directory"""
+    return Path(out_dir) / f"processing_queue.shard{index:03d}of{count:03d}.sqlite"
+
+
+_COLUMNS = ["divides", "area_km2", "minx", "miny", "maxx", "maxy"]
+
+
+def _measure(basin, basin_url, fs):
+    gdf = gpd.read_file(fs.open(basin_url.format(basin_id=basin)), driver="gpkg", layer="divides")
+    minx, miny, maxx, maxy = gdf.to_crs(_AREA_CRS).total_bounds
+    return (basin, len(gdf), (maxx - minx) * (maxy - miny) / 1e6, *gdf.to_crs("EPSG:4326").total_bounds)
+
+
+def basin_costs(basins, basin_url, path, threads=8):
+    """
+    The divide count, bounding box area (km2) and lon/lat bounds of every basin, cached in a csv.
+
+    Only basins missing from the csv are measured, by reading their geopackage. The csv is
+    replaced atomically, so jobs that start at once may measure the same basins but never
+    read a partial file.
+
+    Parameters
+    ----------
+    basins : iterable
+        Basin ids.
+    basin_url : str
+        Template of the basin geopackage urls, formatted with basin_id.
+    path : str or Path
+        The csv of costs, e.g. `{out_dir}/basin_costs.csv`.
+    threads : int, optional
+        Geopackages read concurrently. Default 8.
+
+    Returns
+    -------
+    pd.DataFrame indexed by basin with `divides`, `area_km2` and `minx`, `miny`, `maxx`, `maxy`
+    (EPSG:4326) columns, in the order of `basins`.
+    """
+    path = Path(path)
+    basins = [str(b) for b in basins]
+    costs = pd.DataFrame(columns=_COLUMNS, index=pd.Index([], name="basin", dtype=str))
+    if path.exists():
+        costs = pd.read_csv(path, index_col="basin", dtype={"basin": str})
+        if any(col not in costs.columns for col in _COLUMNS):
+            # written before the bounds were kept, measure again
+            costs = costs.iloc[:0].reindex(columns=_COLUMNS)
+    missing = [b for b in basins if b not in costs.index]
+    if missing:
+        print(f"Measuring the divides and extent of {len(missing)} basins")
+        fs = source_fs(basin_url)
+        with ThreadPoolExecutor(threads) as pool:
+            rows = list(pool.map(lambda b: _measure(b, basin_url, fs), missing))
+        new = pd.DataFrame(rows, columns=["basin", *_COLUMNS]).set_index("basin")
+        costs = pd.concat([costs, new]) if len(costs) else new
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        costs.sort_index().to_csv(tmp)
+        os.replace(tmp, path)
+    return costs.loc[basins]
+
+
+def assign_shards(costs, count):
+    """
+    Deterministic longest processing time first assignment of basins to `count` shards.
+
+    The cost of a basin is its share of all divides plus its share of the total bounding
+    box area. Basins are taken from the most to the least costly (ties by basin id) and each
+    goes to the shard with the least cost so far (ties to the lowest shard).
+
+    Returns
+    -------
+    pd.Series of basin to shard index.
+    """
+    divides = costs["divides"].astype(float)
+    area = costs["area_km2"].astype(float)
+    cost = divides / max(divides.sum(), 1) + area / max(area.sum(), 1)
+    order = sorted(cost.index, key=lambda b: (-cost[b], b))
+    loads = np.zeros(count)
+    shards = {}
+    for b in order:
+        shard = int(np.argmin(loads))
+        shards[b] = shard
+        loads[shard] += cost[b]
+    return pd.Series(shards, name="shard").loc[costs.index]
+
+
+def shard_basins(basins, basin_url, costs_path, index, count):
+    """The basins of shard `index` of `count`, in the order given"""
+    shards = assign_shards(basin_costs(basins, basin_url, costs_path), count)
+    mine = [str(b) for b in basins if shards[str(b)] == index]
+    print(f"Shard {index}/{count}: {len(mine)} of {len(shards)} basins")
+    return mine
+
+
+def verify_shards(out_dir, basins, count, merge=False):
+    """
+    Check that every basin finished in exactly one shard queue.
+
+    Parameters
+    ----------
+    out_dir : str or Path
+        The year range directory holding the shard queues.
+    basins : iterable
+        Every basin that should have been processed.
+    count : int
+        Number of shards.
+    merge : bool, optional
+        Mark the finished basins as done in `{out_dir}/processing_queue.sqlite`, the queue of an
+        unsharded run. Default False.
+
+    Returns
+    -------
+    bool, True if every basin finished exactly once.
+    """
+    finished, states = {}, {}
+    for index in range(count):
+        path = shard_queue_path(out_dir, index, count)
+        if not path.exists():
+            print(f"Shard {index}/{count} has no queue at {path}")
+            continue
+        # read only, so a verify during the run does not lock the shard's queue
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        for basin, state in db.execute("SELECT basin, state FROM tasks"):
+            states.setdefault(basin, []).append((index, state))
+            if state == "done":
+                finished.setdefault(basin, []).append(index)
+        db.close()
+    basins = [str(b) for b in basins]
+    missing = [b for b in basins if b not in states]
+    unfinished = [b for b in basins if b in states and b not in finished]
+    repeated = {b: shards for b, shards in finished.items() if len(shards) > 1}
+    print(f"{len(basins) - len(missing) - len(unfinished)} of {len(basins)} basins finished")
+    for b in missing:
+        print(f"Basin {b} is in no shard queue")
+    for b in unfinished:
+        print(f"Basin {b} did not finish: " + ", ".join(f"{state} in shard {i}" for i, state in states[b]))
+    for b, shards in repeated.items():
+        print(f"Basin {b} finished in shards {shards}")
+    if merge:
+        queue = BasinQueue(Path(out_dir) / "processing_queue.sqlite")
+        queue.mark_done([b for b in basins if b in finished])
+        queue.summary()
+        queue.close()
+    return not (missing or unfinished or repeated)
+
+
+if __name__ == "__main__":
+    import yaml
+
+    from generate import list_basins
+
+    parser = argparse.ArgumentParser(description="Measure basin costs for sharding, or verify the shards of a run.")
+    parser.add_argument("config_path", type=str, help="Path to the YAML configuration file of generate.py")
+    parser.add_argument("step", choices=["costs", "verify"], help="'costs' measures every basin once before the jobs start, 'verify' checks the shards after they ended")
+    parser.add_argument("--shards", type=int, help="Number of shards of the run, for verify")
+    parser.add_argument("--merge", action="store_true", help="Merge the finished basins into the queue of an unsharded run")
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as file:
+        config = yaml.safe_load(file)
+    out_root = Path(config["out_dir"].format(home_dir=str(Path.home())))
+    basins = list_basins(config["basins"], config["basin_url_template"])
+    if args.step == "costs":
+        costs = basin_costs(basins, config["basin_url_template"], out_root / "basin_costs.csv")
+        print(f"{len(costs)} basins, {int(costs['divides'].sum())} divides")
+        sys.exit(0)
+    if args.shards is None:
+        parser.error("verify requires --shards")
+    year_str = "_to_".join(str(y) for y in config["years"])
+    sys.exit(0 if verify_shards(out_root / year_str, basins, args.shards, args.merge) else 1)
@@ -0,0 +1,329 @@
+"""stores.py
+    Module for opening the zarr stores of AORC and HRRR, with an optional local chunk cache
+
+    A store root may be an s3 url (e.g. 's3://noaa-nws-aorc-v1-1-1km/1980.zarr') or
+    a local directory holding the same layout, so the pipeline can also run
+    offline against a local stand-in of the buckets. With a ChunkCache, every
+    key (chunk or metadata) read from a store is kept on local disk, bounded in
+    size with least recently used eviction, so reruns do not download the same
+    chunks again. With the consolidated metadata of a store (see
+    hrrr_metadata.py), its metadata keys are answered locally as well.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections.abc import MutableMapping
+from pathlib import Path
+
+import fsspec
+import s3fs
+import zarr
+
+ZARR3 = int(zarr.__version__.split(".")[0]) >= 3
+
+
+def is_s3(url):
+    return str(url).startswith("s3://")
+
+
+def source_fs(root):
+    """The filesystem of a data source root: anonymous s3 for s3 urls, otherwise the local filesystem"""
+    if is_s3(root):
+        return s3fs.S3FileSystem(anon=True)
+    return fsspec.filesystem("file")
+
+
+# Hit/miss counters of this process by cache root, shared by the copies of a cache unpickled
+# in worker processes or dask tasks, so take_counts collects all reads of a worker
+_counters = {}
+_counters_lock = threading.Lock()
+
+
+class ChunkCache:
+    """
+    On disk cache of zarr store keys with a size limit and hit/miss counters.
+
+    Entries are files named after a hash of the store root and key. Hits touch
+    the file, and once the cache exceeds `max_gb` the least recently used
+    entries are evicted. The counters are kept per process, see take_counts and
+    add_counts to report those of worker processes.
+
+    Parameters
+    ----------
+    root : str or Path
+        Directory of the cache, may be shared by runs and processes.
+    max_gb : float, optional
+        Size limit of the cache in GB. Default None means unbounded.
+    """
+
+    def __init__(self, root, max_gb=None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = None if max_gb is None else int(max_gb * 1e9)
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _count(self, hits=0, misses=0, bytes_read=0):
+        with _counters_lock:
+            counts = _counters.setdefault(str(self.root), [0, 0, 0])
+            counts[0] += hits
+            counts[1] += misses
+            counts[2] += bytes_read
+
+    def counts(self):
+        """(hits, misses, bytes read) of this process"""
+        with _counters_lock:
+            return tuple(_counters.get(str(self.root), (0, 0, 0)))
+
+    def take_counts(self):
+        """The counts of this process, reset to zero, e.g. returned by a worker process to add_counts"""
+        with _counters_lock:
+            return tuple(_counters.pop(str(self.root), (0, 0, 0)))
+
+    def add_counts(self, counts):
+        """Add the counts taken in another process"""
+        if counts is not None:
+            self._count(*counts)
+
+    def take_worker_counts(self, client):
+        """Add the counts of the workers of a dask.distributed `client`"""
+        for counts in client.run(self.take_counts).values():
+            self.add_counts(counts)
+
+    def _path(self, store_id, key):
+        h = hashlib.sha256(f"{store_id}/{key}".encode()).hexdigest()
+        return self.root / h[:2] / h
+
+    def get(self, store_id, key):
+        """The cached bytes of `key` in the store `store_id`, or None"""
+        path = self._path(store_id, key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self._count(misses=1)
+            return None
+        try:
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self._count(hits=1, bytes_read=len(data))
+        return data
+
+    def put(self, store_id, key, data):
+        """Cache the bytes of `key` atomically, then evict old entries if over the limit"""
+        path = self._path(store_id, key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(file.stat().st_size for file in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        return (file for file in self.root.glob("*/*") if not file.name.endswith(".tmp"))
+
+    def _evict(self):
+        entries = []
+        for file in self._entries():
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+        self._size = sum(e[1] for e in entries)
+        # evict down to 90% of the limit, so eviction does not run on every put
+        for _, size, file in sorted(entries, key=lambda e: e[0]):
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            file.unlink(missing_ok=True)
+            self._size -= size
+
+    def summary(self):
+        """Print the hit/miss counters of this process, including those added from workers"""
+        hits, misses, bytes_read = self.counts()
+        total = hits + misses
+        rate = hits / total if total else 0
+        print(
+            f"Chunk cache {self.root}: {hits} hits, {misses} misses ({rate:.0%} hit rate), "
+            f"{bytes_read / 1e9:.2f} GB read from the cache"
+        )
+
+
+class CachedMapping(MutableMapping):
+    """A zarr (v2) store mapping that reads through a ChunkCache"""
+
+    def __init__(self, store, cache, store_id):
+        self.store = store
+        self.cache = cache
+        self.store_id = store_id
+
+    def __getitem__(self, key):
+        data = self.cache.get(self.store_id, key)
+        if data is None:
+            data = self.store[key]
+            self.cache.put(self.store_id, key, bytes(data))
+        return data
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __setitem__(self, key, value):
+        self.store[key] = value
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+
+def _metadata_keys(metadata):
+    """The bytes of `.zmetadata` and of every key it consolidates"""
+    keys = {key: json.dumps(value).encode() for key, value in metadata["metadata"].items()}
+    keys[".zmetadata"] = json.dumps(metadata).encode()
+    return keys
+
+
+class IndexedMapping(MutableMapping):
+    """A zarr (v2) store mapping that answers the metadata keys from consolidated metadata held locally"""
+
+    def __init__(self, store, metadata):
+        self.store = store
+        self.keys_local = _metadata_keys(metadata)
+
+    def __getitem__(self, key):
+        if key in self.keys_local:
+            return self.keys_local[key]
+        return self.store[key]
+
+    def __contains__(self, key):
+        return key in self.keys_local or key in self.store
+
+    def __setitem__(self, key, value):
+        self.store[key] = value
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+
+if ZARR3:
+    from zarr.storage import WrapperStore
+
+    class CachedStore(WrapperStore):
+        """A zarr store that reads whole keys through a ChunkCache"""
+
+        def __init__(self, store, cache, store_id):
+            super().__init__(store)
+            self.cache = cache
+            self.store_id = store_id
+
+        def _with_store(self, store):
+            return type(self)(store, self.cache, self.store_id)
+
+        async def get(self, key, prototype, byte_range=None):
+            if byte_range is not None:
+                return await self._store.get(key, prototype, byte_range)
+            data = self.cache.get(self.store_id, key)
+            if data is not None:
+                return prototype.buffer.from_bytes(data)
+            buf = await self._store.get(key, prototype)
+            if buf is not None:
+                self.cache.put(self.store_id, key, buf.to_bytes())
+            return buf
+
+    class IndexedStore(WrapperStore):
+        """A zarr store that answers the metadata keys from consolidated metadata held locally"""
+
+        def __init__(self, store, metadata):
+            super().__init__(store)
+            self.metadata = metadata
+            self.keys_local = _metadata_keys(metadata)
+
+        def _with_store(self, store):
+            return type(self)(store, self.metadata)
+
+        async def get(self, key, prototype, byte_range=None):
+            if key in self.keys_local and byte_range is None:
+                return prototype.buffer.from_bytes(self.keys_local[key])
+            if key == "zarr.json":
+                # the indexed stores are zarr v2, no need to probe for v3 metadata
+                return None
+            return await self._store.get(key, prototype, byte_range)
+
+        async def exists(self, key):
+            if key == "zarr.json":
+                return False
+            return key in self.keys_local or await self._store.exists(key)
+
+
+def open_store(url, fs=None, cache=None, metadata=None):
+    """
+    A zarr store for `url` that xarray can open, read through `cache` if given.
+
+    Parameters
+    ----------
+    url : str
+        Root of the zarr store, an s3 url (the 's3://' may be omitted when `fs` is an
+        S3FileSystem, as in the results of its ls) or a local path.
+    fs : fsspec.AbstractFileSystem, optional
+        The filesystem of the url. Default None uses source_fs(url).
+    cache : ChunkCache, optional
+        Local cache of the store's keys. Default None reads directly from the source.
+    metadata : dict, optional
+        The consolidated metadata of the store (the content of a `.zmetadata`), e.g. from
+        hrrr_metadata.HrrrMetadataIndex. Its keys are answered locally, so xarray opens the
+        store from it without reading any metadata key. Default None reads them from the source.
+
+    Returns
+    -------
+    A store accepted by xr.open_dataset/open_mfdataset(engine='zarr')
+    """
+    if fs is None:
+        fs = source_fs(url)
+    local = not isinstance(fs, s3fs.S3FileSystem)
+    if cache is None and metadata is None:
+        return str(url) if local else s3fs.S3Map(root=url, s3=fs, check=False)
+    store_id = str(url).removeprefix("s3://").rstrip("/")
+    if not ZARR3:
+        store = fsspec.get_mapper(str(url)) if local else s3fs.S3Map(root=url, s3=fs, check=False)
+        if cache is not None:
+            store = CachedMapping(store, cache, store_id)
+        return store if metadata is None else IndexedMapping(store, metadata)
+    from zarr.storage import FsspecStore, LocalStore
+
+    if local:
+        store = LocalStore(str(url), read_only=True)
+    else:
+        store = FsspecStore.from_mapper(s3fs.S3Map(root=url, s3=fs, check=False), read_only=True)
+    if cache is not None:
+        store = CachedStore(store, cache, store_id)
+    return store if metadata is None else IndexedStore(store, metadata)
+
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""subset.py
+    Clip the forcing to the (padded) bounding box of a basin or VPU once and
+    store it time-major in a local zarr store
+
+    The AORC yearly zarrs are chunked for spatial access, so reading a small
+    window over decades costs many small chunk reads per year. The subset store
+    holds the whole window in each chunk and many hours per chunk, so repeated
+    runs over the same area (new hydrofabric versions, weight methods or
+    variable sets) read contiguous local time series instead. Pass the store
+    path to process_geo_data as `data`, or set `forcing_store` in the config of
+    generate.py.
+
+    Example
+    -------
+    python subset.py config_aorc.yaml --gpkg /path/to/vpu.gpkg --out /path/to/vpu.zarr
+    python subset.py config_aorc.yaml --basin 1022500 --out /path/to/1022500.zarr
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+from dask.diagnostics import ProgressBar
+
+
+def _window(coords, lo, hi, pad):
+    """Index slice of the coordinates within [lo, hi], padded by `pad` cells on each side"""
+    inside = np.flatnonzero((coords >= lo) & (coords <= hi))
+    if inside.size == 0:
+        # bounds narrower than a cell, use the nearest cell
+        inside = np.array([np.abs(coords - (lo + hi) / 2).argmin()])
+    return slice(max(inside[0] - pad, 0), min(inside[-1] + pad + 1, coords.size))
+
+
+def subset_forcing(data, extent, y_lat_dim, x_lon_dim, out, pad=2, chunk_mb=64):
+    """
+    Write the forcing within a padded bounding box to a time-major local zarr store.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        Xarray dataset of raster data, e.g. generate.open_forcing.
+    extent : array-like
+        (minx, miny, maxx, maxy) bounding box in the crs of `data`, e.g. gdf.total_bounds.
+    y_lat_dim : str
+        The latitude identifier in the xarray dataset `data`.
+    x_lon_dim : str
+        The longitude identifier in the xarray dataset `data`.
+    out : str or Path
+        The zarr store to write.
+    pad : int, optional
+        Number of grid cells added around the bounding box, so weights of cells on its edge can
+        be computed. Default 2.
+    chunk_mb : float, optional
+        Size in MB of a chunk of one variable. Each chunk holds the whole window, and as many
+        hours as fit. Default 64.
+
+    Returns
+    -------
+    xr.Dataset of the store
+    """
+    sub = data.isel({
+        x_lon_dim: _window(data[x_lon_dim].values, extent[0], extent[2], pad),
+        y_lat_dim: _window(data[y_lat_dim].values, extent[1], extent[3], pad),
+    })
+    itemsize = max(sub[name].dtype.itemsize for name in sub.data_vars)
+    cells = sub[y_lat_dim].size * sub[x_lon_dim].size
+    ctime = int(min(max(chunk_mb * 1e6 // (cells * itemsize), 1), sub["time"].size))
+    sub = sub.chunk({"time": ctime, y_lat_dim: -1, x_lon_dim: -1})
+    for name in sub.variables:
+        # the chunking and encoding of the source do not apply to the subset
+        sub[name].encoding = {}
+    sub.attrs["subset_bounds"] = [float(b) for b in extent]
+    sub.attrs["subset_pad"] = pad
+    print(
+        f"Writing {sub['time'].size} time steps over a {sub[y_lat_dim].size} x {sub[x_lon_dim].size} window "
+        f"to {out} in chunks of {ctime} time steps"
+    )
+    with ProgressBar():
+        sub.to_zarr(out, mode="w", consolidated=True)
+    return open_subset(out)
+
+
+def open_subset(path):
+    """Lazily open a subset store, chunked as stored"""
+    return xr.open_zarr(path, consolidated=True)
+
+
+def check_within(gdf, data, y_lat_dim, x_lon_dim, path=""):
+    """Raise a ValueError if the catchments extend beyond the grid of a subset store"""
+    extent = gdf.total_bounds
+    for dim, lo, hi in [(x_lon_dim, extent[0], extent[2]), (y_lat_dim, extent[1], extent[3])]:
+        coords = data[dim].values
+        if lo < coords.min() or hi > coords.max():
+            raise ValueError(
+                f"The catchments extend beyond the subset store {path} along {dim}, "
+                f"create a subset for their bounding box with subset.py"
+            )
+
+
+if __name__ == "__main__":
+    import geopandas as gpd
+    import yaml
+
+    from generate import open_forcing
+    from stores import source_fs
+
+    parser = argparse.ArgumentParser(description="Clip the AORC forcing to a bounding box into a time-major local zarr store.")
+    parser.add_argument("config_path", type=str, help="Path to the YAML configuration file of generate.py")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--gpkg", type=str, help="Geopackage (e.g. a VPU) whose divides bound the subset")
+    group.add_argument("--basin", type=str, help="Basin id read with basin_url_template")
+    parser.add_argument("--out", type=str, required=True, help="The zarr store to write")
+    parser.add_argument("--pad", type=int, default=2, help="Grid cells added around the bounding box")
+    parser.add_argument("--chunk_mb", type=float, default=64, help="Size in MB of a chunk of one variable")
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as file:
+        config = yaml.safe_load(file)
+    forcing = open_forcing(config["aorc_source"], config["aorc_year_url_template"], tuple(config["years"]))
+    proj = forcing[next(iter(forcing.keys()))].crs
+    if args.gpkg is not None:
+        gdf = gpd.read_file(args.gpkg, driver="gpkg", layer="divides")
+    else:
+        url = config["basin_url_template"].format(basin_id=args.basin)
+        gdf = gpd.read_file(source_fs(url).open(url), driver="gpkg", layer="divides")
+    gdf = gdf.to_crs(proj)
+    subset_forcing(forcing, gdf.total_bounds, config["y_lat_dim"], config["x_lon_dim"], Path(args.out), args.pad, args.chunk_mb)
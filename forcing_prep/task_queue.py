@@ -0,0 +1,225 @@
+"""task_queue.py
+    Module for a durable, crash resumable queue of basins to process
+
+    Basin states live in a SQLite database (pending, running, done, failed)
+    along with timing and retry counts. Only the scheduling process writes to
+    the database, so basins interrupted by a crash are left 'running' and are
+    picked up again, together with failed basins, on the next start.
+"""
+
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from pathlib import Path
+
+STATES = ("pending", "running", "done", "failed")
+
+
+class BasinQueue:
+    """
+    SQLite backed queue of basins.
+
+    Parameters
+    ----------
+    path : str or Path
+        The SQLite database file, e.g. `{out_dir}/processing_queue.sqlite`.
+    max_retries : int, optional
+        How many times a failed basin is retried within a run. Default 2.
+    """
+
+    def __init__(self, path, max_retries=2):
+        self.path = Path(path)
+        self.max_retries = max_retries
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS tasks (
+                basin TEXT PRIMARY KEY,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                started REAL,
+                finished REAL,
+                seconds REAL,
+                error TEXT
+            )"""
+        )
+
+    def add(self, basins):
+        """Queue basins that are not already known"""
+        self.db.executemany(
+            "INSERT OR IGNORE INTO tasks (basin) VALUES (?)", [(str(b),) for b in basins]
+        )
+
+    def import_log(self, log_file, basins=None):
+        """Mark the basins finished in a legacy processing_log.txt as done, only those of `basins` if given (e.g. a shard)"""
+        log_file = Path(log_file)
+        if not log_file.exists():
+            return
+        with open(log_file, "r") as file:
+            finished = [line.split(":")[0] for line in file.read().splitlines() if line.endswith(": finished")]
+        if basins is not None:
+            keep = {str(b) for b in basins}
+            finished = [b for b in finished if b in keep]
+        self.mark_done(finished)
+
+    def mark_done(self, basins):
+        """Record basins finished elsewhere (e.g. a legacy log or the queue of a shard) as done"""
+        self.add(basins)
+        self.db.executemany("UPDATE tasks SET state = 'done' WHERE basin = ?", [(str(b),) for b in basins])
+
+    def recover(self):
+        """Requeue basins interrupted by a crash ('running') and those that failed previously, with fresh retries"""
+        cur = self.db.execute(
+            "UPDATE tasks SET state = 'pending', "
+            "attempts = CASE state WHEN 'failed' THEN 0 ELSE attempts END "
+            "WHERE state IN ('running', 'failed')"
+        )
+        if cur.rowcount:
+            print(f"Requeued {cur.rowcount} interrupted or failed basins")
+
+    def claim(self):
+        """Atomically mark the next pending basin as running and return it, or None if there is none"""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute(
+                "SELECT basin FROM tasks WHERE state = 'pending' ORDER BY rowid LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                self.db.execute(
+                    "UPDATE tasks SET state = 'running', attempts = attempts + 1, started = ?, "
+                    "finished = NULL, error = NULL WHERE basin = ?",
+                    (time.time(), row[0]),
+                )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return None if row is None else row[0]
+
+    def done(self, basin):
+        now = time.time()
+        self.db.execute(
+            "UPDATE tasks SET state = 'done', finished = ?, seconds = ? - started WHERE basin = ?",
+            (now, now, basin),
+        )
+
+    def fail(self, basin, error):
+        """Mark a basin failed, or back to pending if it has retries left"""
+        now = time.time()
+        attempts = self.db.execute("SELECT attempts FROM tasks WHERE basin = ?", (basin,)).fetchone()[0]
+        state = "pending" if attempts <= self.max_retries else "failed"
+        self.db.execute(
+            "UPDATE tasks SET state = ?, finished = ?, seconds = ? - started, error = ? WHERE basin = ?",
+            (state, now, now, str(error), basin),
+        )
+        print(f"Basin {basin} failed on attempt {attempts}" + (", retrying" if state == "pending" else "") + f": {error}")
+
+    def release(self, basin):
+        """Put a running basin back to pending without counting the attempt (e.g. its worker process was lost)"""
+        self.db.execute(
+            "UPDATE tasks SET state = 'pending', attempts = MAX(attempts - 1, 0), started = NULL WHERE basin = ?",
+            (basin,),
+        )
+
+    def counts(self):
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.db.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+        return counts
+
+    def summary(self):
+        """Print the number of basins in each state and the processing times"""
+        counts = self.counts()
+        total, mean = self.db.execute(
+            "SELECT SUM(seconds), AVG(seconds) FROM tasks WHERE state = 'done'"
+        ).fetchone()
+        print(", ".join(f"{n} {state}" for state, n in counts.items()))
+        if total is not None:
+            print(f"{total / 3600:.2f} hours of basin processing, {mean / 60:.1f} minutes per basin")
+        for basin, error in self.db.execute("SELECT basin, error FROM tasks WHERE state = 'failed'"):
+            print(f"Basin {basin} failed: {error}")
+
+    def close(self):
+        self.db.close()
+
+
+def run_queue(queue, func, args=(), workers=1, initializer=None, initargs=(), collect=None):
+    """
+    Process every pending basin with `func(basin, *args)`, running up to `workers` basins concurrently.
+
+    With more than one worker each basin runs in a separate (spawned) process, prepared by
+    `initializer(*initargs)`. Basin states are only written by this process. The return value
+    of every basin that finishes is passed to `collect`, if given.
+
+    When a worker process dies (e.g. killed out of memory) the pool is restarted. The basins
+    running at the time are put back to pending without counting the attempt, as the one that
+    killed the worker is not known, and each of them is then run alone: a basin that kills its
+    worker while running alone fails that attempt.
+    """
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        while (basin := queue.claim()) is not None:
+            try:
+                result = func(basin, *args)
+            except Exception as e:
+                queue.fail(basin, repr(e))
+            else:
+                queue.done(basin)
+                if collect is not None:
+                    collect(result)
+        return
+
+    # Basins running when a worker process died, each run alone until it finishes
+    suspects = set()
+    while True:
+        pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_context("spawn"), initializer=initializer, initargs=initargs
+        )
+        running = {}
+        broken = False
+        try:
+            while not broken:
+                while len(running) < workers and not suspects & set(running.values()):
+                    basin = queue.claim()
+                    if basin is None:
+                        break
+                    if basin in suspects and running:
+                        # wait for the others to finish first
+                        queue.release(basin)
+                        break
+                    try:
+                        running[pool.submit(func, basin, *args)] = basin
+                    except BrokenProcessPool:
+                        queue.release(basin)
+                        broken = True
+                        break
+                if not running:
+                    if broken:
+                        break
+                    return
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        # every running basin fails this way, left in `running` to requeue
+                        broken = True
+                        continue
+                    except Exception as e:
+                        queue.fail(running[future], repr(e))
+                    else:
+                        queue.done(running[future])
+                        if collect is not None:
+                            collect(result)
+                    suspects.discard(running.pop(future))
+            # The pool is broken: a worker process died
+            if len(running) == 1:
+                # the only basin running killed its worker, it stays a suspect for its retries
+                queue.fail(running.popitem()[1], "BrokenProcessPool: the worker process died")
+            print("A worker process died, restarting the pool" + (f" and requeueing {len(running)} running basins" if running else ""))
+            for basin in running.values():
+                queue.release(basin)
+                suspects.add(basin)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -10,9 +10,11 @@
     0.1
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
 import dask
-import dask.array as da
-import dask.dataframe as ddf
 import geopandas as gpd
 import numpy as np
 import pandas as pd
@@ -22,17 +24,116 @@ from exactextract import exact_extract
 dask.config.set({"dataframe.convert-string": False})
 
 
-def get_weights_df(gdf: gpd.GeoDataFrame, raster: xr.DataArray,id_col:str = 'divide_id') -> pd.DataFrame:
-    """Get the coverage weights of the given raster for each feature"""
-    stats = ["cell_id", "coverage"]
+def grid_template(data: xr.Dataset, y_lat_dim: str, x_lon_dim: str) -> xr.DataArray:
+    """
+    A zero raster on the grid of `data`, for computing weights without reading any data.
+
+    Built from the 1-D coordinates, the attributes of the first variable and the
+    scalar coordinates (e.g. spatial_ref), which carry the CRS.
+    """
+    var = data[next(iter(data.data_vars))]
+    coords = {dim: data[dim] for dim in (y_lat_dim, x_lon_dim)}
+    coords.update({name: coord for name, coord in var.coords.items() if coord.ndim == 0 and name != "time"})
+    return xr.DataArray(
+        np.zeros((data[y_lat_dim].size, data[x_lon_dim].size), dtype=np.float32),
+        coords=coords,
+        dims=(y_lat_dim, x_lon_dim),
+        attrs=var.attrs,
+    )
+
+
+def cell_window(data, extent, y_lat_dim, x_lon_dim):
+    """
+    Index slices of every grid cell whose extent intersects the bounding box `extent`.
+
+    Worked out from the coordinates alone, assuming cells centred on regularly spaced coordinates.
+    """
+    window = {}
+    for dim, lo, hi in [(x_lon_dim, extent[0], extent[2]), (y_lat_dim, extent[1], extent[3])]:
+        coords = data[dim].values
+        half = np.abs(coords[1] - coords[0]) / 2 if coords.size > 1 else 0
+        inside = np.flatnonzero((coords + half >= lo) & (coords - half <= hi))
+        if inside.size == 0:
+            raise ValueError(f"The catchments are outside of the grid along {dim}")
+        window[dim] = slice(inside[0], inside[-1] + 1)
+    return window
+
+
+def _extract(gdf, raster, id_col):
     # raster must be xarray.core.dataarray.DataArray or list thereof
-    output = exact_extract(
+    return exact_extract(
         raster,
         gdf,
-        stats,
+        ["cell_id", "coverage"],
         include_cols=[id_col],
         output="pandas",
     )
+
+
+# the raster of the processes of _tiled_extract, sent once per process
+_raster = None
+
+
+def _init_raster(raster):
+    global _raster
+    _raster = raster
+
+
+def _extract_tile(gdf, id_col):
+    return _extract(gdf, _raster, id_col)
+
+
+def _nearest(coords, values):
+    """Index of the coordinate nearest to every value, for monotonic coordinates"""
+    if coords.size > 1 and coords[0] > coords[-1]:
+        return coords.size - 1 - _nearest(coords[::-1], values)
+    idx = np.clip(np.searchsorted(coords, values), 1, max(coords.size - 1, 1))
+    return np.where(np.abs(values - coords[idx - 1]) <= np.abs(values - coords[idx]), idx - 1, idx)
+
+
+def _tiled_extract(gdf, raster, id_col, workers, tile_cells):
+    """
+    exact_extract in a process pool, over tiles of `tile_cells` x `tile_cells` cells.
+
+    Every feature goes to the tile of its representative point, so features that
+    cross tile edges are extracted whole, exactly once. Each process extracts the
+    features of a tile against the same (zero, so cheap) raster as a single
+    exact_extract would, which keeps the cell grid and so the coverage bit for bit
+    identical; cropping the raster per tile would shift the cell edges by rounding.
+    """
+    y_dim, x_dim = raster.dims[-2:]
+    points = gdf.geometry.representative_point()
+    ty = _nearest(raster[y_dim].values, points.y.values) // tile_cells
+    tx = _nearest(raster[x_dim].values, points.x.values) // tile_cells
+    rows = np.arange(len(gdf))
+    tiles = [rows[(ty == tile[0]) & (tx == tile[1])] for tile in np.unique(np.stack([ty, tx], axis=1), axis=0)]
+    if len(tiles) == 1:
+        return _extract(gdf, raster, id_col)
+    print(f"Computing weights over {len(tiles)} tiles with {workers} processes")
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(tiles)), mp_context=get_context("spawn"), initializer=_init_raster, initargs=(raster,)
+    ) as pool:
+        futures = [pool.submit(_extract_tile, gdf.iloc[members], id_col) for members in tiles]
+        outputs = [future.result() for future in futures]
+    # back to the order of the features, as from a single exact_extract
+    order = np.argsort(np.concatenate(tiles), kind="stable")
+    return pd.concat(outputs, ignore_index=True).iloc[order].reset_index(drop=True)
+
+
+def get_weights_df(gdf: gpd.GeoDataFrame, raster: xr.DataArray,id_col:str = 'divide_id', workers: int = None, tile_cells: int = 256) -> pd.DataFrame:
+    """
+    Get the coverage weights of the given raster for each feature
+
+    With `workers` > 1 the features are split into tiles of `tile_cells` x `tile_cells`
+    raster cells that are extracted in a pool of `workers` processes, with the same
+    result as a single exact_extract.
+    """
+    # more processes than cores only adds start up and pickling time
+    workers = min(workers, os.cpu_count() or 1) if workers is not None else None
+    if workers is not None and workers > 1 and len(gdf) > 1:
+        output = _tiled_extract(gdf, raster, id_col, workers, tile_cells)
+    else:
+        output = _extract(gdf, raster, id_col)
     output.set_index(id_col, inplace=True)
     # Some features may have no coverage, in that case warn the user
     # and for now just do a nearest neighbor assignment so they have
@@ -69,23 +170,31 @@ def get_weights_df(gdf: gpd.GeoDataFrame, raster: xr.DataArray,id_col:str = 'div
     return output
 
 
-def _build_index(series, global_shape):
+def _build_index(weights_df, global_shape):
     """
-    From a given exact exact feature coverage row, unstack the encapsulated
-    arrays and add an unraveled index based on global_shape
+    Flatten the per feature exact extract `cell_id`/`coverage` arrays into
+    one long coverage table keyed on the feature id, with an unraveled index
+    based on global_shape.
     """
-    all = []
-    for _, series in series.iterrows():
-        cells = series["cell_id"]
-        ids = pd.Series(da.from_array(cells), name="ids")
-        cov = pd.Series(da.from_array(series["coverage"]), name="coverage")
-        global_idx = np.unravel_index(cells, global_shape)
-        idy = pd.Series(da.from_array(global_idx[0]), name="global_idx_y")
-        idx = pd.Series(da.from_array(global_idx[1]), name="global_idx_x")
-        did = pd.Series([series.name] * len(cells), name="divide_id")
-        df = pd.concat([ids, cov, idy, idx, did], axis=1).set_index("divide_id")
-        all.append(df)
-    return pd.concat(all)
+    cells = weights_df["cell_id"].values
+    lengths = np.fromiter((c.size for c in cells), dtype=np.int64, count=len(cells))
+    if lengths.sum() > 0:
+        ids = np.concatenate(cells).astype(np.int32)
+        cov = np.concatenate(weights_df["coverage"].values).astype(np.float32)
+    else:
+        ids = np.empty(0, dtype=np.int32)
+        cov = np.empty(0, dtype=np.float32)
+    global_idx = np.unravel_index(ids, global_shape)
+    index = pd.Index(np.repeat(weights_df.index.values, lengths), name="divide_id")
+    return pd.DataFrame(
+        {
+            "ids": ids,
+            "coverage": cov,
+            "global_idx_y": global_idx[0].astype(np.int32),
+            "global_idx_x": global_idx[1].astype(np.int32),
+        },
+        index=index,
+    )
 
 
 def get_all_cov(dataset, weights_df,y_lat_dim = 'latitude', x_lon_dim = 'longitude'):
@@ -94,17 +203,6 @@ def get_all_cov(dataset, weights_df,y_lat_dim = 'latitude', x_lon_dim = 'longitu
     into flat dataframe keyed on divide_id. This dataframe also has the x,y
     raveled indicies for cell_id based on the extent of the provided dataset
     """
-    # TODO allow npartitions to be more configurable
-    dask_weights = ddf.from_pandas(weights_df, npartitions=8)
-    meta = {
-        "ids": np.int64,
-        "coverage": float,
-        "global_idx_y": np.int64,
-        "global_idx_x": np.int64,
-    }
-    all = dask_weights.map_partitions(
-        _build_index, (dataset[y_lat_dim].size, dataset[x_lon_dim].size), meta=meta
+    return _build_index(
+        weights_df, (dataset[y_lat_dim].size, dataset[x_lon_dim].size)
     )
-    all = all.compute()
-
-    return all
@@ -0,0 +1,150 @@
+"""weights_store.py
+    Module for a shared, content addressed store of coverage weights
+
+    Coverage tables are keyed on a fingerprint of the raster grid (coordinates,
+    CRS and therefore slice origin) and a hash of the catchment geometries, so
+    a cached entry is reused whenever both inputs match (e.g. across AORC year
+    ranges, HRRR days and repeated runs) and rebuilt whenever either changes.
+    The store is bounded in size with least recently used eviction.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def _grid_crs(data):
+    """Collect whatever CRS description the dataset carries"""
+    crs = [str(data.attrs.get("crs", ""))]
+    for name in data.data_vars:
+        crs.append(str(data[name].attrs.get("crs", "")))
+        break
+    for name in ["spatial_ref", "crs"]:
+        if name in data.coords:
+            attrs = data.coords[name].attrs
+            crs.append(str(attrs.get("crs_wkt", attrs.get("spatial_ref", ""))))
+    return "|".join(crs)
+
+
+def grid_fingerprint(data, y_lat_dim, x_lon_dim):
+    """Hash the grid definition (coordinates and CRS) of a raster dataset"""
+    h = hashlib.sha256()
+    for dim in (y_lat_dim, x_lon_dim):
+        h.update(dim.encode())
+        h.update(np.ascontiguousarray(data[dim].values, dtype=np.float64).tobytes())
+    h.update(_grid_crs(data).encode())
+    return h.hexdigest()
+
+
+def geometry_hash(gdf, id_col="divide_id"):
+    """Hash the ids, CRS and geometries of a geodataframe, independent of row order"""
+    gdf = gdf.sort_values(id_col)
+    h = hashlib.sha256()
+    h.update(id_col.encode())
+    h.update(str(gdf.crs.to_wkt() if gdf.crs is not None else "").encode())
+    for id, wkb in zip(gdf[id_col].astype(str), gdf.geometry.to_wkb()):
+        h.update(id.encode())
+        h.update(wkb)
+    return h.hexdigest()
+
+
+def grid_extent(data, y_lat_dim, x_lon_dim):
+    """Describe the grid of a raster for a WeightStore entry"""
+    return {
+        dim: [float(data[dim].values[0]), float(data[dim].values[-1]), int(data[dim].size)]
+        for dim in (y_lat_dim, x_lon_dim)
+    }
+
+
+def weights_key(data, gdf, y_lat_dim, x_lon_dim, id_col="divide_id"):
+    """The content address of the weights of `gdf` over the grid of `data`"""
+    h = hashlib.sha256()
+    h.update(grid_fingerprint(data, y_lat_dim, x_lon_dim).encode())
+    h.update(geometry_hash(gdf, id_col).encode())
+    return h.hexdigest()[:32]
+
+
+class WeightStore:
+    """
+    On disk store of coverage tables keyed on grid and geometry.
+
+    Each entry is a `{key}.parquet` coverage table and a `{key}.json` sidecar
+    describing the grid the coverage indices refer to. Entries are touched
+    on read and the least recently used ones are evicted once the store
+    exceeds `max_gb`.
+
+    Parameters
+    ----------
+    root : str or Path
+        Directory holding the store, shared by all runs.
+    max_gb : float, optional
+        Size limit of the store in GB. Default None means unbounded.
+    """
+
+    def __init__(self, root, max_gb=None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = None if max_gb is None else int(max_gb * 1e9)
+
+    def key(self, data, gdf, y_lat_dim, x_lon_dim, id_col="divide_id"):
+        """The content address of the weights of `gdf` over the grid of `data`"""
+        return weights_key(data, gdf, y_lat_dim, x_lon_dim, id_col)
+
+    def _paths(self, key):
+        return self.root / f"{key}.parquet", self.root / f"{key}.json"
+
+    def get(self, key):
+        """
+        Return (coverage, grid) for key, or None if the store has no entry.
+        `grid` maps each dimension to the [first, last, size] of the coordinates
+        of the raster the coverage indices were built against.
+        """
+        table, meta = self._paths(key)
+        if not (table.exists() and meta.exists()):
+            return None
+        with open(meta, "r") as file:
+            grid = json.load(file)
+        coverage = pd.read_parquet(table)
+        # mark as recently used
+        os.utime(table)
+        return coverage, grid
+
+    def put(self, key, coverage, grid):
+        """Write an entry atomically, then evict old entries if over the limit"""
+        table, meta = self._paths(key)
+        tmp = table.with_name(f"{table.name}.{os.getpid()}.tmp")
+        coverage.to_parquet(tmp)
+        os.replace(tmp, table)
+        tmp = meta.with_name(f"{meta.name}.{os.getpid()}.tmp")
+        with open(tmp, "w") as file:
+            json.dump(grid, file)
+        os.replace(tmp, meta)
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for table in self.root.glob("*.parquet"):
+            meta = table.with_suffix(".json")
+            try:
+                stat = table.stat()
+                size = stat.st_size + (meta.stat().st_size if meta.exists() else 0)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, size, table, meta))
+        total = sum(e[1] for e in entries)
+        for _, size, table, meta in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            if table.stem == keep:
+                continue
+            print(f"Evicting weights {table.stem} from {self.root}")
+            table.unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+            total -= size
+
@@ -0,0 +1,460 @@
+"""writers.py
+    Module for streaming aggregated forcing to disk one time block at a time
+
+    Each writer appends a computed (time, divide_id) block of a process_geo_data
+    result to its output, so peak memory is proportional to one time chunk
+    rather than the full period.
+"""
+
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import dask
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.coding.times import decode_cf_datetime, encode_cf_datetime
+
+from pipeline import PipelineView
+
+
+def _csv_last_time(file):
+    """The time index of the last row of a csv, read from the end of the file, or None if it has no rows"""
+    with open(file, "rb") as f:
+        size = f.seek(0, 2)
+        f.seek(max(size - 4096, 0))
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    if not lines or (size <= 4096 and len(lines) < 2):
+        return None
+    return pd.Timestamp(lines[-1].split(b",")[0].decode())
+
+
+def _after(ds, last):
+    """The time steps of a block that are not yet written"""
+    if last is None:
+        return ds
+    return ds.isel(time=ds["time"].values > np.datetime64(last))
+
+
+def _make_time_unlimited(path):
+    """Rewrite a netcdf with a fixed size time dimension (e.g. from xarray's to_netcdf) so it can be appended to"""
+    tmp = path.with_name(f"{path.name}.tmp")
+    with netCDF4.Dataset(path, "r") as src, netCDF4.Dataset(tmp, "w") as dst:
+        dst.setncatts(src.__dict__)
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if name == "time" else len(dim))
+        for name, var in src.variables.items():
+            attrs = var.__dict__
+            chunks, filters = var.chunking(), var.filters() or {}
+            if chunks == "contiguous" and var.dimensions == ("catchment-id", "time"):
+                chunks = (1, max(min(len(src.dimensions["time"]), 8760), 1))
+            out = dst.createVariable(
+                name, var.datatype, var.dimensions, fill_value=attrs.pop("_FillValue", None),
+                zlib=filters.get("zlib", False), shuffle=filters.get("shuffle", False),
+                complevel=filters.get("complevel", 4), chunksizes=None if chunks == "contiguous" else chunks,
+            )
+            out.setncatts(attrs)
+            out.set_auto_maskandscale(False)
+            var.set_auto_maskandscale(False)
+            out[:] = var[:]
+    tmp.replace(path)
+
+
+def last_written(writers):
+    """
+    The last time step present in every output of a list of writers opened with mode 'a',
+    or None if any output is missing or empty.
+    """
+    times = [writer.last_time() for writer in writers]
+    if any(t is None for t in times):
+        return None
+    return min(times)
+
+
+class NgenNetcdfWriter:
+    """
+    Appendable, ngen compatible netcdf writer.
+
+    Writes the same layout as generate.to_ngen_netcdf (`ids` and `Time` per
+    catchment-id, variables over (catchment-id, time)), with an unlimited time
+    dimension so blocks can be appended as they are computed.
+
+    Variables are chunked as one catchment by up to `time_chunk` steps, matching
+    ngen's per-catchment reads. With `compress` they are also float32 and
+    zlib/shuffle compressed, and the repeated rows of `Time` then take almost
+    no space on disk.
+
+    Parameters
+    ----------
+    path : str or Path
+        The netcdf file to write.
+    mode : str, optional
+        'w' replaces an existing file, 'a' appends to it. Default 'w'.
+    compress : bool, optional
+        Write float32, compressed and chunked variables. Default False.
+    time_chunk : int, optional
+        Max time steps per chunk; the length of the first block written is used if shorter. Default 8760.
+    """
+
+    def __init__(self, path, mode="w", compress=False, time_chunk=8760):
+        self.path = Path(path)
+        self.mode = mode
+        self.compress = compress
+        self.time_chunk = time_chunk
+        self.nc = None
+
+    def _create(self, ds):
+        ids = ds["divide_id"].values
+        self.nc = netCDF4.Dataset(self.path, "w")
+        self.nc.createDimension("catchment-id", len(ids))
+        self.nc.createDimension("time", None)
+        self.nc.createVariable("catchment-id", np.int64, ("catchment-id",))[:] = np.arange(len(ids))
+        var = self.nc.createVariable("ids", str, ("catchment-id",))
+        var[:] = ids.astype(object)
+        # Encode time the way xarray would for the first block (e.g. 'hours since ...' for hourly data)
+        _, units, calendar = encode_cf_datetime(ds["time"].values)
+        # One catchment per chunk, netcdf's default for an unlimited time dimension is one time step per chunk
+        encoding = {"chunksizes": (1, max(min(ds["time"].size, self.time_chunk), 1))}
+        if self.compress:
+            encoding.update(zlib=True, shuffle=True, complevel=4)
+        var = self.nc.createVariable("Time", np.int64, ("catchment-id", "time"), **encoding)
+        var.units = units
+        var.calendar = calendar
+        for name in ds.data_vars:
+            dtype = np.float32 if self.compress else ds[name].dtype
+            var = self.nc.createVariable(name, dtype, ("catchment-id", "time"), fill_value=np.nan, **encoding)
+            var.coordinates = "Time ids"
+
+    def _open(self, ds):
+        if self.mode == "a" and self.path.exists():
+            with netCDF4.Dataset(self.path, "r") as nc:
+                fixed = not nc.dimensions["time"].isunlimited()
+            if fixed:
+                _make_time_unlimited(self.path)
+            self.nc = netCDF4.Dataset(self.path, "a")
+            if list(self.nc["ids"][:]) != list(ds["divide_id"].values):
+                raise ValueError(f"Catchment ids of {self.path} do not match the data being appended")
+        else:
+            self.path.unlink(missing_ok=True)
+            self._create(ds)
+
+    def last_time(self):
+        """The last time step in the file when appending, otherwise None"""
+        if self.mode != "a" or not self.path.exists():
+            return None
+        with netCDF4.Dataset(self.path, "r") as nc:
+            if len(nc.dimensions["time"]) == 0:
+                return None
+            time = nc["Time"]
+            return pd.Timestamp(decode_cf_datetime(np.asarray(time[0, -1:]), time.units, getattr(time, "calendar", None))[0])
+
+    def write(self, ds):
+        """Append a (time, divide_id) block, skipping time steps already in the file"""
+        if self.nc is None:
+            self.last = self.last_time()
+            self._open(ds)
+        ds = _after(ds, self.last)
+        if ds["time"].size == 0:
+            return
+        start = len(self.nc.dimensions["time"])
+        end = start + ds["time"].size
+        ncat = len(self.nc.dimensions["catchment-id"])
+        times, _, _ = encode_cf_datetime(ds["time"].values, self.nc["Time"].units, self.nc["Time"].calendar)
+        # Write the per catchment copies of Time a few rows at a time rather than broadcasting all of them at once
+        rows = max(int(64e6 // max(times.size * 8, 1)), 1)
+        for row in range(0, ncat, rows):
+            n = min(rows, ncat - row)
+            self.nc["Time"][row:row + n, start:end] = np.broadcast_to(times, (n, times.size))
+        for name in ds.data_vars:
+            self.nc[name][:, start:end] = ds[name].transpose("divide_id", "time").values
+        self.nc.sync()
+
+    def close(self):
+        if self.nc is not None:
+            self.nc.close()
+            self.nc = None
+
+
+class ZarrWriter:
+    """
+    Appendable zarr store of the (time, divide_id) result.
+
+    Parameters
+    ----------
+    path : str or Path
+        The zarr store to write.
+    mode : str, optional
+        'w' replaces an existing store, 'a' appends to it. Default 'w'.
+    """
+
+    def __init__(self, path, mode="w"):
+        self.path = Path(path)
+        self.append = mode == "a" and self.path.exists()
+        self.last = self.last_time()
+
+    def last_time(self):
+        """The last time step in the store when appending, otherwise None"""
+        if not self.append:
+            return None
+        return pd.Timestamp(xr.open_zarr(self.path)["time"].values[-1])
+
+    def write(self, ds):
+        """Append a (time, divide_id) block, skipping time steps already in the store"""
+        ds = _after(ds, self.last)
+        if ds["time"].size == 0:
+            return
+        if self.append:
+            ds.to_zarr(self.path, append_dim="time")
+        else:
+            if self.path.exists():
+                shutil.rmtree(self.path)
+            ds.to_zarr(self.path, mode="w")
+            self.append = True
+
+    def close(self):
+        pass
+
+
+class AggCsvWriter:
+    """
+    Appendable csv of the basin aggregated timeseries (all subcatchments averaged together).
+
+    Parameters
+    ----------
+    path : str or Path
+        The csv file to write.
+    mode : str, optional
+        'w' replaces an existing file, 'a' appends to it. Default 'w'.
+    """
+
+    def __init__(self, path, mode="w"):
+        self.path = Path(path)
+        self.header = not (mode == "a" and self.path.exists())
+        self.last = self.last_time()
+
+    def last_time(self):
+        """The last time step in the file when appending, otherwise None"""
+        return None if self.header else _csv_last_time(self.path)
+
+    def write(self, ds):
+        """Append a (time, divide_id) block, skipping time steps already in the file"""
+        ds = _after(ds, self.last)
+        if ds["time"].size == 0:
+            return
+        agg = ds.to_dataframe().groupby("time").mean()
+        agg.to_csv(self.path, mode="w" if self.header else "a", header=self.header)
+        self.header = False
+
+    def close(self):
+        pass
+
+
+def _bulk_columns(ds):
+    """The csv columns of a (time, divide_id) dataset if every one can be formatted in bulk, otherwise None"""
+    columns = [name for name in ds.variables if name not in ds.dims]
+    for name in columns:
+        if set(ds[name].dims) != {"time", "divide_id"} or ds[name].dtype.kind != "f":
+            return None
+    return columns
+
+
+def format_divide_csvs(ds, columns, mem_mb=256):
+    """
+    Format the csv rows of every divide of a (time, divide_id) dataset, a group of divides at a time.
+
+    The text is byte identical to `ds.to_dataframe().groupby("divide_id")` followed by `to_csv`
+    of each divide, as both format floats with numpy's shortest round trip repr and missing
+    values as empty fields, and the time stamps are formatted by pandas itself.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Variables over (time, divide_id).
+    columns : list
+        The variables to write, see _bulk_columns.
+    mem_mb : float, optional
+        Approximate size of the formatted text of one group of divides. Default 256.
+
+    Yields
+    ------
+    tuple
+        (divide_ids, rows) of a group of divides, with rows[t, i] the csv row (without line end)
+        of divide_ids[i] at time step t.
+    """
+    # pandas decides how datetimes are written (e.g. dates only when every step is at midnight) from the whole index
+    times = np.array(pd.DataFrame(index=pd.Index(ds["time"].values, name="time")).to_csv().splitlines()[1:])
+    values = [ds[name].transpose("time", "divide_id").values for name in columns]
+    ids = ds["divide_id"].values
+    # about 25 characters of 4 bytes per value
+    group = max(int(mem_mb * 1e6 // (100 * (len(columns) + 1) * max(len(times), 1))), 1)
+    for start in range(0, len(ids), group):
+        block = slice(start, start + group)
+        rows = times[:, None]
+        for value in values:
+            value = value[:, block]
+            text = value.astype(str)
+            text[np.isnan(value)] = ""
+            rows = np.char.add(np.char.add(rows, ","), text)
+        yield ids[block], rows
+
+
+class DivideCsvWriter:
+    """
+    Appendable csv timeseries for each sub-catchment, saved as `{path}/{divide_id}_{uniq_name}.csv`.
+
+    Divides are formatted together in bulk (see format_divide_csvs) and their files written from a
+    thread pool, with the same bytes as pandas' to_csv of each divide.
+
+    Parameters
+    ----------
+    path : str or Path
+        The directory to write the csv files in.
+    uniq_name : str
+        The suffix of every file name. None saves `{path}/{divide_id}.csv`.
+    mode : str, optional
+        'w' replaces existing files, 'a' appends to them. Default 'w'.
+    threads : int, optional
+        Number of files written concurrently. Default 8.
+    """
+
+    def __init__(self, path, uniq_name, mode="w", threads=8):
+        self.path = Path(path)
+        self.uniq_name = uniq_name
+        self.mode = mode
+        self.threads = threads
+        self.started = False
+        self.last = {}
+
+    def _file(self, name):
+        if self.uniq_name is None:
+            return self.path / f"{name}.csv"
+        return self.path / f"{name}_{self.uniq_name}.csv"
+
+    def _file_mode(self, file):
+        """Start a new file with a header, unless appending to it"""
+        if self.started or (self.mode == "a" and file.exists()):
+            return "a", False
+        return "w", True
+
+    def _files(self):
+        return self.path.glob("*.csv" if self.uniq_name is None else f"*_{self.uniq_name}.csv")
+
+    def last_time(self):
+        """The earliest last time step of the divide files when appending, otherwise None"""
+        if self.mode != "a":
+            return None
+        times = [_csv_last_time(file) for file in self._files()]
+        if not times or any(t is None for t in times):
+            return None
+        return min(times)
+
+    def _write_pandas(self, ds):
+        """Per divide to_csv, for datasets with columns that cannot be formatted in bulk"""
+        df = ds.to_dataframe()
+        for name, data in df.groupby("divide_id"):
+            file = self._file(name)
+            mode, header = self._file_mode(file)
+            data = data.droplevel("divide_id")
+            last = self.last.get(file.name)
+            if last is not None:
+                data = data[data.index > last]
+            data.to_csv(file, mode=mode, header=header)
+
+    def _write_bulk(self, ds, columns):
+        times = ds["time"].values
+        header = ",".join(["time"] + columns) + "\n"
+
+        def write(file, rows):
+            mode, with_header = self._file_mode(file)
+            last = self.last.get(file.name)
+            if last is not None:
+                rows = rows[times > np.datetime64(last)]
+            text = "\n".join(rows.tolist()) + "\n" if rows.size else ""
+            with open(file, mode) as f:
+                f.write((header if with_header else "") + text)
+
+        with ThreadPoolExecutor(self.threads) as pool:
+            for ids, rows in format_divide_csvs(ds, columns):
+                # consume each write so errors are raised
+                list(pool.map(write, [self._file(id) for id in ids], rows.T))
+
+    def write(self, ds):
+        """Append a (time, divide_id) block, skipping time steps already in each file"""
+        Path.mkdir(self.path, exist_ok=True, parents=True)
+        if not self.started and self.mode == "a":
+            self.last = {file.name: _csv_last_time(file) for file in self._files()}
+        columns = _bulk_columns(ds)
+        if columns is None:
+            self._write_pandas(ds)
+        else:
+            self._write_bulk(ds, columns)
+        self.started = True
+
+    def close(self):
+        pass
+
+
+def stream_forcing(results, writers, ctime=None):
+    """
+    Compute lazy process_geo_data results one time block at a time and hand each block to its writers.
+
+    Parameters
+    ----------
+    results : dict
+        Name to lazy (dask backed) xr.Dataset, e.g. from process_geo_data(..., compute=False)
+        or process_geo_data_batch(..., compute=False). All results must share a time axis;
+        blocks of results from one batch are computed together, so the forcing is read once.
+        With io_workers set, the results are pipeline.PipelineView of one pipeline, whose
+        blocks are written as they are aggregated.
+    writers : dict
+        Name to list of writers (e.g. NgenNetcdfWriter, AggCsvWriter) for that result.
+    ctime : int, optional
+        Number of time steps per block. Default None follows the time chunks of the first result.
+        Not used with pipeline views, whose blocks follow the pipeline.
+    """
+    names = list(results)
+    if isinstance(results[names[0]], PipelineView):
+        _stream_pipeline(results, writers)
+        return
+    ntime = results[names[0]]["time"].size
+    if ctime is None:
+        bounds = np.cumsum((0,) + results[names[0]].chunksizes["time"])
+    else:
+        bounds = np.append(np.arange(0, ntime, ctime), ntime)
+    try:
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            block = slice(start, end)
+            print(f"Writing time steps {start} to {end} of {ntime}")
+            computed = dask.compute(*[results[name].isel(time=block) for name in names])
+            for name, ds in zip(names, computed):
+                for writer in writers[name]:
+                    writer.write(ds)
+    finally:
+        for name in names:
+            for writer in writers[name]:
+                writer.close()
+
+
+def _stream_pipeline(views, writers):
+    """Hand each block of a pipeline to the writers of every view, see stream_forcing"""
+    names = list(views)
+    pipeline = views[names[0]].pipeline
+    if any(views[name].pipeline is not pipeline for name in names):
+        raise ValueError("Pipeline views streamed together must share one pipeline")
+    ntime = pipeline.time.size
+    start = 0
+    try:
+        for block in pipeline.blocks():
+            end = start + block["time"].size
+            print(f"Writing time steps {start} to {end} of {ntime}")
+            start = end
+            for name in names:
+                ds = views[name].select(block)
+                for writer in writers[name]:
+                    writer.write(ds)
+    finally:
+        for name in names:
+            for writer in writers[name]:
+                writer.close()